@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Compare the size and read time of pages stored as JSON and compressed
+
+Pages are read from the files given on the command line (such as a directory
+of pages saved with ``--save-path``), or generated if there are none. Each
+page is stored the way ``--content-compression`` would store it, and then read
+back the way the cache-hit path in ``get_url()`` reads it.
+
+Without ``--dsn``, only the encoding and decoding are measured. With
+``--dsn``, the pages are also stored in a temporary table in Postgres, so that
+the size on disk (after TOAST) and the time for a round trip are measured as
+well.
+
+.. code-block:: bash
+
+    $ python bench/compression.py --pages 2000
+    $ python bench/compression.py --dsn 'dbname=flayer' ~/saved/*.html
+'''
+# Python
+import sys
+import json
+import time
+import random
+import argparse
+
+# 3rd party
+import psycopg2
+import psycopg2.extras
+
+# Internal
+import flayer.compress
+
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+    'tempor incididunt ut labore et dolore magna aliqua recipe flour sugar '
+    'butter eggs oven minutes stir bake serve'
+).split()
+
+
+def generate(count, seed=0):
+    '''
+    Generate pages that look roughly like the HTML on a real site
+    '''
+    rand = random.Random(seed)
+    pages = []
+    for num in range(count):
+        paras = ''.join(
+            '<p class="body">{}</p>\n'.format(' '.join(rand.choice(WORDS) for _ in range(80)))
+            for _ in range(rand.randint(10, 60))
+        )
+        links = ''.join(
+            '<li><a href="/page/{0}">Page {0}</a></li>\n'.format(rand.randint(0, count))
+            for _ in range(100)
+        )
+        pages.append(
+            '<html><head><title>Page {}</title></head><body>\n'
+            '<nav><ul>{}</ul></nav>\n<main>{}</main></body></html>'.format(num, links, paras)
+        )
+    return pages
+
+
+def load(paths):
+    '''
+    Load pages from files
+    '''
+    pages = []
+    for path in paths:
+        with open(path, 'rb') as fh_:
+            pages.append(fh_.read().decode('utf-8', 'replace'))
+    return pages
+
+
+def bench_local(pages, codec):
+    '''
+    Encode and decode every page, and return the total size, and the seconds
+    spent encoding and decoding
+    '''
+    start = time.time()
+    if codec == 'none':
+        stored = [json.dumps({'content': page, 'status': 200}) for page in pages]
+    else:
+        stored = [flayer.compress.compress(page, codec) for page in pages]
+    encode = time.time() - start
+
+    start = time.time()
+    for body in stored:
+        if codec == 'none':
+            flayer.compress.unpack(json.loads(body), None, None, 200)
+        else:
+            flayer.compress.unpack(None, body, codec, 200)
+    decode = time.time() - start
+
+    return sum(len(body) for body in stored), encode, decode
+
+
+def bench_db(dbclient, pages, codec):
+    '''
+    Store every page in a temporary table, and return the size of the table,
+    and the seconds spent reading each page back
+    '''
+    cur = dbclient.cursor()
+    cur.execute('DROP TABLE IF EXISTS bench_content')
+    cur.execute('''
+        CREATE TEMPORARY TABLE bench_content (
+            id integer primary key,
+            data jsonb,
+            body bytea,
+            encoding text,
+            status integer
+        )
+    ''')
+    cur.execute('ALTER TABLE bench_content ALTER COLUMN body SET STORAGE EXTERNAL')
+    opts = {'content_compression': codec}
+    rows = []
+    for num, page in enumerate(pages):
+        columns = flayer.compress.pack(page, 200, {}, opts)
+        rows.append((num, columns['data'], columns['body'], columns['encoding'], 200))
+    psycopg2.extras.execute_values(
+        cur, 'INSERT INTO bench_content VALUES %s', rows,
+    )
+    cur.execute('ANALYZE bench_content')
+    cur.execute("SELECT pg_total_relation_size('bench_content')")
+    size = cur.fetchone()[0]
+
+    start = time.time()
+    for num in range(len(pages)):
+        cur.execute(
+            'SELECT data, body, encoding, status FROM bench_content WHERE id = %s',
+            [num],
+        )
+        flayer.compress.unpack(*cur.fetchone())
+    read = time.time() - start
+
+    dbclient.rollback()
+    return size, read
+
+
+def main():
+    '''
+    Run the benchmark
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--dsn', default=None)
+    parser.add_argument('files', nargs='*')
+    args = parser.parse_args()
+
+    pages = load(args.files) if args.files else generate(args.pages)
+    raw = sum(len(page.encode('utf-8')) for page in pages)
+    codecs = ['none', 'gzip']
+    if flayer.compress.HAS_ZSTD:
+        codecs.append('zstd')
+    else:
+        sys.stderr.write('zstandard is not installed, skipping zstd\n')
+
+    dbclient = None
+    if args.dsn:
+        dbclient = psycopg2.connect(args.dsn)
+
+    print('{} pages, {:.1f} MiB'.format(len(pages), raw / 1048576))
+    print('{:<6} {:>10} {:>7} {:>12} {:>12} {:>10} {:>12}'.format(
+        'codec', 'size MiB', 'ratio', 'encode us', 'decode us', 'db MiB', 'db read us'
+    ))
+    for codec in codecs:
+        size, encode, decode = bench_local(pages, codec)
+        db_size = db_read = ''
+        if dbclient is not None:
+            db_size, db_read = bench_db(dbclient, pages, codec)
+            db_size = '{:.1f}'.format(db_size / 1048576)
+            db_read = '{:.1f}'.format(db_read / len(pages) * 1000000)
+        print('{:<6} {:>10.1f} {:>6.1f}x {:>12.1f} {:>12.1f} {:>10} {:>12}'.format(
+            codec,
+            size / 1048576,
+            raw / size,
+            encode / len(pages) * 1000000,
+            decode / len(pages) * 1000000,
+            db_size,
+            db_read,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Compare pages/sec between the requests engine and the asyncio engine
+
+A local HTTP server stands in for remote sites. Each page takes ``--latency``
+seconds to respond, and links to a handful of other pages. Both engines
+download every page and extract its links with ``flayer.tools.parse_links()``;
+the database is not used, so only the fetch path is being measured.
+
+.. code-block:: bash
+
+    $ python bench/engines.py --pages 500 --latency 0.05 --concurrency 50
+'''
+# Python
+import time
+import asyncio
+import argparse
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# 3rd party
+import requests
+import aiohttp
+
+# Internal
+import flayer.aio
+import flayer.tools
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    '''
+    Threaded HTTP Server
+    '''
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def make_handler(pages, latency):
+    '''
+    Return a handler which serves ``pages`` pages, each ``latency`` seconds
+    slow
+    '''
+    class StandInHandler(BaseHTTPRequestHandler):
+        '''
+        Serve a generated page
+        '''
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            '''
+            Generate a page with some links in it
+            '''
+            time.sleep(latency)
+            page = int(self.path.strip('/') or 0)
+            links = ''.join(
+                '<a href="/{}">page {}</a>\n'.format((page + i) % pages, i)
+                for i in range(1, 21)
+            )
+            body = '<html><body>{}</body></html>'.format(links).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):  # pylint: disable=arguments-differ,unused-argument
+            '''
+            Don't log to the console
+            '''
+            return
+
+    return StandInHandler
+
+
+def bench_requests(base, pages, opts):
+    '''
+    One page at a time, as the requests engine does without workers
+    '''
+    session = requests.Session()
+    for page in range(pages):
+        url = '{}/{}'.format(base, page)
+        content = session.get(url).text
+        flayer.tools.parse_links(url, content, 0, opts)
+
+
+def bench_asyncio(base, pages, opts, concurrency):
+    '''
+    Up to ``concurrency`` pages at a time on an event loop
+    '''
+    async def _run():
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async def _one(page):
+                url = '{}/{}'.format(base, page)
+                _, _, content = await flayer.aio.fetch(session, url, opts)
+                flayer.tools.parse_links(url, content, 0, opts)
+            await asyncio.gather(*[_one(page) for page in range(pages)])
+    asyncio.run(_run())
+
+
+def main():
+    '''
+    Run the benchmark
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+
+    server = StandInServer(('127.0.0.1', 0), make_handler(args.pages, args.latency))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    opts = {
+        'daemon': True,
+        'method': 'GET',
+        'headers': {},
+        'level': 0,
+        'search_src': False,
+        'span_hosts': False,
+    }
+
+    results = {}
+    start = time.time()
+    bench_requests(base, args.pages, opts)
+    results['requests'] = args.pages / (time.time() - start)
+
+    start = time.time()
+    bench_asyncio(base, args.pages, opts, args.concurrency)
+    results['asyncio'] = args.pages / (time.time() - start)
+
+    server.shutdown()
+    for engine, rate in results.items():
+        print('{:<10} {:>10.1f} pages/sec'.format(engine, rate))
+    print('speedup    {:>10.1f}x'.format(results['asyncio'] / results['requests']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Compare the speed of JSON-LD extraction with and without a soup, and check
+that they agree
+
+Pages are read from the files given on the command line, or generated if there
+are none. The blocks on each page are extracted the way that they used to be
+(by building a BeautifulSoup tree and decoding each block with ``json``), and
+with ``flayer.jsonld.extract()``, using ``json`` and (if it is installed)
+``orjson``. Any page where the decoded blocks differ is reported.
+
+.. code-block:: bash
+
+    $ python bench/jsonld.py --pages 500
+    $ python bench/jsonld.py ~/saved/*.html
+'''
+# Python
+import sys
+import json
+import time
+import random
+import argparse
+
+# 3rd party
+from bs4 import BeautifulSoup
+
+# Internal
+import flayer.jsonld
+
+
+def generate(count, seed=0):
+    '''
+    Generate recipe pages, with a large body and a mix of JSON-LD layouts
+    '''
+    rand = random.Random(seed)
+    pages = []
+    for num in range(count):
+        recipe = {
+            '@context': 'https://schema.org',
+            '@type': 'Recipe',
+            'name': 'Recipe {}'.format(num),
+            'recipeIngredient': ['{} cups of thing {}'.format(rand.randint(1, 4), item)
+                                 for item in range(rand.randint(5, 20))],
+            'recipeInstructions': ['Step {}: stir &amp; wait'.format(step)
+                                   for step in range(rand.randint(3, 12))],
+        }
+        kind = rand.random()
+        if kind < .4:
+            data = recipe
+        elif kind < .7:
+            data = {
+                '@context': 'https://schema.org',
+                '@graph': [{'@type': 'WebPage', 'name': 'Page {}'.format(num)}, recipe],
+            }
+        else:
+            data = [{'@type': 'BreadcrumbList', 'itemListElement': []}, recipe]
+        body = ''.join(
+            '<div class="c{0}"><p>Paragraph {0} with <a href="/p/{0}">a link</a></p></div>'.format(
+                rand.randint(0, 1000)
+            )
+            for _ in range(rand.randint(200, 800))
+        )
+        pages.append(
+            '<html><head><title>Recipe {0}</title>'
+            '<script>var x = "<b>" + 1;</script>'
+            '<script type="application/ld+json">{1}</script></head>'
+            '<body>{2}</body></html>'.format(num, json.dumps(data, indent=2), body)
+        )
+    return pages
+
+
+def load(paths):
+    '''
+    Load pages from files
+    '''
+    pages = []
+    for path in paths:
+        with open(path, 'rb') as fh_:
+            pages.append(fh_.read().decode('utf-8', 'replace'))
+    return pages
+
+
+def soup_blocks(page):
+    '''
+    Extract the blocks from a page the way that it used to be done
+    '''
+    blocks = []
+    soup = BeautifulSoup(page, 'html.parser')
+    for tag in soup.find_all('script', attrs={'type': 'application/ld+json'}):
+        for data in tag:
+            try:
+                blocks.append(json.loads(data))
+            except json.decoder.JSONDecodeError:
+                pass
+    return blocks
+
+
+def bench(function, pages):
+    '''
+    Run every page through a function, and return the results and the seconds
+    spent
+    '''
+    start = time.time()
+    ret = [function(page) for page in pages]
+    return ret, time.time() - start
+
+
+def main():
+    '''
+    Run the benchmark
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('files', nargs='*')
+    args = parser.parse_args()
+
+    pages = load(args.files) if args.files else generate(args.pages)
+    print('{} pages, {:.1f} MiB'.format(
+        len(pages), sum(len(page) for page in pages) / 1048576
+    ))
+
+    expected, soup_time = bench(soup_blocks, pages)
+    print('{:<10} {:>10.3f} ms/page'.format('soup', soup_time / len(pages) * 1000))
+
+    backends = [False, True] if flayer.jsonld.HAS_ORJSON else [False]
+    has_orjson = flayer.jsonld.HAS_ORJSON
+    mismatches = 0
+    try:
+        for backend in backends:
+            flayer.jsonld.HAS_ORJSON = backend
+            got, got_time = bench(flayer.jsonld.extract, pages)
+            for num, (blocks, data) in enumerate(zip(expected, got)):
+                if blocks != list(data):
+                    mismatches += 1
+                    sys.stderr.write('Page {} differs\n'.format(
+                        args.files[num] if args.files else num
+                    ))
+            print('{:<10} {:>10.3f} ms/page {:>7.1f}x  {} recipes'.format(
+                'orjson' if backend else 'json',
+                got_time / len(pages) * 1000,
+                soup_time / got_time,
+                sum(len(data.of_type('Recipe')) for data in got),
+            ))
+    finally:
+        flayer.jsonld.HAS_ORJSON = has_orjson
+    if not has_orjson:
+        sys.stderr.write('orjson is not installed, skipping it\n')
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
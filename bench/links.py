@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Compare the speed of the link extractors, and check that they agree
+
+Pages are read from the files given on the command line (such as a directory
+of pages saved with ``--save-path``, or a blob store), or generated if there
+are none. Each page is run through ``flayer.tools.parse_links()`` with
+``link_extractor`` set to ``soup`` and to ``fast``, with and without
+``span_hosts`` and ``search_src``. Any page where the two extractors return
+different links is reported.
+
+.. code-block:: bash
+
+    $ python bench/links.py --pages 500
+    $ python bench/links.py --url http://example.com/ ~/saved/*.html
+'''
+# Python
+import sys
+import time
+import random
+import argparse
+
+# Internal
+import flayer.tools
+
+HOSTS = ('example.com', 'www.example.com', 'cdn.example.net', 'other.org')
+
+
+def generate(count, seed=0):
+    '''
+    Generate pages with a mix of relative, absolute and off-site links
+    '''
+    rand = random.Random(seed)
+    pages = []
+    for num in range(count):
+        links = []
+        for _ in range(200):
+            kind = rand.random()
+            path = '/page/{}?b={}&a={}'.format(
+                rand.randint(0, count), rand.randint(0, 9), rand.randint(0, 9)
+            )
+            if kind < .5:
+                href = path
+            elif kind < .6:
+                href = '../{}#top'.format(rand.randint(0, count))
+            elif kind < .9:
+                href = 'http://{}{}'.format(rand.choice(HOSTS), path)
+            else:
+                href = 'javascript:void(0)'
+            links.append('<li><a href="{}">Page <b>{}</b></a></li>'.format(href, num))
+        images = ''.join(
+            '<img src="//{}/img/{}.jpg">'.format(rand.choice(HOSTS), rand.randint(0, count))
+            for _ in range(20)
+        )
+        pages.append(
+            '<html><head><title>Page {0}</title>'
+            '<script src="/static/app.js"></script></head><body>\n'
+            '<nav><ul>{1}</ul></nav>\n<main><p>Some text &amp; more</p>{2}</main>'
+            '<a>No href</a></body></html>'.format(num, '\n'.join(links), images)
+        )
+    return pages
+
+
+def load(paths):
+    '''
+    Load pages from files
+    '''
+    pages = []
+    for path in paths:
+        with open(path, 'rb') as fh_:
+            pages.append(fh_.read().decode('utf-8', 'replace'))
+    return pages
+
+
+def bench(pages, url, opts):
+    '''
+    Extract the links from every page, and return the links and the seconds
+    spent
+    '''
+    start = time.time()
+    ret = [flayer.tools.parse_links(url, page, 0, opts) for page in pages]
+    return ret, time.time() - start
+
+
+def main():
+    '''
+    Run the benchmark
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=500)
+    parser.add_argument('--url', default='http://example.com/section/index.html')
+    parser.add_argument('files', nargs='*')
+    args = parser.parse_args()
+
+    pages = load(args.files) if args.files else generate(args.pages)
+    print('{} pages, {:.1f} MiB'.format(
+        len(pages), sum(len(page) for page in pages) / 1048576
+    ))
+    print('{:<10} {:<10} {:>8} {:>12} {:>12} {:>8}'.format(
+        'span', 'search_src', 'links', 'soup ms/pg', 'fast ms/pg', 'speedup'
+    ))
+    mismatches = 0
+    for span_hosts in (False, True):
+        for search_src in (False, True):
+            opts = {
+                'level': 0,
+                'span_hosts': span_hosts,
+                'search_src': search_src,
+                'daemon': True,
+            }
+            soup, soup_time = bench(pages, args.url, dict(opts, link_extractor='soup'))
+            fast, fast_time = bench(pages, args.url, dict(opts, link_extractor='fast'))
+            for num, (expected, got) in enumerate(zip(soup, fast)):
+                if expected != got:
+                    mismatches += 1
+                    sys.stderr.write('Page {} differs (span_hosts={}, search_src={})\n'.format(
+                        args.files[num] if args.files else num, span_hosts, search_src
+                    ))
+            print('{:<10} {:<10} {:>8} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+                str(span_hosts),
+                str(search_src),
+                sum(len(links) for links in fast),
+                soup_time / len(pages) * 1000,
+                fast_time / len(pages) * 1000,
+                soup_time / fast_time,
+            ))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Measure how long ``flay`` takes to start, and check it against a budget
+
+``python -X importtime`` is run on ``flayer.scripts`` a number of times, and
+the median time taken to import it is compared with ``--budget`` (in
+milliseconds). The modules which took the longest to import are listed, and
+any of the slow dependencies which are only supposed to be imported by the
+commands that use them (see ``flayer/scripts.py``) are reported if they were
+imported anyway. Then each of the quick commands (``--version`` and
+``--show-opts``) is run, and timed from start to finish.
+
+The script exits with a non-zero status if the budget was exceeded, or if a
+lazy dependency was imported at startup, so that it can be run in CI:
+
+.. code-block:: bash
+
+    $ python bench/startup.py --budget 150
+    $ python bench/startup.py --config-file /etc/flayer/flayer --runs 10
+'''
+# Python
+import os
+import re
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FLAY = os.path.join(ROOT, 'scripts', 'flay')
+
+# Modules which importing flayer.scripts should not import
+LAZY = (
+    'salt', 'requests', 'bs4', 'aiohttp', 'psutil', 'asyncio', 'http.server',
+    'multiprocessing', 'flayer.migrate', 'flayer.pipeline', 'flayer.reprocess',
+)
+
+COMMANDS = (('--version',), ('--show-opts',))
+
+_IMPORTTIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+
+def _env():
+    '''
+    Return the environment to run Python in. Bytecode is written, so that the
+    import times don't include compiling the modules.
+    '''
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [path for path in env.get('PYTHONPATH', '').split(os.pathsep) if path]
+    )
+    return env
+
+
+def importtime(module='flayer.scripts'):
+    '''
+    Import a module in a new interpreter, and return the microseconds taken
+    to import it, and a dict of the modules that it imported, with the
+    microseconds taken to import each of them, not counting their own imports
+    '''
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        env=_env(),
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    modules = []
+    total = None
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME.match(line)
+        if match is None:
+            continue
+        self_us, cumulative, indent, name = match.groups()
+        modules.append((len(indent), name, int(self_us)))
+        if name == module and not indent:
+            total = int(cumulative)
+            break
+    if total is None:
+        raise RuntimeError('{} was not imported'.format(module))
+
+    # Only the modules imported by this one, not by site
+    ret = {}
+    for depth, name, self_us in reversed(modules[:-1]):
+        if depth == 0:
+            break
+        ret[name] = self_us
+    return total, ret
+
+
+def run_command(args):
+    '''
+    Run ``flay`` and return the seconds it took
+    '''
+    start = time.time()
+    subprocess.run(
+        [sys.executable, FLAY] + list(args),
+        env=_env(),
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    return time.time() - start
+
+
+def main():
+    '''
+    Run the benchmark
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=150,
+                        help='Milliseconds that importing flayer.scripts may take')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--config-file', default=None,
+                        help='The config file to run the commands with')
+    args = parser.parse_args()
+
+    # The first run writes the bytecode
+    importtime()
+    totals = []
+    modules = {}
+    for _ in range(args.runs):
+        total, modules = importtime()
+        totals.append(total / 1000)
+    median = statistics.median(totals)
+
+    failed = False
+    print('import flayer.scripts: {:.1f} ms (min {:.1f}, max {:.1f}, budget {:.0f})'.format(
+        median, min(totals), max(totals), args.budget
+    ))
+    for name, self_us in sorted(modules.items(), key=lambda item: -item[1])[:args.top]:
+        print('    {:<40} {:>8.1f} ms'.format(name, self_us / 1000))
+    imported = [
+        name for name in LAZY
+        if any(module == name or module.startswith(name + '.') for module in modules)
+    ]
+    if imported:
+        failed = True
+        print('Imported at startup: {}'.format(', '.join(imported)))
+    if median > args.budget:
+        failed = True
+        print('Over budget by {:.1f} ms'.format(median - args.budget))
+
+    config = ['--config-file', args.config_file] if args.config_file else []
+    if args.config_file or os.path.exists('/etc/flayer/flayer'):
+        for command in COMMANDS:
+            times = [run_command(config + list(command)) for _ in range(args.runs)]
+            print('flay {}: {:.1f} ms'.format(
+                ' '.join(command), statistics.median(times) * 1000
+            ))
+    else:
+        print('No config file, so the commands were not run')
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
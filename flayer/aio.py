@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+'''
+asyncio crawl engine for Web Flayer
+
+This engine is selected with ``--engine asyncio``. Pages are downloaded on an
+event loop using ``aiohttp``, so that a single process can keep a large number
+of slow connections open at once. Everything that talks to the database still
+uses the same functions as the ``requests`` engine, so the cache, the ``urls``
+and ``content`` tables and the parser plugins behave the same way.
+'''
+# Python
+import os
+import random
+import pprint
+import asyncio
+import threading
+import importlib.util
+import concurrent.futures
+
+# Internal
+import flayer.db
+import flayer.canon
+import flayer.document
+import flayer.tools
+
+# aiohttp takes a long time to import, and is only needed once the engine
+# runs, so it is imported then
+HAS_AIOHTTP = importlib.util.find_spec('aiohttp') is not None
+
+
+async def fetch(session, url, opts, headers=None, data=None):
+    '''
+    Download a URL without touching the database, and return the status code,
+    the response headers and the decoded content
+    '''
+    if headers is None:
+        headers = opts['headers']
+    async with session.request(opts['method'], url, headers=headers, data=data) as resp:
+        content = await resp.text(errors='replace')
+        return resp.status, resp.headers, content
+
+
+class StreamAdapter(object):
+    '''
+    Wrap an ``aiohttp`` response so that it can be handed to
+    ``flayer.tools.status()`` from a worker thread, as if it were a streaming
+    ``requests`` response
+    '''
+    def __init__(self, resp, loop):
+        '''
+        Initialize
+        '''
+        self.resp = resp
+        self.loop = loop
+        self.headers = resp.headers
+        self.status_code = resp.status
+        self.encoding = resp.charset
+
+    def iter_content(self, chunk_size=flayer.tools.MIN_CHUNK):
+        '''
+        Read blocks from the response on the event loop
+        '''
+        while True:
+            block = asyncio.run_coroutine_threadsafe(
+                self.resp.content.read(chunk_size), self.loop
+            ).result()
+            if not block:
+                break
+            yield block
+
+
+class Engine(object):
+    '''
+    Process URLs from the in-memory list and the download queue on an event
+    loop
+    '''
+    def __init__(self, opts, context, urls, dbclient, parsers):
+        '''
+        Initialize
+        '''
+        self.opts = opts
+        self.context = context
+        self.urls = urls
+        self.dbclient = dbclient
+        self.parsers = parsers
+        self.out = flayer.tools.Output(opts)
+        self.concurrency = max(int(opts.get('workers', 1)), 1)
+        self.level = 0
+        self.local = threading.local()
+        self.loop = None
+
+        # Database bookkeeping and file downloads run in a small thread pool,
+        # where each thread has its own connection. Link extraction and the
+        # parser plugins share the original dbclient, so they get a single
+        # thread of their own.
+        self.db_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.concurrency, 16),
+        )
+        self.parse_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def _dbclient(self):
+        '''
+        Return the database client for the current thread
+        '''
+        if getattr(self.local, 'dbclient', None) is None:
+            self.local.dbclient = flayer.db.client(self.opts)
+        return self.local.dbclient
+
+    async def db(self, fun):
+        '''
+        Run ``fun(dbclient)`` in the database thread pool
+        '''
+        return await self.loop.run_in_executor(
+            self.db_pool, lambda: fun(self._dbclient())
+        )
+
+    async def parse(self, fun, *args):
+        '''
+        Run ``fun(*args)`` in the parser thread
+        '''
+        return await self.loop.run_in_executor(self.parse_pool, lambda: fun(*args))
+
+    def _stopped(self):
+        '''
+        Check whether a stop has been requested
+        '''
+        if self.opts['stop']:
+            return True
+        if os.path.exists(self.opts['stop_file']):
+            self.out.warn('stop file found, exiting')
+            os.remove(self.opts['stop_file'])
+            return True
+        return False
+
+    def run(self):
+        '''
+        Run the crawl until there is nothing left to do, or a stop is
+        requested
+        '''
+        try:
+            asyncio.run(self._crawl())
+        finally:
+            self.db_pool.shutdown()
+            self.parse_pool.shutdown()
+
+    async def _crawl(self):
+        '''
+        Main loop
+        '''
+        import aiohttp
+
+        self.loop = asyncio.get_running_loop()
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            ssl=None if bool(self.opts.get('verify', True)) else False,
+        )
+        tasks = set()
+        async with aiohttp.ClientSession(connector=connector) as session:
+            while True:
+                if self._stopped():
+                    break
+                if len(self.urls) < 1 and self.opts['use_queue'] is True:
+                    await self.db(
+                        lambda dbclient: flayer.db.pop_dl_queue(dbclient, self.urls, self.opts)
+                    )
+                if self.opts['urls']:
+                    queued, self.opts['urls'] = self.opts['urls'], []
+                    await self.db(
+                        lambda dbclient, queued=queued: flayer.tools.queue_urls(
+                            queued, dbclient, self.opts
+                        )
+                    )
+                # Share domain waits with other agents, every so often
+                if self.urls.scheduler.due():
+                    await self.db(self.urls.scheduler.sync)
+                if len(tasks) >= self.concurrency:
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                try:
+                    url = self.urls.pop(0)
+                except IndexError:
+                    if tasks:
+                        await asyncio.wait(
+                            tasks, timeout=.1, return_when=asyncio.FIRST_COMPLETED
+                        )
+                        continue
+                    if self.opts['daemon']:
+                        await asyncio.sleep(.1)
+                        continue
+                    break
+                if url is None:
+                    # There are URLs, but their hosts are all waiting
+                    await asyncio.sleep(min(self.urls.wait_time() or .1, 1))
+                    continue
+                if url.strip() == '':
+                    self.urls.release(url)
+                    continue
+                task = asyncio.ensure_future(self._process(session, url))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                if self.opts.get('single') is True:
+                    break
+            if tasks:
+                await asyncio.wait(tasks)
+
+    async def _process(self, session, url):
+        '''
+        Download, parse and queue the links for a single URL
+        '''
+        claimed = url
+        unchanged = False
+        try:
+            try:
+                # The hooks are plugin code, so they run in the parser thread
+                url_uuid, url, content = await self.parse(
+                    flayer.tools.pre_flight, url, self.parsers
+                )
+                if url_uuid is None:
+                    url_uuid, content, unchanged = await self.get_url(session, url)
+            finally:
+                self.urls.release(claimed)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.out.error('Error processing {}: {}'.format(url, exc))
+            return
+
+        opts = self.opts
+        if unchanged is True:
+            # Nothing new to parse
+            return
+        if opts.get('source', False) is True:
+            self.out.info(content)
+        content = flayer.document.Document.wrap(content, url, opts)
+        hrefs = await self.parse(content.links, self.level)
+        self.level += 1
+        if opts.get('links', False) is True:
+            self.out.info('\n'.join(hrefs))
+        if opts.get('queuelinks', False) is True:
+            await self.parse(flayer.tools.queue_urls, hrefs, self.dbclient, opts)
+        if opts.get('use_parsers', True) is True:
+            try:
+                await self.parse(
+                    flayer.tools.process_url, url_uuid, url, content, self.parsers
+                )
+            except TypeError:
+                self.out.warn('No matching parsers were found')
+        if opts.get('queue_re'):
+            await self.parse(
+                flayer.tools.queue_regexp, hrefs, opts['queue_re'], self.dbclient, opts
+            )
+
+    async def get_url(self, session, url, parent=None, referer=None):
+        '''
+        Download a URL (if necessary) and store it. This is the asyncio
+        counterpart to ``flayer.tools.fetch_url()``.
+        '''
+        import aiohttp
+
+        opts = self.opts
+        url = flayer.canon.canonicalize(url)
+        headers, data = flayer.tools.prepare_request(url, referer, opts)
+
+        if opts.get('no_db_cache') is True:
+            await self.db(lambda dbclient: flayer.db.finish_url(dbclient, opts, url))
+            status, req_headers, content = await fetch(session, url, opts, headers, data)
+            if opts.get('include_headers') is True:
+                self.out.info(pprint.pformat(dict(req_headers)))
+            if opts['random_wait'] is True:
+                await asyncio.sleep(random.randrange(1, int(opts.get('wait', 10))))
+            opts['warned'].add(url)
+            return 0, content, False
+
+        url_uuid, exists, cached, refresh = await self.db(
+            lambda dbclient: flayer.tools.lookup_url(url, parent, dbclient, opts)
+        )
+        unchanged = False
+
+        if cached is None or cached[0] is None or refresh is True or opts['force'] is True:
+            if cached is not None and cached[0] is not None and opts['force'] is not True:
+                headers.update(flayer.tools.conditional_headers(cached[2]))
+            try:
+                if opts['save_path']:
+                    content, req_headers, status, blob = await self._save_path(
+                        session, url, url_uuid, headers, data
+                    )
+                else:
+                    status, req_headers, content = await fetch(
+                        session, url, opts, headers, data
+                    )
+                    blob = None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                self.out.error('Error downloading {}:'.format(url))
+                self.out.error(exc)
+                return 0, '', False
+            opts['warned'].add(url)
+            if opts.get('include_headers') is True:
+                self.out.info(pprint.pformat(dict(req_headers)))
+            unchanged = opts['force'] is not True and flayer.tools.is_unchanged(
+                cached, status, content, blob
+            )
+            if unchanged is True:
+                self.out.info('{} has not changed'.format(url))
+                content = cached[0]['content']
+                await self.db(lambda dbclient: flayer.db.finish_url(dbclient, opts, url))
+            else:
+                await self.db(
+                    lambda dbclient: flayer.tools.store_content(
+                        url, url_uuid, content, status, cached, dbclient, opts, req_headers, blob
+                    )
+                )
+        else:
+            content = cached[0]['content']
+            await self.db(lambda dbclient: flayer.db.finish_url(dbclient, opts, url))
+
+        if exists is False:
+            if opts['random_wait'] is True:
+                await asyncio.sleep(random.randrange(1, int(opts.get('wait', 10))))
+        return url_uuid, content, unchanged
+
+    async def _save_path(self, session, url, url_uuid, headers, data):
+        '''
+        Stream a URL to disk. The response is read on the event loop, while
+        ``flayer.tools.status()`` writes it out from a database thread.
+        '''
+        downloads = self.context.setdefault('downloads', {})
+        dl_context = downloads[url] = {}
+        file_name = flayer.tools._file_name(url, self.opts)  # pylint: disable=protected-access
+        resume = flayer.tools.resume_headers(file_name, url)
+        if resume:
+            # A partial download can't also be conditional
+            headers = dict(headers, **resume)
+            headers.pop('If-None-Match', None)
+            headers.pop('If-Modified-Since', None)
+        try:
+            async with session.request(
+                    self.opts['method'], url, headers=headers, data=data
+                ) as resp:
+                req = StreamAdapter(resp, self.loop)
+                content, req_headers, blob = await self.db(
+                    lambda dbclient: flayer.tools._save_path(  # pylint: disable=protected-access
+                        url, url_uuid, req, 0, self.opts, dl_context, dbclient
+                    )
+                )
+                return content, req_headers, resp.status, blob
+        finally:
+            del downloads[url]
+
+
+def crawl(opts, context, urls, dbclient, parsers):
+    '''
+    Run the crawl loop using the asyncio engine
+    '''
+    if not HAS_AIOHTTP:
+        out = flayer.tools.Output(opts)
+        out.error('The asyncio engine requires aiohttp to be installed', force=True)
+        return
+    Engine(opts, context, urls, dbclient, parsers).run()
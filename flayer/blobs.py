@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+'''
+Content-addressed blob store for Web Flayer
+
+When ``blob_store`` is set to a directory, downloaded bodies are stored there
+instead of in the database, named after the sha256 digest of their contents,
+and only the digest and size are stored in the ``content`` table. Blobs are
+sharded into two levels of directories, so that no one directory becomes too
+large:
+
+.. code-block:: text
+
+    <blob_store>/9f/86/9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08
+
+The digest is calculated while the body is being streamed to disk, so no
+extra pass over the file is needed. Identical pages, and media which is
+mirrored on several sites, are only stored once. Blobs are read-only, and
+files downloaded with ``save_path`` are copies of their blob (cloned, on
+filesystems which support it, so that they don't take up any more space), so
+editing a saved file can never change the blob behind it.
+
+Blobs are read back with ``mmap``, so bodies never have to travel over the
+database connection, or be read into memory more than once.
+'''
+# Python
+import os
+import mmap
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+# The ioctl which clones a file (a reflink) on btrfs, xfs and friends
+FICLONE = 0x40049409
+
+_STORES = {}
+
+
+def store(opts):
+    '''
+    Return the blob store configured by ``blob_store``, or ``None`` if there
+    isn't one
+    '''
+    root = opts.get('blob_store')
+    if not root:
+        return None
+    if root not in _STORES:
+        _STORES[root] = BlobStore(root)
+    return _STORES[root]
+
+
+def unpack(opts, digest, status):
+    '''
+    Read a page back out of the blob store, into the dict that has always been
+    stored in ``content.data``. Returns ``None`` if the blob is not available.
+    '''
+    blobs = store(opts)
+    if blobs is None:
+        return None
+    try:
+        content = blobs.read_text(digest)
+    except FileNotFoundError:
+        return None
+    return {
+        'content': content,
+        'status': status,
+    }
+
+
+class BlobStore(object):
+    '''
+    A directory of blobs, named after their sha256 digests
+    '''
+    def __init__(self, root):
+        '''
+        Initialize
+        '''
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.tmp = os.path.join(self.root, 'tmp')
+        os.makedirs(self.tmp, mode=0o0755, exist_ok=True)
+
+    def path(self, digest):
+        '''
+        Return the path to a blob
+        '''
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def writer(self):
+        '''
+        Return a new ``BlobWriter``
+        '''
+        return BlobWriter(self)
+
+    def put(self, data):
+        '''
+        Store a blob that is already in memory, and return its writer
+        '''
+        with self.writer() as blob:
+            blob.write(data)
+        blob.commit()
+        return blob
+
+    def open(self, digest):
+        '''
+        Return a read-only ``mmap`` of a blob. Empty blobs can't be mapped, so
+        an empty ``bytes`` is returned for them instead.
+        '''
+        with open(self.path(digest), 'rb') as fh_:
+            if os.fstat(fh_.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(fh_.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read_text(self, digest):
+        '''
+        Return a blob as text, decoded straight out of the mapped file
+        '''
+        mapped = self.open(digest)
+        try:
+            return str(mapped, 'utf-8', 'replace')
+        finally:
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+
+class BlobWriter(object):
+    '''
+    Stream a blob into the store, hashing it along the way. The blob is written
+    to a temporary file, and only moved into place by ``commit()``.
+    '''
+    def __init__(self, blobs):
+        '''
+        Initialize
+        '''
+        self.blobs = blobs
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.digest = None
+        self.fh_ = tempfile.NamedTemporaryFile(dir=blobs.tmp, delete=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fh_.close()
+
+    def write(self, data):
+        '''
+        Write a chunk of the blob
+        '''
+        self.hash.update(data)
+        self.size += len(data)
+        return self.fh_.write(data)
+
+    def resume(self, path, offset=0):
+        '''
+        Write the blob to ``path`` instead of a temporary file, so that it can
+        be resumed if it is interrupted. The first ``offset`` bytes of
+        ``path`` are kept, and hashed again.
+        '''
+        self.abort()
+        self.hash = hashlib.sha256()
+        self.size = 0
+        if not offset:
+            self.fh_ = open(path, 'w+b')
+            return
+        self.fh_ = open(path, 'r+b')
+        while self.size < offset:
+            block = self.fh_.read(min(offset - self.size, 1024 * 1024))
+            if not block:
+                break
+            self.hash.update(block)
+            self.size += len(block)
+        self.fh_.truncate(self.size)
+        self.fh_.seek(self.size)
+
+    def adopt(self, path):
+        '''
+        Use a file which has already been written (out of order, so it could
+        not be hashed along the way) as the blob, hashing it in one pass
+        '''
+        self.abort()
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.fh_ = open(path, 'rb')
+        for block in iter(lambda: self.fh_.read(1024 * 1024), b''):
+            self.hash.update(block)
+            self.size += len(block)
+
+    def flush(self):
+        '''
+        Flush the file
+        '''
+        return self.fh_.flush()
+
+    def fileno(self):
+        '''
+        Return the file descriptor of the temporary file
+        '''
+        return self.fh_.fileno()
+
+    def truncate(self, size):
+        '''
+        Truncate the temporary file
+        '''
+        return self.fh_.truncate(size)
+
+    def commit(self):
+        '''
+        Move the blob into place, unless an identical one is already stored,
+        and return its digest
+        '''
+        self.fh_.close()
+        digest = self.hash.hexdigest()
+        path = self.blobs.path(digest)
+        os.makedirs(os.path.dirname(path), mode=0o0755, exist_ok=True)
+        # Temporary files are only readable by their owner, and blobs must
+        # never be written to once they are in place
+        os.chmod(self.fh_.name, 0o0444)
+        try:
+            os.link(self.fh_.name, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            # No hard links on this filesystem
+            os.replace(self.fh_.name, path)
+        if os.path.exists(self.fh_.name):
+            os.remove(self.fh_.name)
+        self.digest = digest
+        return digest
+
+    def abort(self):
+        '''
+        Throw the blob away
+        '''
+        self.fh_.close()
+        try:
+            os.remove(self.fh_.name)
+        except FileNotFoundError:
+            pass
+
+    def copy(self, file_name):
+        '''
+        Save a copy of the committed blob as ``file_name``. The copy is cloned
+        where the filesystem supports it, and moved into place with a rename,
+        so that whatever was at ``file_name`` before (including a link to a
+        blob, from older versions) is replaced rather than written to.
+        '''
+        path = self.blobs.path(self.digest)
+        dirname = os.path.dirname(os.path.abspath(file_name))
+        with open(path, 'rb') as src:
+            dst = tempfile.NamedTemporaryFile(dir=dirname, delete=False)
+            try:
+                with dst:
+                    try:
+                        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    except OSError:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.chmod(dst.name, 0o0644)
+                os.replace(dst.name, file_name)
+            except BaseException:
+                os.remove(dst.name)
+                raise
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+'''
+URL canonicalization and hashing for Web Flayer
+
+The same page can be linked to in many ways: with the host in a different
+case, with the default port spelled out, with a fragment on the end, or with
+its query parameters in a different order. Each of these used to be stored,
+and downloaded, separately. ``canonicalize()`` turns them all into the same
+URL before they are queued, downloaded or looked up.
+
+Each URL is also stored with a 64-bit hash, ``url_hash``, which is what the
+``urls``, ``dl_queue`` and ``url_metadata`` tables are indexed on, rather than
+the (often long) URL itself. The hash is the first 8 bytes of the MD5 of the
+URL, so that Postgres can calculate it too (see ``SQL_URL_HASH``). Two URLs
+may have the same hash, so the tables are only unique on the hash and the URL
+together, and lookups always compare the URL as well as the hash: a collision
+costs an extra comparison, but never returns the wrong row, or keeps a URL
+from being stored.
+'''
+# Python
+import re
+import hashlib
+import urllib.parse
+
+DEFAULT_PORTS = {
+    'http': 80,
+    'https': 443,
+    'ftp': 21,
+}
+
+# The same hash as url_hash(), for use in SQL. Format it with the column (or
+# placeholder) to hash.
+SQL_URL_HASH = "('x' || left(md5({}), 16))::bit(64)::bigint"
+
+_ESCAPE = re.compile('%[0-9a-fA-F]{2}')
+
+
+def canonicalize(url):
+    '''
+    Return the canonical form of a URL:
+
+    * The scheme and host are lowercased, and the default port is dropped
+    * An empty path becomes ``/``, and ``.`` and ``..`` segments are resolved
+    * Percent-escapes are uppercased
+    * Query parameters are sorted by name (keeping the order of parameters
+      with the same name)
+    * The fragment is dropped
+
+    URLs without a scheme and host (such as ``mailto:`` links) are returned
+    with only the fragment dropped.
+    '''
+    url = url.strip()
+    try:
+        comps = urllib.parse.urlsplit(url)
+        port = comps.port
+    except ValueError:
+        return url.split('#')[0]
+    if not comps.scheme or not comps.netloc:
+        return url.split('#')[0]
+
+    scheme = comps.scheme.lower()
+    netloc = (comps.hostname or '').rstrip('.')
+    if ':' in netloc:
+        # IPv6
+        netloc = '[{}]'.format(netloc)
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc = '{}:{}'.format(netloc, port)
+    if comps.username is not None:
+        userinfo = comps.username
+        if comps.password is not None:
+            userinfo = '{}:{}'.format(userinfo, comps.password)
+        netloc = '{}@{}'.format(userinfo, netloc)
+
+    path = _upper_escapes(_remove_dot_segments(comps.path or '/'))
+    query = comps.query
+    if query:
+        params = [param for param in query.split('&') if param]
+        params.sort(key=lambda param: param.split('=', 1)[0])
+        query = _upper_escapes('&'.join(params))
+
+    return urllib.parse.urlunsplit((scheme, netloc, path, query, ''))
+
+
+def url_hash(url):
+    '''
+    Return the 64-bit hash of a URL, as a signed integer (to fit in a
+    ``bigint``)
+    '''
+    digest = hashlib.md5(url.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def _remove_dot_segments(path):
+    '''
+    Resolve the ``.`` and ``..`` segments of a path, as in RFC 3986
+    '''
+    if '.' not in path:
+        return path
+    segments = path.split('/')
+    ret = []
+    for segment in segments[1:-1]:
+        if segment == '..':
+            if ret:
+                ret.pop()
+        elif segment != '.':
+            ret.append(segment)
+    last = segments[-1]
+    if last == '..':
+        if ret:
+            ret.pop()
+        last = ''
+    elif last == '.':
+        last = ''
+    return '/' + '/'.join(ret + [last])
+
+
+def _upper_escapes(text):
+    '''
+    Uppercase the percent-escapes in a string
+    '''
+    if '%' not in text:
+        return text
+    return _ESCAPE.sub(lambda match: match.group(0).upper(), text)
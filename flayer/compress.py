@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+'''
+Compressed page storage for Web Flayer
+
+By default, each page is stored in ``content.data`` as JSON, which means the
+whole page is parsed as JSON whenever it is read back out, and is only
+compressed as much as Postgres is willing to compress it. When
+``content_compression`` is set to ``gzip`` or ``zstd``, the page is instead
+compressed and stored in ``content.body`` as ``bytea``, with its status and
+headers in their own columns, and ``content.data`` is left empty.
+
+Pages are decompressed transparently when they are read back out of the
+cache, no matter which way they were stored.
+
+``zstd`` requires the ``zstandard`` module.
+'''
+# Python
+import zlib
+import threading
+
+# 3rd party
+import psycopg2
+import psycopg2.extras
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+CODECS = ('none', 'gzip', 'zstd')
+
+_LOCAL = threading.local()
+
+
+def _zstd(kind, level=3):
+    '''
+    Return a zstd compressor or decompressor for the current thread. These
+    are not thread-safe, but are worth reusing.
+    '''
+    if not HAS_ZSTD:
+        raise RuntimeError('zstd compression requires the zstandard module')
+    key = 'zstd_{}'.format(kind)
+    ret = getattr(_LOCAL, key, None)
+    if ret is None:
+        if kind == 'compressor':
+            ret = zstandard.ZstdCompressor(level=level)
+        else:
+            ret = zstandard.ZstdDecompressor()
+        setattr(_LOCAL, key, ret)
+    return ret
+
+
+def compress(text, codec):
+    '''
+    Compress a page with the named codec, and return the bytes
+    '''
+    raw = text.encode('utf-8')
+    if codec == 'gzip':
+        # A zlib stream with a gzip header, so that the body can also be
+        # unpacked with standard tools
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress(raw) + compressor.flush()
+    if codec == 'zstd':
+        return _zstd('compressor').compress(raw)
+    return raw
+
+
+def decompress(body, codec):
+    '''
+    Decompress a page which was stored with the named codec, and return the
+    text
+    '''
+    body = bytes(body)
+    if codec == 'gzip':
+        raw = zlib.decompress(body, 47)
+    elif codec == 'zstd':
+        raw = _zstd('decompressor').decompress(body)
+    else:
+        raw = body
+    return raw.decode('utf-8')
+
+
+def pack(content, status_code, headers, opts):
+    '''
+    Return the columns of the ``content`` table for a page, stored as
+    configured by ``content_compression``
+    '''
+    content = content.replace('\x00', '')
+    codec = opts.get('content_compression') or 'none'
+    if codec == 'none':
+        return {
+            'data': psycopg2.extras.Json({'content': content, 'status': status_code}),
+            'body': None,
+            'encoding': None,
+            'status': status_code,
+            'headers': psycopg2.extras.Json(dict(headers or {})),
+        }
+    return {
+        'data': None,
+        'body': psycopg2.Binary(compress(content, codec)),
+        'encoding': codec,
+        'status': status_code,
+        'headers': psycopg2.extras.Json(dict(headers or {})),
+    }
+
+
+def unpack(data, body, encoding, status):
+    '''
+    Turn a row from the ``content`` table back into the dict that has always
+    been stored in ``content.data``, decompressing the body if necessary
+    '''
+    if body is None:
+        return data
+    return {
+        'content': decompress(body, encoding),
+        'status': status,
+    }
+
+
+def convert(dbclient, opts, batch_size=500):
+    '''
+    Compress any pages which are still stored as JSON, using the codec from
+    ``content_compression``. Pages are converted in batches, each in their
+    own transaction, so that this can be interrupted and picked up again
+    later. Returns the number of pages that were converted.
+    '''
+    codec = opts.get('content_compression') or 'none'
+    if codec == 'none':
+        return 0
+
+    cur = dbclient.cursor()
+    count = 0
+    while True:
+        cur.execute('''
+            SELECT uuid, data->>'content', (data->>'status')::integer
+            FROM content
+            WHERE body IS NULL
+            AND data ? 'content'
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ''', [batch_size])
+        rows = cur.fetchall()
+        if not rows:
+            dbclient.commit()
+            return count
+        psycopg2.extras.execute_values(
+            cur,
+            '''
+            UPDATE content
+            SET body = batch.body, encoding = batch.encoding,
+                status = batch.status, data = NULL
+            FROM (VALUES %s) AS batch (uuid, body, encoding, status)
+            WHERE content.uuid = batch.uuid
+            ''',
+            [
+                (uuid, psycopg2.Binary(compress(text or '', codec)), codec, status)
+                for uuid, text, status in rows
+            ],
+            template='(%s::uuid, %s::bytea, %s, %s::integer)',
+        )
+        dbclient.commit()
+        count += len(rows)
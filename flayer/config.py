@@ -68,6 +68,14 @@ def load(opts):
         default=[],
         help='Location for flayer filter plugins',
     )
+    parser.add_argument(
+        '--plugin-loader',
+        dest='plugin_loader',
+        action='store',
+        default='auto',
+        choices=['auto', 'salt', 'builtin'],
+        help='How to load plugins',
+    )
     parser.add_argument(
         '--salt-node',
         dest='salt_node',
@@ -159,6 +167,20 @@ def load(opts):
         default=0,
         help='Amount of time to wait between requests, per domain',
     )
+    parser.add_argument(
+        '--domain-burst',
+        dest='domain_burst',
+        action='store',
+        default=1,
+        help='Number of requests that may be made to a domain before waiting',
+    )
+    parser.add_argument(
+        '--domain-wait-sync',
+        dest='domain_wait_sync',
+        action='store',
+        default=5,
+        help='Seconds between syncing domain waits with the database',
+    )
     parser.add_argument(
         '--random-wait',
         dest='random_wait',
@@ -166,6 +188,28 @@ def load(opts):
         default=False,
         help='Random wait (default from 1 to 10 seconds) between requests',
     )
+    parser.add_argument(
+        '--engine',
+        dest='engine',
+        action='store',
+        default='requests',
+        choices=['requests', 'asyncio'],
+        help='The engine to download URLs with (requests or asyncio)',
+    )
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        action='store',
+        default=1,
+        help='Number of fetch workers to run at the same time',
+    )
+    parser.add_argument(
+        '--parse-processes',
+        dest='parse_processes',
+        action='store',
+        default=0,
+        help='Number of processes to parse pages with (default 0, parse inline)',
+    )
     parser.add_argument(
         '-s', '--single',
         dest='single',
@@ -212,6 +256,13 @@ def load(opts):
         action='store_false',
         help="Don't process any of the items in the download queue",
     )
+    parser.add_argument(
+        '--claim-size',
+        dest='claim_size',
+        action='store',
+        default=10,
+        help='Number of URLs to claim from the download queue at once',
+    )
     parser.add_argument(
         '--queue',
         dest='queue',
@@ -219,6 +270,27 @@ def load(opts):
         default=False,
         help='Add the URLs to the download queue and exit',
     )
+    parser.add_argument(
+        '--queue-batch-size',
+        dest='queue_batch_size',
+        action='store',
+        default=1000,
+        help='Number of URLs to add to the download queue at once',
+    )
+    parser.add_argument(
+        '--seen-filter',
+        dest='seen_filter',
+        action='store',
+        default=None,
+        help='File to keep a filter of the URLs that have already been seen in',
+    )
+    parser.add_argument(
+        '--seen-filter-size',
+        dest='seen_filter_size',
+        action='store',
+        default=10000000,
+        help='Number of URLs to size a new seen-URL filter for',
+    )
     parser.add_argument(
         '-p', '--reprocess',
         dest='reprocess',
@@ -255,6 +327,14 @@ def load(opts):
         default=False,
         help='Search tags with src attribute, in addition to hrefs',
     )
+    parser.add_argument(
+        '--link-extractor',
+        dest='link_extractor',
+        action='store',
+        default='fast',
+        choices=['fast', 'soup'],
+        help='How to extract the links from a page',
+    )
     parser.add_argument(
         '-x', '--force-directories',
         dest='force_directories',
@@ -322,6 +402,56 @@ def load(opts):
         nargs='+',
         help='Name of a queued URL to unpause',
     )
+    parser.add_argument(
+        '--content-compression',
+        dest='content_compression',
+        action='store',
+        default='none',
+        choices=['none', 'gzip', 'zstd'],
+        help='Compress pages stored in the database (none, gzip or zstd)',
+    )
+    parser.add_argument(
+        '--blob-store',
+        dest='blob_store',
+        action='store',
+        default=None,
+        help='Directory to store downloaded bodies in, by their sha256 digests',
+    )
+    parser.add_argument(
+        '--segments',
+        dest='segments',
+        action='store',
+        default=1,
+        help='Number of segments to download large files in, at the same time',
+    )
+    parser.add_argument(
+        '--segment-min-size',
+        dest='segment_min_size',
+        action='store',
+        default=16777216,
+        help='Smallest file, in bytes, to download in segments',
+    )
+    parser.add_argument(
+        '--segment-timeout',
+        dest='segment_timeout',
+        action='store',
+        default=60,
+        help='Seconds to wait for a segment to connect or send data',
+    )
+    parser.add_argument(
+        '--pool-size',
+        dest='pool_size',
+        action='store',
+        default=10,
+        help='Number of keep-alive connections to keep open for each host',
+    )
+    parser.add_argument(
+        '--pool-hosts',
+        dest='pool_hosts',
+        action='store',
+        default=100,
+        help='Number of hosts to keep connections open for',
+    )
     parser.add_argument(
         '--verify',
         dest='verify',
@@ -426,6 +556,13 @@ def load(opts):
         action='append',
         help='Show any metadata for the given URL',
     )
+    parser.add_argument(
+        '--migrate',
+        dest='migrate',
+        action='store_true',
+        default=False,
+        help='Bring the database schema up to date, and check its indexes',
+    )
     parser.add_argument(
         '--show-opts',
         dest='show_opts',
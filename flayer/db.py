@@ -4,17 +4,26 @@ Database functions for Web Flayer
 '''
 # Python
 import os
-import time
 import json
 import urllib
-import datetime
 
 # 3rd party
 import psycopg2
 import psycopg2.extras
 
 # Internal
+import flayer.seen
+import flayer.blobs
+import flayer.canon
 import flayer.tools
+import flayer.compress
+import flayer.frontier
+
+# The columns of the content table that finish_url() can store
+CONTENT_COLUMNS = (
+    'data', 'body', 'encoding', 'status', 'headers', 'digest', 'size',
+    'etag', 'last_modified', 'body_hash',
+)
 
 
 def client(config):
@@ -37,54 +46,199 @@ def pop_dl_queue(dbclient, urls, opts):
     '''
     Check the database for any queued URLS, and add to the list
     '''
-    cur = dbclient.cursor()
+    claim_dl_queue(dbclient, urls, opts, int(opts.get('claim_size', 10)))
 
-    # Unpause jobs past the time limit
-    cur.execute('''
-        UPDATE dl_queue
-        SET paused_until = NULL
-        WHERE paused_until IS NOT NULL
-        AND paused_until <= NOW()
-    ''')
-    dbclient.commit()
 
-    # Lock a URL for this instance
+def claim_dl_queue(dbclient, urls, opts, limit=1):
+    '''
+    Claim up to ``limit`` URLs from the download queue, and add them to the
+    list (or frontier, in which case their ``dl_order`` is kept). Rows which
+    are locked by another agent are skipped, rather than waited on, so
+    multiple agents can claim from the queue at the same time.
+
+    In the same statement, jobs which are past their ``paused_until`` time are
+    unpaused, claimed jobs with a ``refresh_interval`` are paused until their
+    next refresh, and all other claimed jobs are deleted from the queue. The
+    frontier keeps the rows which were deleted, so that any which have not
+    been processed by the time the agent stops can be put back with
+    ``requeue_claims()``.
+
+    Returns a list of ``(uuid, url, dl_order, added)`` tuples for the rows
+    that were claimed.
+    '''
+    cur = dbclient.cursor()
     cur.execute('''
-        LOCK TABLE ONLY dl_queue;
-        UPDATE dl_queue
-        SET locked_by = %s
-        WHERE uuid = (
-            SELECT uuid
+        WITH unpaused AS (
+            UPDATE dl_queue
+            SET paused_until = NULL
+            WHERE paused_until IS NOT NULL
+            AND paused_until <= NOW()
+        ), claimed AS (
+            SELECT uuid, url, dl_order, added, refresh_interval, overwrite
             FROM dl_queue
             WHERE paused = FALSE
             AND paused_until IS NULL
             ORDER BY dl_order, added
-            LIMIT 1
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ), refreshed AS (
+            UPDATE dl_queue
+            SET paused_until = NOW() + (
+                SELECT string_agg(value || ' ' || key, ' ')
+                FROM jsonb_each_text(claimed.refresh_interval)
+            )::interval
+            FROM claimed
+            WHERE dl_queue.uuid = claimed.uuid
+            AND jsonb_typeof(claimed.refresh_interval) = 'object'
+        ), deleted AS (
+            DELETE FROM dl_queue
+            USING claimed
+            WHERE dl_queue.uuid = claimed.uuid
+            AND jsonb_typeof(claimed.refresh_interval) IS DISTINCT FROM 'object'
         )
+        SELECT uuid, url, dl_order, added, overwrite,
+               jsonb_typeof(refresh_interval) = 'object' AS refreshing
+        FROM claimed
+        ORDER BY dl_order, added
+    ''', [limit])
+    rows = cur.fetchall()
+    dbclient.commit()
+
+    for uuid, url, dl_order, added, overwrite, refreshing in rows:
+        if isinstance(urls, flayer.frontier.Frontier):
+            claim = None
+            if not refreshing:
+                # Refreshed jobs are still in the queue, so only deleted
+                # ones need to be put back
+                claim = (uuid, url, dl_order, added, overwrite)
+            urls.push(url, dl_order, added, claim=claim)
+        else:
+            urls.append(url)
+    return [row[:4] for row in rows]
+
+
+def requeue_claims(dbclient, urls):
+    '''
+    Put the URLs which were claimed from the download queue by this agent,
+    but not processed, back into the queue as they were. This is done when
+    the agent stops, since URLs are claimed several at a time. Returns the
+    number of URLs that were put back.
+    '''
+    if not isinstance(urls, flayer.frontier.Frontier):
+        return 0
+    claims = urls.claims()
+    if not claims:
+        return 0
+    cur = dbclient.cursor()
+    rows = psycopg2.extras.execute_values(
+        cur,
+        '''
+        INSERT INTO dl_queue (uuid, url, url_hash, dl_order, added, overwrite)
+        VALUES %s
+        ON CONFLICT DO NOTHING
         RETURNING uuid
-    ''', [opts['id']])
-    if cur.rowcount > 0:
-        data = cur.fetchone()
-        url_uuid = data[0]
-    else:
-        return
-
-    # Helps out with the lock
-    time.sleep(.2)
-
-    # Queue the URL and delete it from the queue
-    cur.execute('SELECT url, refresh_interval FROM dl_queue WHERE uuid = %s', [url_uuid])
-    url, refresh = cur.fetchone()
-    urls.append(url)
-    if refresh:
-        next_refresh = datetime.datetime.now() + datetime.timedelta(**refresh)
-        cur.execute('''
-            UPDATE dl_queue SET locked_by = '', paused_until = %s WHERE uuid = %s
-        ''', [next_refresh, url_uuid])
-    else:
-        cur.execute('DELETE FROM dl_queue WHERE uuid = %s', [url_uuid])
+        ''',
+        [
+            (uuid, url, flayer.canon.url_hash(url), dl_order, added, overwrite)
+            for uuid, url, dl_order, added, overwrite in claims
+        ],
+        template='(%s::uuid, %s, %s::bigint, %s, %s, %s)',
+        page_size=len(claims),
+        fetch=True,
+    )
     dbclient.commit()
-    opts['queue_id'] = url_uuid
+    return len(rows)
+
+
+def queue_batch(dbclient, opts, urls, skip_existing=True):
+    '''
+    Add a batch of URLs to the download queue, in a single statement. URLs
+    which are already queued are skipped, as are URLs which have already been
+    downloaded, if ``skip_existing`` is ``True``.
+
+    Returns the number of URLs that were added.
+    '''
+    cur = dbclient.cursor()
+
+    refresh = opts.get('refresh_interval')
+    if isinstance(refresh, dict):
+        refresh = json.dumps(refresh)
+
+    # Duplicates within the batch would get past the NOT EXISTS checks
+    urls = list(dict.fromkeys(urls))
+    seen = flayer.seen.store(opts)
+    if skip_existing and seen is not None and urls and all(url in seen for url in urls):
+        # Every URL has probably been seen before, so confirm that without
+        # writing anything, and only queue the ones that were false positives
+        urls = _unseen(dbclient, urls)
+        if not urls:
+            return 0
+    args = [
+        (url, flayer.canon.url_hash(url), refresh, opts['overwrite'])
+        for url in urls
+    ]
+
+    existing = '''
+        AND NOT EXISTS (
+            SELECT 1 FROM urls WHERE urls.url_hash = v.url_hash AND urls.url = v.url
+        )
+    ''' if skip_existing else ''
+    sql = '''
+        INSERT INTO dl_queue (url, url_hash, refresh_interval, overwrite)
+        SELECT v.url, v.url_hash, v.refresh_interval, v.overwrite
+        FROM (VALUES %s) AS v (url, url_hash, refresh_interval, overwrite)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM dl_queue
+            WHERE dl_queue.url_hash = v.url_hash AND dl_queue.url = v.url
+        )
+        {}
+        ON CONFLICT DO NOTHING
+        RETURNING uuid
+    '''.format(existing)
+    rows = psycopg2.extras.execute_values(
+        cur,
+        sql,
+        args,
+        template='(%s, %s::bigint, %s::jsonb, %s)',
+        page_size=len(args),
+        fetch=True,
+    )
+    dbclient.commit()
+    flayer.seen.add(opts, urls)
+    return len(rows)
+
+
+def _unseen(dbclient, urls):
+    '''
+    Return the URLs which are in neither ``urls`` nor ``dl_queue``
+    '''
+    cur = dbclient.cursor()
+    cur.execute('''
+        SELECT url FROM urls WHERE url_hash = ANY(%(hashes)s)
+        UNION ALL
+        SELECT url FROM dl_queue WHERE url_hash = ANY(%(hashes)s)
+    ''', {'hashes': [flayer.canon.url_hash(url) for url in urls]})
+    known = {row[0] for row in cur.fetchall()}
+    dbclient.commit()
+    return [url for url in urls if url not in known]
+
+
+def queue_size(dbclient):
+    '''
+    Return an estimate of the number of URLs in the download queue. This is
+    taken from the table statistics, so it's cheap even for large queues, but
+    may lag behind by a moment.
+    '''
+    cur = dbclient.cursor()
+    cur.execute('''
+        SELECT n_live_tup
+        FROM pg_stat_user_tables
+        WHERE relname = 'dl_queue'
+    ''')
+    row = cur.fetchone()
+    if row is None:
+        return 0
+    return int(row[0])
 
 
 def update_url_refresh(url_uuid, interval, dbclient, opts):
@@ -137,9 +291,12 @@ def pause(dbclient, opts, urls):
 
     cur = dbclient.cursor()
 
-    spacer = ', '.join(['%s' for url in range(len(urls))])
-    sql = 'UPDATE dl_queue SET paused = true WHERE url IN ({})'.format(spacer)
-    cur.execute(sql, urls)
+    urls = [flayer.canon.canonicalize(url) for url in urls]
+    sql = '''
+        UPDATE dl_queue SET paused = true
+        WHERE url_hash = ANY(%s) AND url = ANY(%s)
+    '''
+    cur.execute(sql, [[flayer.canon.url_hash(url) for url in urls], urls])
     dbclient.commit()
     out.info(ret)
     return ret
@@ -154,101 +311,242 @@ def unpause(dbclient, opts, urls):
 
     cur = dbclient.cursor()
 
-    spacer = ', '.join(['%s' for url in range(len(urls))])
-    sql = 'UPDATE dl_queue SET paused = false WHERE url IN ({})'.format(spacer)
-    cur.execute(sql, urls)
+    urls = [flayer.canon.canonicalize(url) for url in urls]
+    sql = '''
+        UPDATE dl_queue SET paused = false
+        WHERE url_hash = ANY(%s) AND url = ANY(%s)
+    '''
+    cur.execute(sql, [[flayer.canon.url_hash(url) for url in urls], urls])
     dbclient.commit()
     out.info(ret)
     return ret
 
 
-def pattern_wait(dbclient, url):
-    '''
-    Check the URL against the ``pattern_wait`` table, using a regular
-    expression. If it matches, then all other URLs that match the pattern will
-    have their ``paused_until`` values updated to ``now() + {wait} seconds``.
+# Shared by begin_url() and finish_url(): apply any matching pattern_wait to
+# the download queue
+_PATTERN_CTES = '''
+    pattern AS (
+        SELECT wait, pattern
+        FROM pattern_wait
+        WHERE %(url)s ~ pattern
+        LIMIT 1
+    ), paused AS (
+        UPDATE dl_queue
+        SET paused_until = now() + pattern.wait * interval '1 second'
+        FROM pattern
+        WHERE dl_queue.url ~ pattern.pattern
+    )
+'''
 
-    Only the first match will be returned, so it's best to make patterns as
-    specific as possible. Normally a pattern will only be a domain name, so
-    this should not normally be a problem.
+# Shared by begin_url() and finish_url(): check and set the domain_wait for
+# the URL's domain. These are skipped when the agent is keeping track of the
+# waits itself (see flayer.scheduler).
+_DOMAIN_CTES = '''
+    expired AS (
+        DELETE FROM domain_wait
+        WHERE wait_until < now()
+        AND domain <> %(domain)s
+    ), waiting AS (
+        SELECT count(*) AS count
+        FROM domain_wait
+        WHERE domain = %(domain)s
+        AND wait_until >= now()
+    ), domain_set AS (
+        INSERT INTO domain_wait (domain, wait_until)
+        VALUES (%(domain)s, now() + %(domain_wait)s * interval '1 second')
+        ON CONFLICT (domain) DO UPDATE
+        SET wait_until = EXCLUDED.wait_until
+        WHERE domain_wait.wait_until < {extend_before}
+    )
+'''
 
-    This function should be run before and after any download, such as
-    ``get_url()`` and ``status()``. Running before will help prevent other
-    agents from hitting the domain again at the same time, and running after
-    will keep all agents from hitting a domain again too fast.
-    '''
-    cur = dbclient.cursor()
+_NOT_WAITING_CTE = '''
+    waiting AS (
+        SELECT 0 AS count
+    )
+'''
 
-    sql = 'SELECT wait, pattern FROM pattern_wait WHERE %s ~ pattern LIMIT 1'
-    cur.execute(sql, [url])
-    try:
-        row = cur.fetchone()
-        wait = row[0]
-        pattern = row[1]
-    except TypeError:
-        # No matches
-        return
 
-    sql = '''
-        UPDATE dl_queue
-        SET paused_until = now() + '%s seconds'
-        WHERE %s ~ url
+def _wait_ctes(opts, extend_before):
     '''
-    cur.execute(sql, [wait, pattern])
-    dbclient.commit()
-
-
-def check_domain_wait(dbclient, url):
+    Return the CTEs which handle the waits for a URL
     '''
-    Check the URL against the ``domain_wait`` table. If the domain is in the
-    table, it will check the ``wait_until`` field. If that time has not yet
-    passed, return ``False``.
+    if opts.get('local_domain_wait') is True:
+        return [_PATTERN_CTES, _NOT_WAITING_CTE]
+    return [_PATTERN_CTES, _DOMAIN_CTES.format(extend_before=extend_before)]
 
-    Before checking the ``domain_wait`` table for the domain, another query
-    will delete any entries from the table that are passed the ``wait_until``
-    time.
 
-    This function should be run before any download, such as ``get_url()`` and
-    ``status()``. Running before will help prevent other agents from hitting
-    the domain again at the same time, or too quickly afterwards.
+def begin_url(dbclient, opts, url, parent=None):
+    '''
+    Do all of the database bookkeeping that is needed before downloading a
+    URL, in a single round trip:
+
+    * Clear out expired ``domain_wait`` entries, check whether the URL's
+      domain is still waiting, and set the ``domain_wait`` for the domain
+      (unless ``local_domain_wait`` is set)
+    * Apply ``pattern_wait``
+    * Look up the URL in ``urls``, adding it if necessary
+    * Save the referer relationship, if a ``parent`` is passed in
+    * Look up any cached content for the URL
+    * Check whether the URL is queued with a ``refresh_interval``
+
+    Returns a dict containing ``url_uuid``, ``exists``, ``data`` and
+    ``content_uuid`` (both ``None`` if nothing is cached), ``validators`` (the
+    ``etag``, ``last_modified`` and ``body_hash`` of the cached content),
+    ``waiting`` and ``refresh``.
+    Compressed pages are decompressed into ``data``, and pages in the blob
+    store are read into it, so that it looks the same no matter how the page
+    was stored. If the page is in the blob store, but the blob store is not
+    available, ``data`` will be ``None``.
     '''
     cur = dbclient.cursor()
-
-    sql = 'DELETE from domain_wait WHERE wait_until < now()'
-    cur.execute(sql)
+    sql = '''
+        WITH {},
+        existing AS (
+            SELECT uuid
+            FROM urls
+            WHERE url_hash = %(url_hash)s
+            AND url = %(url)s
+            LIMIT 1
+        ), inserted AS (
+            INSERT INTO urls (url, url_hash)
+            SELECT %(url)s, %(url_hash)s
+            WHERE NOT EXISTS (SELECT 1 FROM existing)
+            ON CONFLICT DO NOTHING
+            RETURNING uuid
+        ), url_row AS (
+            SELECT uuid, TRUE AS existed FROM existing
+            UNION ALL
+            SELECT uuid, FALSE AS existed FROM inserted
+        ), referer AS (
+            INSERT INTO referers (url_uuid, referer_uuid)
+            SELECT url_row.uuid, %(parent)s::uuid
+            FROM url_row
+            WHERE %(parent)s::uuid IS NOT NULL
+            AND NOT EXISTS (
+                SELECT 1
+                FROM referers
+                WHERE referers.url_uuid = url_row.uuid
+                AND referers.referer_uuid = %(parent)s::uuid
+            )
+            ON CONFLICT DO NOTHING
+        )
+        SELECT url_row.uuid, url_row.existed, cached.uuid, waiting.count,
+               cached.data, cached.body, cached.encoding, cached.status, cached.digest,
+               cached.etag, cached.last_modified, cached.body_hash,
+               EXISTS (
+                   SELECT 1
+                   FROM dl_queue
+                   WHERE dl_queue.url_hash = %(url_hash)s
+                   AND dl_queue.url = %(url)s
+                   AND jsonb_typeof(dl_queue.refresh_interval) = 'object'
+               )
+        FROM waiting
+        LEFT JOIN url_row ON TRUE
+        LEFT JOIN LATERAL (
+            SELECT data, body, encoding, status, digest, etag, last_modified, body_hash, uuid
+            FROM content
+            WHERE content.url_uuid = url_row.uuid
+            ORDER BY retrieved
+            LIMIT 1
+        ) cached ON TRUE
+    '''
+    params = _url_params(opts, url, parent=parent)
+    cur.execute(sql.format(', '.join(_wait_ctes(opts, 'now()'))), params)
+    row = cur.fetchone()
+    if row[0] is None:
+        # Another worker or agent added the URL at the same moment, and the
+        # INSERT gave way to it once it was committed. Look the URL up again,
+        # without applying the waits a second time.
+        waiting = row[3]
+        cur.execute(sql.format(_NOT_WAITING_CTE), params)
+        row = cur.fetchone()
+        row = row[:3] + (waiting,) + row[4:]
     dbclient.commit()
-
-    urlcomps = urllib.parse.urlparse(url)
-    domain = urlcomps[1]
-
-    sql = 'SELECT count(*) FROM domain_wait WHERE domain ~ %s'
-    cur.execute(sql, [domain])
-    try:
-        wait = cur.fetchone()[0]
-        if int(wait) > 0:
-            return False
-    except TypeError:
-        # No matches
-        return True
+    if row[1] is False:
+        flayer.seen.add(opts, url)
+    return {
+        'url_uuid': row[0],
+        'exists': row[1],
+        'data': _cached_data(opts, *row[4:9]),
+        'content_uuid': row[2],
+        'validators': {
+            'etag': row[9],
+            'last_modified': row[10],
+            'body_hash': row[11],
+        },
+        'waiting': int(row[3]) > 0,
+        'refresh': row[12],
+    }
+
+
+def _cached_data(opts, data, body, encoding, status, digest):
+    '''
+    Return the cached content for a URL, from wherever it was stored
+    '''
+    if digest is not None:
+        return flayer.blobs.unpack(opts, digest, status)
+    return flayer.compress.unpack(data, body, encoding, status)
 
 
-def set_domain_wait(dbclient, opts, url):
+def finish_url(dbclient, opts, url, url_uuid=None, columns=None, content_uuid=None):
     '''
-    This function should be run before any download, such as ``get_url()`` and
-    ``status()``. Running before will help prevent other agents from hitting
-    the domain again at the same time, or too quickly afterwards.
+    Do all of the database bookkeeping that is needed after downloading a
+    URL, in a single round trip:
+
+    * Store ``columns`` (such as those returned by ``flayer.compress.pack()``)
+      in the ``content`` table, either as a new row, or by updating
+      ``content_uuid`` if it is passed in. Any columns which are not passed in
+      are set to ``NULL``.
+    * Apply ``pattern_wait`` and extend the ``domain_wait`` for the domain
+      (unless ``local_domain_wait`` is set)
     '''
     cur = dbclient.cursor()
+    params = _url_params(opts, url, url_uuid=url_uuid, content_uuid=content_uuid)
+    params.update(dict.fromkeys(CONTENT_COLUMNS))
+    params.update(columns or {})
+    ctes = _wait_ctes(opts, "'infinity'")
+    if columns is not None and content_uuid is None:
+        ctes.append('''
+            stored AS (
+                INSERT INTO content (
+                    url_uuid, data, body, encoding, status, headers, digest, size,
+                    etag, last_modified, body_hash
+                ) VALUES (
+                    %(url_uuid)s, %(data)s, %(body)s, %(encoding)s, %(status)s,
+                    %(headers)s, %(digest)s, %(size)s,
+                    %(etag)s, %(last_modified)s, %(body_hash)s
+                )
+            )
+        ''')
+    elif columns is not None:
+        ctes.append('''
+            stored AS (
+                UPDATE content
+                SET url_uuid = %(url_uuid)s, data = %(data)s, body = %(body)s,
+                    encoding = %(encoding)s, status = %(status)s, headers = %(headers)s,
+                    digest = %(digest)s, size = %(size)s, etag = %(etag)s,
+                    last_modified = %(last_modified)s, body_hash = %(body_hash)s
+                WHERE uuid = %(content_uuid)s
+            )
+        ''')
+    cur.execute('WITH {} SELECT 1'.format(', '.join(ctes)), params)
+    dbclient.commit()
 
-    urlcomps = urllib.parse.urlparse(url)
-    domain = urlcomps[1]
 
-    sql = '''
-        INSERT INTO domain_wait (domain, wait_until)
-        values (%s, now() + '%s seconds')
-        ON CONFLICT DO NOTHING
+def _url_params(opts, url, **kwargs):
+    '''
+    Return the query parameters used by begin_url() and finish_url()
     '''
-    cur.execute(sql, [domain, opts['domain_wait']])
+    params = {
+        'url': url,
+        'url_hash': flayer.canon.url_hash(url),
+        'domain': urllib.parse.urlparse(url)[1],
+        'domain_wait': float(opts.get('domain_wait') or 0),
+        'parent': None,
+    }
+    params.update(kwargs)
+    return params
 
 
 def get_url_metadata(dbclient, opts):
@@ -260,15 +558,17 @@ def get_url_metadata(dbclient, opts):
     cur = dbclient.cursor()
 
     for url in opts['show_url_metadata']:
-        sql = 'SELECT uuid FROM urls WHERE url ~ %s'
-        cur.execute(sql, (url,))
+        url = flayer.canon.canonicalize(url)
+        params = (flayer.canon.url_hash(url), url)
+        sql = 'SELECT uuid FROM urls WHERE url_hash = %s AND url = %s'
+        cur.execute(sql, params)
 
         uuid = None
         if cur.rowcount > 0:
             uuid = cur.fetchone()[0]
 
-        sql = 'SELECT uuid, metadata FROM url_metadata WHERE url = %s'
-        cur.execute(sql, (url,))
+        sql = 'SELECT uuid, metadata FROM url_metadata WHERE url_hash = %s AND url = %s'
+        cur.execute(sql, params)
 
         uuidm, metadata = cur.fetchone()
         if uuid and uuid != uuidm:
@@ -288,8 +588,10 @@ def store_url_metadata(dbclient, opts, url, metadata):
     '''
     cur = dbclient.cursor()
 
-    sql = 'SELECT uuid FROM urls WHERE url ~ %s'
-    cur.execute(sql, (url,))
+    url = flayer.canon.canonicalize(url)
+    url_hash = flayer.canon.url_hash(url)
+    sql = 'SELECT uuid FROM urls WHERE url_hash = %s AND url = %s'
+    cur.execute(sql, (url_hash, url))
 
     uuid = None
     data = cur.fetchone()
@@ -297,10 +599,10 @@ def store_url_metadata(dbclient, opts, url, metadata):
         uuid = data[0]
 
     sql = '''
-        INSERT INTO url_metadata (uuid, url, metadata)
-        VALUES (%s, %s, %s)
+        INSERT INTO url_metadata (uuid, url, url_hash, metadata)
+        VALUES (%s, %s, %s, %s)
         ON CONFLICT (url) DO UPDATE
           SET metadata = %s
     '''
-    cur.execute(sql, (uuid, url, json.dumps(metadata), json.dumps(metadata)))
+    cur.execute(sql, (uuid, url, url_hash, json.dumps(metadata), json.dumps(metadata)))
     dbclient.commit()
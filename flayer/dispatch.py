@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+'''
+Parser dispatch for Web Flayer
+
+Parsers used to be found by calling the ``func_map()`` of every parser module
+for every URL, until one of them returned a function, and many ``func_map()``
+functions then looped over a list of domains of their own. Instead, a parser
+module may declare its routes up front, with a ``routes()`` function which
+returns a list of ``(kind, pattern, function)`` tuples:
+
+.. code-block:: python
+
+    def routes():
+        return [
+            ('host', 'example.com', parse_page),
+            ('regex', r'/recipes/\\d+', parse_recipe),
+        ]
+
+A ``host`` route matches a URL on that host, or on any subdomain of it: the
+host is compared, not searched for, so ``example.com`` matches
+``www.example.com``, but not ``notexample.com``, or a URL which only mentions
+``example.com`` in its path or query string (as ``'example.com' in url`` in a
+``func_map()`` used to). A ``regex`` route matches a URL which the pattern can
+be found in.
+
+When the parsers are loaded, the routes of every module are compiled into an
+index: a dict of hosts, and a single regular expression for all of the
+patterns. A URL is then looked up by its host (and each of the domains above
+it), and then matched against the one expression, however many routes there
+are. Routes are tried in that order (hosts, then patterns, each in the order
+that they were declared), and then the ``func_map()`` of any module without
+a ``routes()`` is called, as before.
+
+A pattern with backreferences (``\\1`` or ``(?P=name)``) or named groups of its
+own can't be combined with the others, since its groups would be numbered
+(or could be named) differently inside the combined expression, and nor can
+one which starts with global flags, such as ``(?i)``. Each of those is
+compiled by itself instead, and is tried between the patterns around it.
+
+The index is cached for as long as the parsers are loaded. If a module's
+routes depend on something which can change while it is running (such as a
+list of domains in ``__context__``), it should also declare a ``routes_key()``
+function, which returns a cheap summary of that state, such as its length.
+The index is built again whenever any ``routes_key()`` returns something
+different from when it was last built.
+'''
+# Python
+import re
+import weakref
+import urllib.parse
+
+_INDEXES = {}
+
+# Backreferences, named groups and global flags, which are not escaped
+_STANDALONE = re.compile(r'(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?P[<=]|\(\?[aiLmsux]+\))')
+
+
+def index(parsers):
+    '''
+    Return the dispatch index for a set of parsers, building it if necessary
+    '''
+    cached = _INDEXES.get(id(parsers))
+    if cached is not None and cached[0]() is parsers and cached[1].current():
+        return cached[1]
+    ret = Dispatch(parsers)
+    _INDEXES[id(parsers)] = (weakref.ref(parsers, _forget(id(parsers))), ret)
+    return ret
+
+
+def _forget(key):
+    '''
+    Return a callback which drops an index once its parsers are gone
+    '''
+    def callback(ref):  # pylint: disable=unused-argument
+        _INDEXES.pop(key, None)
+    return callback
+
+
+class Dispatch(object):
+    '''
+    An index of the routes declared by a set of parsers
+    '''
+    def __init__(self, parsers):
+        '''
+        Build the index
+        '''
+        self.hosts = {}
+        self.functions = []
+        self.func_maps = []
+        self.pre_flight = []
+        self.route_keys = []
+        # (compiled pattern, index of its function), where combined patterns
+        # have an index of None, and are looked up by their group instead
+        self.patterns = []
+        combined = []
+
+        keys = list(parsers)
+        modules = [key[:-len('.routes')] for key in keys if key.endswith('.routes')]
+        for key in keys:
+            if key.endswith('.pre_flight'):
+                self.pre_flight.append(parsers[key])
+            elif key.endswith('.func_map') and key[:-len('.func_map')] not in modules:
+                self.func_maps.append(parsers[key])
+            elif key.endswith('.routes_key') and key[:-len('.routes_key')] in modules:
+                self.route_keys.append(parsers[key])
+
+        for module in modules:
+            for kind, pattern, function in parsers['{}.routes'.format(module)]():
+                if kind == 'host':
+                    self.hosts.setdefault(pattern.lower().strip('.'), function)
+                elif kind == 'regex':
+                    if _STANDALONE.search(pattern):
+                        self._combine(combined)
+                        combined = []
+                        self.patterns.append((re.compile(pattern), len(self.functions)))
+                    else:
+                        # Each pattern is tried from the start of the URL, so
+                        # that the first one declared wins, not the first to
+                        # match
+                        combined.append(
+                            '(?P<r{}>.*?(?:{}))'.format(len(self.functions), pattern)
+                        )
+                    self.functions.append(function)
+                else:
+                    raise ValueError(
+                        'Unknown route type {} in {}'.format(kind, module)
+                    )
+        self._combine(combined)
+        # Only read once the routes have been declared, since declaring them
+        # may have filled in the state that they depend on
+        self.state = self._state()
+
+    def _state(self):
+        '''
+        Return what the ``routes_key()`` functions say the routes depend on
+        '''
+        return tuple(route_key() for route_key in self.route_keys)
+
+    def current(self):
+        '''
+        Whether the routes are still the ones that the index was built from
+        '''
+        return not self.route_keys or self._state() == self.state
+
+    def _combine(self, patterns):
+        '''
+        Compile a run of patterns into a single expression
+        '''
+        if patterns:
+            self.patterns.append((re.compile('|'.join(patterns)), None))
+
+    def route(self, url):
+        '''
+        Return the function which should parse a URL, or ``None``
+        '''
+        if self.hosts:
+            host = (urllib.parse.urlsplit(url).hostname or '').rstrip('.')
+            while host:
+                if host in self.hosts:
+                    return self.hosts[host]
+                host = host.partition('.')[2]
+        for regex, num in self.patterns:
+            if num is not None:
+                if regex.search(url) is not None:
+                    return self.functions[num]
+                continue
+            match = regex.match(url)
+            if match is not None:
+                return self.functions[int(match.lastgroup[1:])]
+        for func_map in self.func_maps:
+            function = func_map(url)
+            if function is not None:
+                return function
+        return None
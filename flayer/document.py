@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+'''
+Parse-once pages for Web Flayer
+
+A page used to be parsed again by each stage that looked at it: once to find
+its links, once by the parser plugin, and once more by an organizer. A
+``Document`` is handed to each of those stages instead, and builds each of the
+expensive views of the page (its soup, its links and its JSON-LD) the first
+time that it is asked for it, and then keeps it.
+
+``Document`` is a ``str``, holding the text of the page, so any plugin which
+expects ``content`` to be a string can be passed one without noticing. Plugins
+which know about it can use its views instead of parsing the page themselves:
+
+.. code-block:: python
+
+    def parse_page(url_uuid, url, document):
+        for recipe in document.jsonld.of_type('Recipe'):
+            ...
+'''
+# Internal
+import flayer.tools
+import flayer.jsonld
+
+
+class Document(str):
+    '''
+    A page, along with views of it which are built when they are first used
+    '''
+    def __new__(cls, content, url=None, opts=None, raw=None):
+        '''
+        Create a document from the text of a page. If the bytes that the text
+        was decoded from are at hand, they may be passed in as ``raw``.
+        '''
+        if isinstance(content, bytes):
+            raw = content
+            content = content.decode('utf-8', 'replace')
+        self = super(Document, cls).__new__(cls, content or '')
+        self.url = url
+        self.opts = opts or {}
+        self._raw = raw
+        self._soup = None
+        self._links = {}
+        self._jsonld = None
+        return self
+
+    @classmethod
+    def wrap(cls, content, url=None, opts=None):
+        '''
+        Return ``content`` as a document, unless it already is one
+        '''
+        if isinstance(content, cls):
+            return content
+        return cls(content, url, opts)
+
+    def __reduce__(self):
+        '''
+        Only the page is pickled, not the views of it (or ``opts``, which may
+        hold things that can't be pickled)
+        '''
+        return (Document, (str(self), self.url, None, self._raw))
+
+    @property
+    def text(self):
+        '''
+        The text of the page, as a plain ``str``
+        '''
+        return str(self)
+
+    @property
+    def raw(self):
+        '''
+        The page as bytes
+        '''
+        if self._raw is None:
+            self._raw = self.encode('utf-8')
+        return self._raw
+
+    @property
+    def soup(self):
+        '''
+        The page, parsed by BeautifulSoup
+        '''
+        if self._soup is None:
+            from bs4 import BeautifulSoup
+            self._soup = BeautifulSoup(self.text, 'html.parser')
+        return self._soup
+
+    def links(self, level=0):
+        '''
+        The links on the page, as returned by ``flayer.tools.parse_links()``
+        '''
+        if level not in self._links:
+            self._links[level] = flayer.tools.parse_links(self.url, self, level, self.opts)
+        return self._links[level]
+
+    @property
+    def jsonld(self):
+        '''
+        The JSON-LD on the page, as a ``flayer.jsonld.JsonLD``: a list of the
+        decoded ``application/ld+json`` blocks, which also has the entities in
+        them, indexed by type. The page is scanned for the blocks, rather than
+        parsed.
+        '''
+        if self._jsonld is None:
+            self._jsonld = flayer.jsonld.extract(self)
+        return self._jsonld
+
+    @property
+    def jsonld_errors(self):
+        '''
+        The errors from any JSON-LD blocks which could not be decoded
+        '''
+        return self.jsonld.errors
@@ -2,16 +2,17 @@
 '''
 Handle Salt event bus
 '''
-# 3rd party
-import salt.config
-import salt.utils.event
+# Internal
+import flayer.loader
 
 
 def bus(opts):
     '''
     Connect to Salt's event bus
     '''
-    salt_opts = salt.config.minion_config('/etc/salt/{}'.format(opts['salt_node']))
+    import salt.utils.event
+
+    salt_opts = flayer.loader.salt_config('/etc/salt/{}'.format(opts['salt_node']))
 
     event = salt.utils.event.get_event(
         opts['salt_node'],
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+'''
+In-memory URL frontier for Web Flayer
+
+The frontier holds the URLs that this agent is about to process. URLs are
+kept in a separate queue for each host, and are handed out in ``dl_order``
+order, then by the time they were added. A host that has just been hit (or
+is still being hit by another worker) is set aside until its
+``flayer.scheduler.HostScheduler`` says it is ready again, so URLs from other
+hosts can be processed in the meantime without having to download and requeue
+anything.
+
+The frontier can be used in place of the old ``urls`` list, which plugins
+still see as ``__urls__``: ``append()``, ``extend()``, ``pop()``, ``len()``
+and ``in`` all work as expected.
+'''
+# Python
+import time
+import heapq
+import urllib.parse
+import datetime
+import itertools
+import threading
+
+# Internal
+import flayer.scheduler
+
+DEFAULT_ORDER = 1000000
+
+
+def host(url):
+    '''
+    Return the host part of a URL
+    '''
+    return urllib.parse.urlparse(url)[1]
+
+
+class Frontier(object):
+    '''
+    Priority queue of URLs, with a sub-queue for each host
+    '''
+    def __init__(self, wait=0, scheduler=None):
+        '''
+        Initialize. ``wait`` is the number of seconds to leave between URLs
+        from the same host, unless a ``scheduler`` is passed in.
+        '''
+        if scheduler is None:
+            scheduler = flayer.scheduler.HostScheduler(wait)
+        self.scheduler = scheduler
+        self.wait = scheduler.wait
+        self._lock = threading.RLock()
+        self._seq = itertools.count()
+        # host -> heap of (order, added, seq, url)
+        self._hosts = {}
+        # heap of (order, added, seq, host), one live entry per ready host
+        self._ready = []
+        # heap of (until, host)
+        self._sleeping = []
+        # host -> time that a sleeping host is waiting for
+        self._next = {}
+        # hosts with a URL currently being processed
+        self._active = set()
+        self._pending = set()
+        # url -> the dl_queue row it was claimed from, until it is popped
+        self._claims = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, url):
+        return url in self._pending
+
+    def __iter__(self):
+        with self._lock:
+            entries = []
+            for queue in self._hosts.values():
+                entries.extend(queue)
+        return iter([entry[3] for entry in sorted(entries)])
+
+    def push(self, url, order=DEFAULT_ORDER, added=None, claim=None):
+        '''
+        Add a URL to the frontier. URLs which are already waiting in the
+        frontier are ignored.
+
+        If the URL was claimed from the download queue, ``claim`` is the row
+        it came from, which is kept until the URL is popped, so that it can
+        be put back (see ``claims()``).
+        '''
+        if isinstance(added, datetime.datetime):
+            added = added.timestamp()
+        elif added is None:
+            added = time.time()
+        with self._lock:
+            if claim is not None:
+                self._claims.setdefault(url, claim)
+            if url in self._pending:
+                return False
+            self._pending.add(url)
+            name = host(url)
+            queue = self._hosts.setdefault(name, [])
+            entry = (order, added, next(self._seq), url)
+            heapq.heappush(queue, entry)
+            if name in self._active:
+                return True
+            if queue[0] is entry:
+                # Either this host was idle, or this URL jumps the queue
+                self._schedule(name)
+            return True
+
+    def append(self, url):
+        '''
+        Add a URL with the default order
+        '''
+        self.push(url)
+
+    def extend(self, urls):
+        '''
+        Add several URLs with the default order
+        '''
+        for url in urls:
+            self.push(url)
+
+    def pop(self, index=0):  # pylint: disable=unused-argument
+        '''
+        Return the next URL whose host is ready to be hit. The host is marked
+        as active until ``release()`` is called for the URL.
+
+        Raises ``IndexError`` if the frontier is empty, and returns ``None``
+        if there are URLs, but none of their hosts are ready yet.
+        '''
+        with self._lock:
+            if not self._pending:
+                raise IndexError('pop from empty frontier')
+            self._wake()
+            while self._ready:
+                order, added, seq, name = heapq.heappop(self._ready)
+                queue = self._hosts.get(name)
+                if not queue or name in self._active:
+                    continue
+                if queue[0][:3] != (order, added, seq):
+                    # Stale entry; the host has been rescheduled since
+                    continue
+                if self.scheduler.ready_at(name) > time.time():
+                    # Another agent has started waiting on this host
+                    self._schedule(name)
+                    continue
+                self.scheduler.hit(name)
+                url = heapq.heappop(queue)[3]
+                if not queue:
+                    del self._hosts[name]
+                self._pending.discard(url)
+                self._claims.pop(url, None)
+                self._active.add(name)
+                return url
+            return None
+
+    def release(self, url, wait=None):
+        '''
+        Mark a URL as finished, so its host may be hit again once the
+        scheduler allows it, or once ``wait`` seconds have passed
+        '''
+        name = host(url)
+        with self._lock:
+            self._active.discard(name)
+            if name in self._hosts:
+                until = 0
+                if wait is not None:
+                    until = time.time() + wait
+                self._schedule(name, until)
+
+    def defer(self, url, wait):
+        '''
+        Put a URL back, and leave its host alone for ``wait`` seconds
+        '''
+        self.push(url)
+        self.release(url, wait)
+
+    def claims(self):
+        '''
+        Return the download queue rows of the URLs which were claimed, but
+        have not been popped yet
+        '''
+        with self._lock:
+            return [
+                claim for url, claim in self._claims.items() if url in self._pending
+            ]
+
+    def busy(self):
+        '''
+        Whether any URLs are still being processed
+        '''
+        return bool(self._active)
+
+    def wait_time(self):
+        '''
+        Return the number of seconds until the next sleeping host is ready
+        '''
+        with self._lock:
+            if not self._sleeping:
+                return 0
+            return max(self._sleeping[0][0] - time.time(), 0)
+
+    def _schedule(self, name, until=0):
+        '''
+        Put a host on the ready heap, or the sleeping heap if it is still
+        inside its wait
+        '''
+        until = max(until, self._next.get(name, 0), self.scheduler.ready_at(name))
+        if until > time.time():
+            self._next[name] = until
+            heapq.heappush(self._sleeping, (until, name))
+            return
+        self._next.pop(name, None)
+        order, added, seq, _ = self._hosts[name][0]
+        heapq.heappush(self._ready, (order, added, seq, name))
+
+    def _wake(self):
+        '''
+        Move any hosts whose wait is over onto the ready heap
+        '''
+        now = time.time()
+        while self._sleeping and self._sleeping[0][0] <= now:
+            until, name = heapq.heappop(self._sleeping)
+            if self._next.get(name, 0) != until:
+                # Stale entry
+                continue
+            del self._next[name]
+            if name in self._hosts and name not in self._active:
+                self._schedule(name)
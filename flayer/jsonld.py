@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+'''
+JSON-LD extraction for Web Flayer
+
+Reading the ``application/ld+json`` blocks out of a page used to mean building
+a complete BeautifulSoup tree for it, only to find a few ``script`` tags, and
+the plugins which read them only looked at the ``@type`` of each block. Pages
+which put their entities in an ``@graph``, or in a list, or which give an
+entity more than one type, were missed.
+
+The blocks are found by scanning the page for the ``script`` tags with a
+regular expression instead, without parsing the rest of it, and are decoded
+with ``orjson`` if it is installed (``json`` is used if it isn't, or if
+``orjson`` can't decode a block). The entities in them are then flattened
+into a single list, and indexed by type:
+
+.. code-block:: python
+
+    data = flayer.jsonld.extract(content)
+    for recipe in data.of_type('Recipe'):
+        ...
+
+A document's ``jsonld`` (see ``flayer.document``) is the same thing, for the
+page that it holds.
+'''
+# Python
+import re
+import json
+
+# 3rd party
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# Every script is matched, so that a tag inside another script (in a string,
+# say) isn't mistaken for one
+_SCRIPT = re.compile(r'<script\b([^>]*)>(.*?)</script\s*>', re.IGNORECASE | re.DOTALL)
+
+# The type attribute may be in any case, quoted or not, and may have
+# parameters (such as a charset) after it
+_TYPE = re.compile(r'''\btype\s*=\s*["']?\s*application/ld\+json\b''', re.IGNORECASE)
+
+# Most pages have no JSON-LD at all, and can be skipped without looking for
+# their scripts
+_HINT = re.compile(r'ld\+json', re.IGNORECASE)
+
+# Some pages still wrap their scripts in comments or CDATA sections
+_WRAPPER = re.compile(
+    r'^\s*(?:<!--|(?://\s*)?<!\[CDATA\[)|(?:-->|(?://\s*)?\]\]>)\s*$'
+)
+
+_SCHEMA = re.compile(r'^(?:https?://schema\.org/|schema:)', re.IGNORECASE)
+
+
+def scan(content):
+    '''
+    Return the text of each ``application/ld+json`` block on a page
+    '''
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', 'replace')
+    if not isinstance(content, str) or _HINT.search(content) is None:
+        return []
+    return [
+        match.group(2) for match in _SCRIPT.finditer(content)
+        if _TYPE.search(match.group(1))
+    ]
+
+
+def loads(text):
+    '''
+    Decode a JSON-LD block
+    '''
+    text = _WRAPPER.sub('', text.strip())
+    if HAS_ORJSON:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # json is more forgiving, of control characters and NaN
+            pass
+    return json.loads(text, strict=False)
+
+
+def types(entity):
+    '''
+    Return the types of an entity, without any ``schema.org`` prefix
+    '''
+    if not isinstance(entity, dict):
+        return []
+    ret = entity.get('@type')
+    if ret is None:
+        return []
+    if not isinstance(ret, list):
+        ret = [ret]
+    return [_SCHEMA.sub('', item) for item in ret if isinstance(item, str)]
+
+
+def flatten(data):
+    '''
+    Return the entities in a decoded block, in the order that they appear.
+    Lists are flattened, and so is the ``@graph`` of an entity (which is
+    itself only kept if it has a type of its own).
+    '''
+    ret = []
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, list):
+            stack.extend(reversed(item))
+        elif isinstance(item, dict):
+            graph = item.get('@graph')
+            if graph is not None and '@type' not in item:
+                stack.append(graph)
+                continue
+            ret.append(item)
+            if graph is not None:
+                stack.append(graph)
+    return ret
+
+
+def extract(content):
+    '''
+    Return the JSON-LD on a page
+    '''
+    return JsonLD(scan(content))
+
+
+class JsonLD(list):
+    '''
+    The decoded JSON-LD blocks on a page. Blocks which could not be decoded
+    are left out, and their errors are kept in ``errors``.
+
+    Every entity in the blocks is in ``entities``, and ``index`` maps each
+    type (in lower case) to the entities of that type.
+    '''
+    def __init__(self, blocks=()):
+        '''
+        Decode the blocks, and index their entities
+        '''
+        super(JsonLD, self).__init__()
+        self.errors = []
+        self.entities = []
+        self.index = {}
+        for text in blocks:
+            if not text:
+                continue
+            try:
+                data = loads(text)
+            except ValueError as exc:
+                self.errors.append(exc)
+                continue
+            self.append(data)
+            for entity in flatten(data):
+                self.entities.append(entity)
+                for name in types(entity):
+                    self.index.setdefault(name.lower(), []).append(entity)
+
+    def of_type(self, *names):
+        '''
+        Return the entities of any of the given types, in the order that they
+        appear on the page
+        '''
+        if len(names) == 1:
+            return list(self.index.get(names[0].lower(), []))
+        wanted = set(name.lower() for name in names)
+        return [
+            entity for entity in self.entities
+            if any(name.lower() in wanted for name in types(entity))
+        ]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+'''
+Fast link extraction for Web Flayer
+
+``flayer.tools.parse_links()`` has always built a complete BeautifulSoup tree
+for every page, only to read the ``href`` (and ``src``) attributes out of it,
+and then resolved every link before deciding whether it was wanted. That is
+still available, with ``link_extractor`` set to ``soup``, and is the reference
+that this module is checked against (see ``bench/links.py``).
+
+The ``fast`` extractor in this module runs the page through
+``html.parser.HTMLParser`` instead, which is the tokenizer underneath
+BeautifulSoup's ``html.parser`` builder, and only keeps the attributes of the
+tags that it needs, without building a tree. The ``level`` checks apply to the
+whole page, so they are made before it is parsed at all, and the
+``span_hosts`` check is made before a link is resolved: relative links are
+always on the same host, so only links with a scheme or a host of their own
+need to be looked at any closer.
+'''
+# Python
+import re
+import urllib.parse
+import html.parser
+
+# Internal
+import flayer.canon
+
+# Links with a scheme or a host of their own, which can't be assumed to be on
+# the same host as the page. Leading whitespace and control characters are
+# ignored by urllib too.
+_ABSOLUTE = re.compile(r'^[\x00-\x20]*([a-zA-Z][a-zA-Z0-9+.-]*:|//)')
+
+
+class LinkParser(html.parser.HTMLParser):
+    '''
+    Collect the links from a page, as ``[href, src, text]`` lists. Links from
+    ``a`` tags are kept in ``anchors``, and (if ``search_src`` is set) links
+    from tags with a ``src`` attribute in ``sources``, which is the order that
+    BeautifulSoup would return them in.
+    '''
+    def __init__(self, search_src=False):
+        '''
+        Initialize
+        '''
+        super(LinkParser, self).__init__(convert_charrefs=True)
+        self.search_src = search_src
+        self.anchors = []
+        self.sources = []
+        self._open = []
+
+    def handle_starttag(self, tag, attrs):
+        '''
+        Keep the link from an ``a`` tag, or any tag with a ``src``
+        '''
+        if tag == 'a':
+            attrs = dict(attrs)
+            link = [attrs.get('href'), attrs.get('src'), []]
+            self.anchors.append(link)
+            self._open.append(link)
+            if self.search_src and 'src' in attrs:
+                self.sources.append(link)
+        elif self.search_src:
+            for name, _ in attrs:
+                if name == 'src':
+                    attrs = dict(attrs)
+                    self.sources.append([attrs.get('href'), attrs.get('src'), []])
+                    break
+
+    def handle_endtag(self, tag):
+        '''
+        Stop collecting the text of an ``a`` tag
+        '''
+        if tag == 'a' and self._open:
+            self._open.pop()
+
+    def handle_data(self, data):
+        '''
+        Collect the text of any ``a`` tags that are open
+        '''
+        for link in self._open:
+            link[2].append(data)
+
+
+def extract(url, content, level, opts):
+    '''
+    Return the links from an HTML page, the same way that the ``soup``
+    extractor in ``flayer.tools.parse_links()`` would
+    '''
+    if level > int(opts['level']):
+        return []
+    if int(opts.get('level', 0)) > 0 and int(opts.get('level', 0)) < 2:
+        return []
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', 'replace')
+    if not isinstance(content, str):
+        # This URL probably isn't HTML
+        return []
+
+    search_src = opts['search_src'] is True
+    parser = LinkParser(search_src)
+    parser.feed(content)
+    parser.close()
+
+    host = urllib.parse.urlsplit(url)[1].split(':')[0]
+    span_hosts = opts['span_hosts'] is True
+
+    hrefs = []
+    for href, src, text in parser.anchors + parser.sources:
+        if search_src and not href:
+            href = src
+        if text and ''.join(text).startswith('javascript'):
+            continue
+        if span_hosts or not href or not _ABSOLUTE.match(href):
+            # Relative links are always on the same host as the page
+            hrefs.append(flayer.canon.canonicalize(urllib.parse.urljoin(url, href)))
+            continue
+        href = urllib.parse.urljoin(url, href)
+        if not urllib.parse.urlsplit(href)[1].startswith(host):
+            continue
+        hrefs.append(flayer.canon.canonicalize(href))
+    return hrefs
@@ -1,45 +1,105 @@
 # -*- coding: utf-8 -*-
 '''
 Basic functions for Web Flayer
+
+Plugins are loaded with Salt's ``LazyLoader`` if Salt is installed, or with
+the built-in ``PluginLoader`` if it isn't (or if ``plugin_loader`` is set to
+``builtin``). Either way, the Salt configuration files are only read once per
+process, and plugin source files are only compiled once per process (unless
+they change), so that loading the plugins is cheap enough to do for every
+worker.
 '''
-# 3rd party
-from salt.loader import LazyLoader
-import salt.config
+# Python
+import os
+import glob
+import types
+import inspect
+import importlib.util
+
+# Internal
+import flayer.session
+import flayer.dispatch
+
+# Salt takes a long time to import, so it is only imported once it is used
+HAS_SALT = importlib.util.find_spec('salt') is not None
+
+_CONFIGS = {}
+_CODE = {}
+
+
+def salt_config(path, kind='minion'):
+    '''
+    Return a Salt ``master`` or ``minion`` config, reading it only the first
+    time it is asked for
+    '''
+    key = (kind, path)
+    if key not in _CONFIGS:
+        import salt.config
+        if kind == 'master':
+            _CONFIGS[key] = salt.config.master_config(path)
+        else:
+            _CONFIGS[key] = salt.config.minion_config(path)
+    return _CONFIGS[key]
+
+
+def _use_salt(opts):
+    '''
+    Whether plugins should be loaded with Salt's loader
+    '''
+    loader = opts.get('plugin_loader') or 'auto'
+    if loader == 'salt' and not HAS_SALT:
+        raise RuntimeError('plugin_loader is set to salt, but Salt is not installed')
+    if loader == 'auto':
+        return HAS_SALT
+    return loader == 'salt'
+
+
+def _load(opts, dirs, kind, pack):
+    '''
+    Load the plugins of one kind
+    '''
+    if _use_salt(opts):
+        from salt.loader import LazyLoader
+        return LazyLoader(
+            dirs,
+            salt_config('/etc/salt/minion'),
+            tag=u'flayer/{}'.format(kind),
+            pack=pack,
+        )
+    return PluginLoader(dirs, kind, pack)
 
 
 def parser(opts, context, urls, dbclient):
     '''
-    Load spider modules
-    '''
-    master_opts = salt.config.master_config('/etc/salt/master')
-    minion_opts = salt.config.minion_config('/etc/salt/minion')
-    return LazyLoader(
-        opts['parser_dir'],
-        minion_opts,
-        tag=u'flayer/parser',
-        pack={
-            u'__master_opts__': master_opts,
-            u'__minion_opts__': minion_opts,
-            u'__opts__': opts,
-            u'__context__': context,
-            u'__urls__': urls,
-            u'__dbclient__': dbclient,
-        },
-    )
+    Load spider modules, and build the index of their routes
+    '''
+    pack = {
+        u'__opts__': opts,
+        u'__context__': context,
+        u'__urls__': urls,
+        u'__dbclient__': dbclient,
+        u'__session__': flayer.session.client(opts),
+    }
+    if HAS_SALT:
+        pack[u'__master_opts__'] = salt_config('/etc/salt/master', 'master')
+        pack[u'__minion_opts__'] = salt_config('/etc/salt/minion')
+    parsers = _load(opts, opts['parser_dir'], 'parser', pack)
+    flayer.dispatch.index(parsers)
+    return parsers
 
 
 def search(opts, dbclient):
     '''
     Load search modules
     '''
-    minion_opts = salt.config.minion_config('/etc/salt/minion')
-    return LazyLoader(
+    return _load(
+        opts,
         opts['search_dir'],
-        minion_opts,
-        tag=u'flayer/search',
-        pack={
+        'search',
+        {
             u'__opts__': opts,
             u'__dbclient__': dbclient,
+            u'__session__': flayer.session.client(opts),
         },
     )
 
@@ -48,32 +108,126 @@ def organize(opts, dbclient, context):
     '''
     Load organizer modules
     '''
-    minion_opts = salt.config.minion_config('/etc/salt/minion')
-    return LazyLoader(
+    return _load(
+        opts,
         opts['organize_dir'],
-        minion_opts,
-        tag=u'flayer/organize',
-        pack={
+        'organize',
+        {
             u'__opts__': opts,
             u'__dbclient__': dbclient,
+            u'__session__': flayer.session.client(opts),
             u'__context__': context,
         },
     )
 
 
-def filter(opts, context, urls, dbclient):
+def filter(opts, context, urls, dbclient):  # pylint: disable=redefined-builtin
     '''
     Load filterr modules
     '''
-    minion_opts = salt.config.minion_config('/etc/salt/minion')
-    return LazyLoader(
+    return _load(
+        opts,
         opts['filter_dir'],
-        minion_opts,
-        tag=u'flayer/filter',
-        pack={
+        'filter',
+        {
             u'__opts__': opts,
             u'__context__': context,
             u'__urls__': urls,
             u'__dbclient__': dbclient,
+            u'__session__': flayer.session.client(opts),
         },
     )
+
+
+def _compile(path):
+    '''
+    Compile a plugin, reusing the code from last time unless the file has
+    changed since
+    '''
+    mtime = os.stat(path).st_mtime_ns
+    cached = _CODE.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as fh_:
+            cached = (mtime, compile(fh_.read(), path, 'exec'))
+        _CODE[path] = cached
+    return cached[1]
+
+
+def _entry_points(group):
+    '''
+    Return the entry points in a group
+    '''
+    try:
+        import importlib.metadata as metadata
+    except ImportError:
+        return []
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return list(entry_points.select(group=group))
+    return list(entry_points.get(group, []))
+
+
+class PluginLoader(dict):
+    '''
+    A plugin loader which doesn't need Salt. Like Salt's loader, each public
+    function of each plugin is available as ``module.function``, and the
+    dunder variables in ``pack`` are available to the plugins as globals.
+
+    Plugins are loaded from ``.py`` files in ``dirs`` (earlier directories
+    win), and from any installed package which names a plugin module in the
+    ``flayer.<kind>`` entry point group:
+
+    .. code-block:: python
+
+        entry_points={'flayer.parser': ['recipes = mypackage.recipes']}
+
+    Each loader runs its own copy of every plugin, so that the globals of one
+    worker's plugins are never seen by another's. A plugin may define
+    ``__virtualname__``, or a ``__virtual__()`` function, which returns the
+    name to load it as, or ``False`` to not load it.
+    '''
+    def __init__(self, dirs, kind, pack):
+        '''
+        Load the plugins
+        '''
+        super(PluginLoader, self).__init__()
+        self.kind = kind
+        self.pack = pack
+        if isinstance(dirs, str):
+            dirs = [dirs]
+        for path in dirs:
+            for file_name in sorted(glob.glob(os.path.join(path, '*.py'))):
+                name = os.path.basename(file_name)[:-3]
+                if not name.startswith('_'):
+                    self._load(name, file_name)
+        for entry in _entry_points('flayer.{}'.format(kind)):
+            spec = importlib.util.find_spec(entry.value.split(':')[0])
+            if spec is not None and spec.origin:
+                self._load(entry.name, spec.origin)
+
+    def _load(self, name, path):
+        '''
+        Run a plugin, and add its functions
+        '''
+        module = types.ModuleType('flayer.plugins.{}.{}'.format(self.kind, name))
+        module.__file__ = path
+        module.__dict__.update(self.pack)
+        exec(_compile(path), module.__dict__)  # pylint: disable=exec-used
+
+        name = module.__dict__.get('__virtualname__', name)
+        if callable(module.__dict__.get('__virtual__')):
+            ret = module.__virtual__()
+            if isinstance(ret, tuple):
+                ret = ret[0]
+            if ret is False:
+                return
+            if isinstance(ret, str):
+                name = ret
+
+        for attr, value in module.__dict__.items():
+            if attr.startswith('_') or not inspect.isfunction(value):
+                continue
+            if value.__module__ != module.__name__:
+                # Imported from somewhere else
+                continue
+            self.setdefault('{}.{}'.format(name, attr), value)
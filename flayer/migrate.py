@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+'''
+Schema migrations for Web Flayer
+
+Migrations are applied in order by ``flay --migrate``, and the version of the
+schema is tracked in the ``schema_version`` table. Before a migration is
+applied, each of its checks is run. A check is a query which returns a count
+of rows that would stop the migration from succeeding (such as duplicate URLs
+where a unique index is about to be created). If any check returns a non-zero
+count, nothing is changed, and the problem is reported instead.
+
+Once the migrations have been applied, any pages which are still stored as
+JSON are compressed, if ``content_compression`` is set.
+
+Then each of the hot queries is run through
+``EXPLAIN`` to verify that it is able to use an index.
+'''
+# Python
+import json
+
+# 3rd party
+import psycopg2.extras
+
+# Internal
+import flayer.canon
+import flayer.tools
+import flayer.compress
+
+# Used by _canonicalize(): once the URLs which are not canonical have been
+# found, rows which turn out to be for the same URL are merged into one. The
+# row which already had the canonical URL is kept, if there is one, and the
+# first of the others if there isn't.
+_MERGE_SQL = [
+    '''
+    CREATE TEMPORARY TABLE url_moves ON COMMIT DROP AS
+    SELECT c.uuid AS old_uuid,
+           coalesce(u.uuid, first_value(c.uuid) OVER (PARTITION BY c.url ORDER BY c.uuid))
+               AS new_uuid,
+           c.url
+    FROM canon_urls c
+    LEFT JOIN urls u ON u.url = c.url
+    ''',
+    '''
+    UPDATE content SET url_uuid = m.new_uuid
+    FROM url_moves m
+    WHERE content.url_uuid = m.old_uuid AND m.old_uuid <> m.new_uuid
+    ''',
+    '''
+    UPDATE active_dl SET url_uuid = m.new_uuid
+    FROM url_moves m
+    WHERE active_dl.url_uuid = m.old_uuid AND m.old_uuid <> m.new_uuid
+    ''',
+    '''
+    UPDATE url_metadata SET uuid = m.new_uuid
+    FROM url_moves m
+    WHERE url_metadata.uuid = m.old_uuid AND m.old_uuid <> m.new_uuid
+    ''',
+    '''
+    INSERT INTO referers (url_uuid, referer_uuid, last_referred)
+    SELECT coalesce(a.new_uuid, r.url_uuid), coalesce(b.new_uuid, r.referer_uuid),
+           r.last_referred
+    FROM referers r
+    LEFT JOIN url_moves a ON a.old_uuid = r.url_uuid AND a.old_uuid <> a.new_uuid
+    LEFT JOIN url_moves b ON b.old_uuid = r.referer_uuid AND b.old_uuid <> b.new_uuid
+    WHERE a.old_uuid IS NOT NULL OR b.old_uuid IS NOT NULL
+    ON CONFLICT DO NOTHING
+    ''',
+    '''
+    DELETE FROM referers r
+    USING url_moves m
+    WHERE m.old_uuid <> m.new_uuid
+    AND (r.url_uuid = m.old_uuid OR r.referer_uuid = m.old_uuid)
+    ''',
+    '''
+    DELETE FROM urls
+    USING url_moves m
+    WHERE urls.uuid = m.old_uuid AND m.old_uuid <> m.new_uuid
+    ''',
+    '''
+    UPDATE urls SET url = m.url
+    FROM url_moves m
+    WHERE urls.uuid = m.old_uuid AND m.old_uuid = m.new_uuid
+    ''',
+    '''
+    DELETE FROM dl_queue
+    USING (
+        SELECT c.uuid,
+               d.uuid IS NOT NULL OR c.uuid <> first_value(c.uuid)
+                   OVER (PARTITION BY c.url ORDER BY c.uuid) AS duplicate
+        FROM canon_dl_queue c
+        LEFT JOIN dl_queue d ON d.url = c.url
+    ) c
+    WHERE dl_queue.uuid = c.uuid AND c.duplicate
+    ''',
+    '''
+    UPDATE dl_queue SET url = c.url
+    FROM canon_dl_queue c
+    WHERE dl_queue.uuid = c.uuid
+    ''',
+    '''
+    DELETE FROM url_metadata
+    USING (
+        SELECT c.old_url,
+               m.url IS NOT NULL OR c.old_url <> first_value(c.old_url)
+                   OVER (PARTITION BY c.url ORDER BY c.old_url) AS duplicate
+        FROM canon_url_metadata c
+        LEFT JOIN url_metadata m ON m.url = c.url
+    ) c
+    WHERE url_metadata.url = c.old_url AND c.duplicate
+    ''',
+    '''
+    UPDATE url_metadata SET url = c.url
+    FROM canon_url_metadata c
+    WHERE url_metadata.url = c.old_url
+    ''',
+]
+
+
+def _canonicalize(dbclient, batch_size=10000):
+    '''
+    Canonicalize the URLs in the ``urls``, ``dl_queue`` and ``url_metadata``
+    tables. The tables are read with server-side cursors, and only the URLs
+    which change are kept, in temporary tables, before they are written back.
+    '''
+    cur = dbclient.cursor()
+    for table, key in (('urls', 'uuid'), ('dl_queue', 'uuid'), ('url_metadata', 'url')):
+        cur.execute(
+            'CREATE TEMPORARY TABLE canon_{0} ({1} {2}, url text) ON COMMIT DROP'.format(
+                table,
+                'uuid' if key == 'uuid' else 'old_url',
+                'uuid' if key == 'uuid' else 'text',
+            )
+        )
+        reader = dbclient.cursor(name='flayer_canonicalize')
+        reader.itersize = batch_size
+        reader.execute('SELECT {}, url FROM {} WHERE url IS NOT NULL'.format(key, table))
+        while True:
+            rows = reader.fetchmany(batch_size)
+            if not rows:
+                break
+            changed = []
+            for row_key, url in rows:
+                canonical = flayer.canon.canonicalize(url)
+                if canonical != url:
+                    changed.append((row_key, canonical))
+            if changed:
+                psycopg2.extras.execute_values(
+                    cur, 'INSERT INTO canon_{} VALUES %s'.format(table), changed
+                )
+        reader.close()
+    for sql in _MERGE_SQL:
+        cur.execute(sql)
+
+
+MIGRATIONS = [
+    {
+        'version': 1,
+        'description': 'Add indexes for hot queries',
+        'checks': [
+            (
+                '''
+                SELECT count(*) FROM (
+                    SELECT url FROM urls GROUP BY url HAVING count(*) > 1
+                ) dupes
+                ''',
+                'URLs are stored more than once in the urls table',
+            ),
+            (
+                'SELECT count(*) FROM urls WHERE octet_length(url) > 2000',
+                'URLs in the urls table are too long to be indexed',
+            ),
+            (
+                '''
+                SELECT count(*) FROM (
+                    SELECT url FROM dl_queue GROUP BY url HAVING count(*) > 1
+                ) dupes
+                ''',
+                'URLs are queued more than once in the dl_queue table',
+            ),
+            (
+                'SELECT count(*) FROM dl_queue WHERE octet_length(url) > 2000',
+                'URLs in the dl_queue table are too long to be indexed',
+            ),
+        ],
+        'sql': [
+            # Duplicate referers carry no information, so they are safe to drop
+            '''
+            DELETE FROM referers a
+            USING referers b
+            WHERE a.ctid < b.ctid
+            AND a.url_uuid = b.url_uuid
+            AND a.referer_uuid = b.referer_uuid
+            ''',
+            'ALTER TABLE active_dl ADD COLUMN IF NOT EXISTS url_uuid uuid',
+            'CREATE UNIQUE INDEX IF NOT EXISTS urls_url_key ON urls (url)',
+            '''
+            CREATE INDEX IF NOT EXISTS content_url_uuid_retrieved_idx
+            ON content (url_uuid, retrieved DESC)
+            ''',
+            '''
+            CREATE UNIQUE INDEX IF NOT EXISTS referers_url_uuid_referer_uuid_key
+            ON referers (url_uuid, referer_uuid)
+            ''',
+            'CREATE UNIQUE INDEX IF NOT EXISTS dl_queue_url_key ON dl_queue (url)',
+            '''
+            CREATE INDEX IF NOT EXISTS dl_queue_ready_idx
+            ON dl_queue (dl_order, added)
+            WHERE NOT paused AND paused_until IS NULL
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS dl_queue_paused_until_idx
+            ON dl_queue (paused_until)
+            WHERE paused_until IS NOT NULL
+            ''',
+            'CREATE INDEX IF NOT EXISTS active_dl_url_uuid_idx ON active_dl (url_uuid)',
+            'CREATE INDEX IF NOT EXISTS domain_wait_wait_until_idx ON domain_wait (wait_until)',
+        ],
+    },
+    {
+        'version': 2,
+        'description': 'Add columns for compressed content',
+        'sql': [
+            '''
+            ALTER TABLE content
+            ADD COLUMN IF NOT EXISTS body bytea,
+            ADD COLUMN IF NOT EXISTS encoding text,
+            ADD COLUMN IF NOT EXISTS status integer,
+            ADD COLUMN IF NOT EXISTS headers jsonb
+            ''',
+            # Bodies are already compressed, so don't let Postgres try again
+            'ALTER TABLE content ALTER COLUMN body SET STORAGE EXTERNAL',
+        ],
+    },
+    {
+        'version': 3,
+        'description': 'Add columns for the blob store',
+        'sql': [
+            '''
+            ALTER TABLE content
+            ADD COLUMN IF NOT EXISTS digest text,
+            ADD COLUMN IF NOT EXISTS size bigint
+            ''',
+        ],
+    },
+    {
+        'version': 4,
+        'description': 'Add columns for conditional refreshes',
+        'sql': [
+            '''
+            ALTER TABLE content
+            ADD COLUMN IF NOT EXISTS etag text,
+            ADD COLUMN IF NOT EXISTS last_modified text,
+            ADD COLUMN IF NOT EXISTS body_hash text
+            ''',
+        ],
+    },
+    {
+        'version': 5,
+        'description': 'Index URLs by their hashes',
+        'sql': [
+            'ALTER TABLE urls ADD COLUMN IF NOT EXISTS url_hash bigint',
+            'ALTER TABLE dl_queue ADD COLUMN IF NOT EXISTS url_hash bigint',
+            'ALTER TABLE url_metadata ADD COLUMN IF NOT EXISTS url_hash bigint',
+            # URLs are canonicalized before they are looked up now, so the
+            # ones which are already stored need to be too
+            _canonicalize,
+            'UPDATE urls SET url_hash = {} WHERE url_hash IS NULL'.format(
+                flayer.canon.SQL_URL_HASH.format('url')
+            ),
+            'UPDATE dl_queue SET url_hash = {} WHERE url_hash IS NULL'.format(
+                flayer.canon.SQL_URL_HASH.format('url')
+            ),
+            'UPDATE url_metadata SET url_hash = {} WHERE url_hash IS NULL'.format(
+                flayer.canon.SQL_URL_HASH.format('url')
+            ),
+            # Different URLs may share a hash, so it is only unique together
+            # with the URL, which is compared on every lookup anyway
+            '''
+            CREATE UNIQUE INDEX IF NOT EXISTS urls_url_hash_url_key
+            ON urls (url_hash, url)
+            ''',
+            '''
+            CREATE UNIQUE INDEX IF NOT EXISTS dl_queue_url_hash_url_key
+            ON dl_queue (url_hash, url)
+            ''',
+            'CREATE INDEX IF NOT EXISTS url_metadata_url_hash_idx ON url_metadata (url_hash)',
+            'DROP INDEX IF EXISTS urls_url_key',
+            'DROP INDEX IF EXISTS dl_queue_url_key',
+        ],
+    },
+]
+
+# The queries which are run for (nearly) every URL, and which must be able to
+# use an index
+HOT_QUERIES = {
+    'urls by url_hash': '''
+        SELECT uuid FROM urls
+        WHERE url_hash = 0 AND url = 'http://example.com/'
+    ''',
+    'content by url_uuid': '''
+        SELECT data, body, encoding, status, digest, etag, last_modified, body_hash, uuid
+        FROM content
+        WHERE url_uuid = '00000000-0000-0000-0000-000000000000'
+        ORDER BY retrieved LIMIT 1
+    ''',
+    'referers by url_uuid and referer_uuid': '''
+        SELECT 1 FROM referers
+        WHERE url_uuid = '00000000-0000-0000-0000-000000000000'
+        AND referer_uuid = '00000000-0000-0000-0000-000000000000'
+    ''',
+    'dl_queue by url_hash': '''
+        SELECT 1 FROM dl_queue
+        WHERE url_hash = 0 AND url = 'http://example.com/'
+    ''',
+    'url_metadata by url_hash': '''
+        SELECT uuid, metadata FROM url_metadata
+        WHERE url_hash = 0 AND url = 'http://example.com/'
+    ''',
+    'dl_queue claim': '''
+        SELECT uuid FROM dl_queue
+        WHERE paused = FALSE AND paused_until IS NULL
+        ORDER BY dl_order, added LIMIT 10
+    ''',
+    'dl_queue unpause': '''
+        SELECT uuid FROM dl_queue
+        WHERE paused_until IS NOT NULL AND paused_until <= now()
+    ''',
+    'domain_wait by domain': '''
+        SELECT count(*) FROM domain_wait
+        WHERE domain = 'example.com' AND wait_until >= now()
+    ''',
+}
+
+
+def current_version(dbclient):
+    '''
+    Return the current version of the schema, creating the ``schema_version``
+    table if necessary
+    '''
+    cur = dbclient.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version integer primary key,
+            description text,
+            applied timestamp without time zone DEFAULT now()
+        )
+    ''')
+    cur.execute('SELECT coalesce(max(version), 0) FROM schema_version')
+    version = cur.fetchone()[0]
+    dbclient.commit()
+    return version
+
+
+def migrate(dbclient, opts):
+    '''
+    Apply any migrations that have not yet been applied, then check that the
+    hot queries can use their indexes
+    '''
+    out = flayer.tools.Output(opts)
+    version = current_version(dbclient)
+    cur = dbclient.cursor()
+
+    for migration in MIGRATIONS:
+        if migration['version'] <= version:
+            continue
+        out.action('Migrating to version {}: {}'.format(
+            migration['version'], migration['description']
+        ))
+
+        problems = []
+        for sql, message in migration.get('checks', []):
+            cur.execute(sql)
+            count = cur.fetchone()[0]
+            if count:
+                problems.append('{} ({})'.format(message, count))
+        if problems:
+            dbclient.rollback()
+            for problem in problems:
+                out.error(problem, force=True)
+            out.error(
+                'Version {} cannot be applied safely; fix the above and try again'.format(
+                    migration['version']
+                ),
+                force=True,
+            )
+            return False
+
+        for sql in migration['sql']:
+            if callable(sql):
+                sql(dbclient)
+            else:
+                cur.execute(sql)
+        cur.execute(
+            'INSERT INTO schema_version (version, description) VALUES (%s, %s)',
+            [migration['version'], migration['description']],
+        )
+        dbclient.commit()
+        version = migration['version']
+
+    out.info('Schema is at version {}'.format(version))
+
+    count = flayer.compress.convert(dbclient, opts)
+    if count:
+        out.info('Compressed {} pages with {}'.format(count, opts['content_compression']))
+
+    ret = True
+    for name, uses_index in explain(dbclient).items():
+        if uses_index:
+            out.info('{}: uses an index'.format(name))
+        else:
+            out.warn('{}: does NOT use an index'.format(name))
+            ret = False
+    return ret
+
+
+def explain(dbclient):
+    '''
+    Run each of the hot queries through ``EXPLAIN``, and return whether each
+    one is able to use an index.
+
+    Sequential scans are disabled while doing so; otherwise the planner will
+    prefer them for small tables, even when a usable index exists.
+    '''
+    cur = dbclient.cursor()
+    ret = {}
+    cur.execute('SET LOCAL enable_seqscan = off')
+    for name, sql in HOT_QUERIES.items():
+        cur.execute('EXPLAIN (FORMAT JSON) {}'.format(sql))
+        plan = cur.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        ret[name] = _uses_index(plan[0]['Plan'])
+    dbclient.rollback()
+    return ret
+
+
+def _uses_index(plan):
+    '''
+    Walk a plan, looking for any index scans
+    '''
+    if 'Index' in plan.get('Node Type', ''):
+        return True
+    for child in plan.get('Plans', []):
+        if _uses_index(child):
+            return True
+    return False
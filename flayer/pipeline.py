@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+'''
+Parse stage for Web Flayer
+
+Link extraction and parser plugins are CPU-bound, and would otherwise block
+the fetch side while they run. When ``--parse-processes`` is set, fetched
+pages are handed to a ``multiprocessing`` pool instead. Each process in the
+pool loads its own parsers, with its own database connection, and the links
+(along with any URLs that the parsers added to ``__urls__``) are sent back to
+the fetch side as they become available.
+'''
+# Python
+import queue
+import pickle
+import threading
+import multiprocessing
+
+# Internal
+import flayer.db
+import flayer.event
+import flayer.document
+import flayer.tools
+import flayer.loader
+
+# Per-process state, set up by _init()
+_STATE = {}
+
+
+def _picklable(opts):
+    '''
+    Return a copy of opts without anything that can't be sent to another
+    process (the event bus, the API server, etc)
+    '''
+    ret = {}
+    for key, value in opts.items():
+        try:
+            pickle.dumps(value)
+        except Exception:  # pylint: disable=broad-except
+            continue
+        ret[key] = value
+    return ret
+
+
+def _init(opts):
+    '''
+    Set up a process in the pool
+    '''
+    if opts.get('salt_events') is True:
+        opts['salt_event'] = flayer.event.bus(opts)
+    dbclient = flayer.db.client(opts)
+    context = {}
+    urls = []
+    _STATE['opts'] = opts
+    _STATE['dbclient'] = dbclient
+    _STATE['urls'] = urls
+    _STATE['parsers'] = flayer.loader.parser(opts, context, urls, dbclient)
+
+
+def _parse(url_uuid, url, content, level):
+    '''
+    Extract the links from a page and run it through the parsers. This runs
+    inside the pool.
+    '''
+    opts = _STATE['opts']
+    urls = _STATE['urls']
+    content = flayer.document.Document.wrap(content, url, opts)
+    ret = {
+        'url': url,
+        'hrefs': content.links(level),
+        'parsed': True,
+        'urls': [],
+    }
+    if opts.get('use_parsers', True) is True:
+        try:
+            flayer.tools.process_url(url_uuid, url, content, _STATE['parsers'])
+        except TypeError:
+            ret['parsed'] = False
+    # Hand any URLs the parsers added to __urls__ back to the fetch side
+    ret['urls'] = urls[:]
+    del urls[:]
+    return ret
+
+
+def wants_links(opts):
+    '''
+    Whether anything will be done with the links from a page, so that pages
+    which are only being run through the parsers don't have to be searched
+    for them
+    '''
+    return bool(
+        opts.get('links') or opts.get('queuelinks') or opts.get('queue_re')
+        or opts.get('render')
+    )
+
+
+def reparse(url_uuid, url, row, opts, parsers, urls):
+    '''
+    Run a page from the cache back through the parsers, without downloading
+    it. ``row`` is the ``data``, ``body``, ``encoding``, ``status`` and
+    ``digest`` columns of the page in the ``content`` table, so that pages are
+    decompressed (or read out of the blob store) by whoever parses them.
+    Returns ``None`` if the page is no longer available.
+    '''
+    data = flayer.db._cached_data(opts, *row)  # pylint: disable=protected-access
+    if data is None:
+        return None
+    content = flayer.document.Document(data.get('content', ''), url, opts)
+    ret = {
+        'url': url,
+        'hrefs': [],
+        'parsed': True,
+        'urls': [],
+    }
+    if wants_links(opts):
+        ret['hrefs'] = content.links(0)
+    if opts.get('use_parsers', True) is True:
+        try:
+            flayer.tools.process_url(url_uuid, url, content, parsers)
+        except TypeError:
+            ret['parsed'] = False
+    ret['urls'] = urls[:]
+    del urls[:]
+    return ret
+
+
+def _reparse(url_uuid, url, row):
+    '''
+    Run ``reparse()`` inside the pool
+    '''
+    return reparse(url_uuid, url, row, _STATE['opts'], _STATE['parsers'], _STATE['urls'])
+
+
+class ParsePool(object):
+    '''
+    A pool of processes for the parse stage
+    '''
+    def __init__(self, opts, processes):
+        '''
+        Initialize. This must be called before any threads are started, since
+        the pool is forked from the current process.
+        '''
+        self.out = flayer.tools.Output(opts)
+        self.results = queue.Queue()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.pool = multiprocessing.get_context('fork').Pool(
+            processes,
+            initializer=_init,
+            initargs=(_picklable(opts),),
+        )
+
+    def submit(self, url_uuid, url, content, level):
+        '''
+        Send a page to the pool
+        '''
+        with self.lock:
+            self.pending += 1
+        self.pool.apply_async(
+            _parse,
+            (url_uuid, url, content, level),
+            callback=self._done,
+            error_callback=self._error,
+        )
+
+    def submit_cached(self, url_uuid, url, row):
+        '''
+        Send a page from the cache to the pool, to be run through the parsers
+        '''
+        with self.lock:
+            self.pending += 1
+        self.pool.apply_async(
+            _reparse,
+            (url_uuid, url, row),
+            callback=self._done,
+            error_callback=self._error,
+        )
+
+    def _done(self, result):
+        '''
+        A page has been parsed
+        '''
+        self.results.put(result)
+        with self.lock:
+            self.pending -= 1
+
+    def _error(self, exc):
+        '''
+        A page failed to parse
+        '''
+        self.out.error('Error parsing page: {}'.format(exc))
+        with self.lock:
+            self.pending -= 1
+
+    def busy(self):
+        '''
+        Whether there are pages in the pool, or results not yet collected
+        '''
+        return self.pending > 0 or not self.results.empty()
+
+    def backlog(self):
+        '''
+        Return the number of pages which have been sent to the pool, but not
+        yet parsed
+        '''
+        return self.pending
+
+    def drain(self):
+        '''
+        Return any results which are ready, without waiting
+        '''
+        ret = []
+        while True:
+            try:
+                ret.append(self.results.get_nowait())
+            except queue.Empty:
+                return ret
+
+    def close(self):
+        '''
+        Wait for the pool to finish, and shut it down
+        '''
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+'''
+Offline reprocessing for Web Flayer
+
+``--reprocess`` runs pages which are already in the cache back through the
+parsers, such as after a parser has been fixed. Rather than loading every
+matching URL into memory and sending each one back through ``get_url()``
+(with its waits and bookkeeping queries), the cached pages are streamed out
+of the database with a server-side cursor, a batch at a time, and handed
+straight to the parsers. Nothing is downloaded, and the ``domain_wait`` and
+``pattern_wait`` tables are not touched.
+
+If ``parse_processes`` is set, pages are parsed by a pool of that many
+processes. Pages are handed to the pool still compressed (or as a blob digest),
+so that they are unpacked by the process that parses them.
+'''
+# Python
+import os
+import time
+
+# Internal
+import flayer.db
+import flayer.tools
+import flayer.loader
+import flayer.pipeline
+
+# The number of rows fetched from the server-side cursor at a time
+BATCH_SIZE = 1000
+
+# The number of pages per process allowed to wait in the pool
+BACKLOG = 64
+
+
+def _query(patterns):
+    '''
+    Return the query that streams the cached pages for the URLs matching
+    ``patterns``
+    '''
+    wheres = ['urls.url ~ %s'] * len(patterns)
+    return '''
+        SELECT urls.uuid, urls.url,
+               cached.data, cached.body, cached.encoding, cached.status, cached.digest
+        FROM urls
+        CROSS JOIN LATERAL (
+            SELECT data, body, encoding, status, digest
+            FROM content
+            WHERE content.url_uuid = urls.uuid
+            ORDER BY retrieved
+            LIMIT 1
+        ) cached
+        WHERE {}
+    '''.format(' OR '.join(wheres))
+
+
+def run(dbclient, opts, context, patterns):
+    '''
+    Reprocess the cached pages for the URLs which match the pattern(s), and
+    return the number of pages that were reprocessed
+    '''
+    out = flayer.tools.Output(opts)
+    if isinstance(patterns, str):
+        patterns = [patterns]
+
+    processes = int(opts.get('parse_processes', 0))
+    pool = None
+    parsers = None
+    urls = []
+    if processes > 0:
+        pool = flayer.pipeline.ParsePool(opts, processes)
+    else:
+        parsers = flayer.loader.parser(opts, context, urls, dbclient)
+
+    # Named cursors only stream from inside a transaction, and the other
+    # queries here (queueing links) commit as they go, so use a connection of
+    # its own
+    stream = flayer.db.client(opts)
+    cur = stream.cursor(name='flayer_reprocess')
+    cur.itersize = BATCH_SIZE
+    count = 0
+    missing = 0
+    try:
+        cur.execute(_query(patterns), patterns)
+        for url_uuid, url, *row in cur:
+            if opts['stop'] or os.path.exists(opts['stop_file']):
+                out.warn('stop requested, exiting')
+                break
+            count += 1
+            if pool is None:
+                result = flayer.pipeline.reparse(url_uuid, url, row, opts, parsers, urls)
+                missing += _handle(result, opts, dbclient)
+                continue
+            pool.submit_cached(url_uuid, url, row)
+            while pool.backlog() > processes * BACKLOG:
+                missing += _collect(pool, opts, dbclient)
+                time.sleep(.01)
+            missing += _collect(pool, opts, dbclient)
+        if pool is not None:
+            while pool.busy():
+                missing += _collect(pool, opts, dbclient)
+                time.sleep(.1)
+    finally:
+        cur.close()
+        stream.close()
+        if pool is not None:
+            pool.close()
+
+    if missing:
+        out.warn('{} cached page(s) could not be read'.format(missing))
+    out.info('Reprocessed {} URL(s)'.format(count - missing))
+    return count - missing
+
+
+def _collect(pool, opts, dbclient):
+    '''
+    Handle the pages which the pool has finished with, and return the number
+    that could not be read
+    '''
+    missing = 0
+    for result in pool.drain():
+        missing += _handle(result, opts, dbclient)
+    return missing
+
+
+def _handle(result, opts, dbclient):
+    '''
+    Display and queue the links from a reprocessed page. Since nothing is
+    downloaded while reprocessing, any URLs the parsers added to ``__urls__``
+    are added to the download queue. Returns 1 if the page could not be read.
+    '''
+    out = flayer.tools.Output(opts)
+    if result is None:
+        return 1
+    hrefs = result['hrefs']
+    if opts.get('links', False) is True:
+        out.info('\n'.join(hrefs))
+    if opts.get('queuelinks', False) is True:
+        flayer.tools.queue_urls(hrefs, dbclient, opts)
+    if result['parsed'] is False:
+        out.warn('No matching parsers were found for {}'.format(result['url']))
+    if opts.get('queue_re'):
+        flayer.tools.queue_regexp(hrefs, opts['queue_re'], dbclient, opts)
+    if result['urls']:
+        flayer.tools.queue_urls(result['urls'], dbclient, opts)
+    return 0
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+Per-host politeness scheduler for Web Flayer
+
+Rather than checking and setting the ``domain_wait`` table before and after
+every download, each agent keeps track of when it may next hit each host in
+memory. Every host has a token bucket, which refills at one token per
+``domain_wait`` seconds, and holds up to ``domain_burst`` tokens.
+
+So that agents in a cluster still leave each other's hosts alone, the
+scheduler is synced with the ``domain_wait`` table every
+``domain_wait_sync`` seconds: the waits from this agent are written out in a
+single batch, and the waits from every other agent are read back in.
+'''
+# Python
+import time
+import threading
+
+# 3rd party
+import psycopg2.extras
+
+
+class HostScheduler(object):
+    '''
+    Token buckets and next-allowed times for each host
+    '''
+    def __init__(self, wait=0, burst=1, interval=5):
+        '''
+        Initialize
+        '''
+        self.wait = float(wait or 0)
+        self.burst = max(float(burst or 1), 1)
+        self.interval = float(interval)
+        self._lock = threading.Lock()
+        # host -> (tokens, time they were counted)
+        self._buckets = {}
+        # host -> time before which other agents have asked us to wait
+        self._remote = {}
+        # host -> wait_until, not yet written to the database
+        self._pending = {}
+        # host -> wait_until, as last written to the database by this agent
+        self._written = {}
+        self._synced = 0
+
+    def ready_at(self, host):
+        '''
+        Return the time at which the host may next be hit
+        '''
+        with self._lock:
+            ret = self._remote.get(host, 0)
+            if self.wait <= 0 or host not in self._buckets:
+                return ret
+            tokens, when = self._refill(host, time.time())
+            if tokens >= 1:
+                return ret
+            return max(ret, when + (1 - tokens) * self.wait)
+
+    def hit(self, host):
+        '''
+        Take a token from the host's bucket, because it is about to be hit
+        '''
+        if self.wait <= 0:
+            return
+        with self._lock:
+            now = time.time()
+            tokens, _ = self._refill(host, now)
+            self._buckets[host] = (tokens - 1, now)
+            self._pending[host] = now + self.wait
+
+    def _refill(self, host, now):
+        '''
+        Return the number of tokens in the host's bucket right now
+        '''
+        tokens, when = self._buckets.get(host, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - when) / self.wait)
+        if tokens >= self.burst:
+            # Full buckets don't need to be remembered
+            self._buckets.pop(host, None)
+        return tokens, now
+
+    def due(self):
+        '''
+        Whether it is time to sync with the database again
+        '''
+        return time.time() - self._synced >= self.interval
+
+    def sync(self, dbclient, force=False):
+        '''
+        Write this agent's waits to the ``domain_wait`` table, and read the
+        waits of all other agents back. This is skipped if the last sync was
+        less than ``interval`` seconds ago, unless ``force`` is ``True``.
+        '''
+        with self._lock:
+            now = time.time()
+            if not force and now - self._synced < self.interval:
+                return False
+            self._synced = now
+            pending, self._pending = self._pending, {}
+
+        cur = dbclient.cursor()
+        cur.execute('DELETE FROM domain_wait WHERE wait_until < now()')
+        if pending:
+            psycopg2.extras.execute_values(
+                cur,
+                '''
+                INSERT INTO domain_wait (domain, wait_until)
+                VALUES %s
+                ON CONFLICT (domain) DO UPDATE
+                SET wait_until = GREATEST(domain_wait.wait_until, EXCLUDED.wait_until)
+                ''',
+                list(pending.items()),
+                template='(%s, to_timestamp(%s)::timestamp)',
+            )
+        cur.execute('''
+            SELECT domain, extract(epoch FROM wait_until::timestamptz)
+            FROM domain_wait
+            WHERE wait_until >= now()
+        ''')
+        rows = cur.fetchall()
+        dbclient.commit()
+
+        with self._lock:
+            self._written.update(pending)
+            remote = {}
+            for host, until in rows:
+                until = float(until)
+                if abs(self._written.get(host, 0) - until) < .01:
+                    # This is our own wait, which the bucket already covers
+                    continue
+                remote[host] = until
+            now = time.time()
+            self._written = {
+                host: until for host, until in self._written.items() if until >= now
+            }
+            self._remote = remote
+        return True
@@ -3,40 +3,48 @@
 
 '''
 Basic functions for Web Flayer
+
+``flay`` is run for quick management commands (``--version``, ``--list-queue``,
+``--pause`` and so on) as often as it is run to crawl, so this module keeps
+its own imports cheap. Slow dependencies (Salt, ``requests``, BeautifulSoup,
+``psutil``, and the HTTP API and asyncio engine) and the modules that only one
+command uses (migrations, reprocessing and the parse pool) are only imported
+by the commands that use them, and ``run()`` handles each management command
+before it connects to anything that the command doesn't need. See
+``bench/startup.py``.
+
+``yaml`` and ``psycopg2`` are still imported up front: every command reads the
+config file, and every command but the few that only print something connects
+to the database.
 '''
 # Python
 import os
 import sys
 import time
-import copy
 import json
 import pprint
-import urllib
 import logging
-
-# 3rd party
-import yaml
-import psutil
-import requests
-from bs4 import BeautifulSoup
-from salt.loader import LazyLoader
-import salt.config
+import threading
 
 # Internal
 import flayer.db
-import flayer.api
+import flayer.seen
 import flayer.tools
 import flayer.event
 import flayer.config
+import flayer.document
 import flayer.loader
+import flayer.frontier
+import flayer.scheduler
 from flayer.version import __version__
 
 log = logging.getLogger(__name__)
 
 
-def daemonize(opts, context):
+def daemonize(opts):
     '''
-    Spawn a new process
+    Spawn a new process. The HTTP API is started by ``run()``, once the
+    parse pool (which is forked) is ready.
     '''
     out = flayer.tools.Output(opts)
     try:
@@ -61,7 +69,170 @@ def daemonize(opts, context):
         out.error('fork #2 failed: {} ({})'.format(exc.errno, exc))
         sys.exit(1)
 
-    flayer.api.run(opts, context)
+
+def _worker(worker_id, opts, context, urls, stop, parse_pool=None):
+    '''
+    A single fetch worker, with its own database connection and parsers
+    '''
+    worker_context = {}
+    context['workers'][worker_id] = worker_context
+    dbclient = flayer.db.client(opts)
+    parsers = flayer.loader.parser(opts, worker_context, urls, dbclient)
+    try:
+        crawl(
+            opts, worker_context, urls, dbclient, parsers,
+            stop=stop, parse_pool=parse_pool,
+        )
+    finally:
+        dbclient.close()
+
+
+def _check_stop(opts, out, stop=None):
+    '''
+    Check whether a stop has been requested, either through opts, the stop
+    file, or by another worker
+    '''
+    if stop is not None and stop.is_set():
+        return True
+    if opts['stop']:
+        return True
+    if os.path.exists(opts['stop_file']):
+        out.warn('stop file found, exiting')
+        try:
+            os.remove(opts['stop_file'])
+        except FileNotFoundError:
+            # Another worker already got to it
+            pass
+        return True
+    return False
+
+
+def crawl(opts, context, urls, dbclient, parsers, stop=None, parse_pool=None):
+    '''
+    Process URLs from the in-memory list and the download queue until there
+    is nothing left to do, or a stop is requested.
+
+    ``urls`` is a ``flayer.frontier.Frontier``, which only hands out URLs whose
+    hosts are not already being hit. When running with multiple workers, each
+    worker calls this function with its own ``dbclient`` and ``parsers``.
+    ``urls`` is shared between them, and ``stop`` is a ``threading.Event``
+    used to tell the other workers to exit.
+
+    If a ``parse_pool`` is passed in, pages will be parsed by that instead,
+    and the results will be collected as they become available. Once the loop
+    exits, this waits for the pages still in the pool, and collects them too.
+    '''
+    out = flayer.tools.Output(opts)
+    level = 0
+    # Use a while instead of for, because the list is expected to expand
+    while True:
+        if _check_stop(opts, out, stop):
+            if stop is not None:
+                stop.set()
+            break
+        if len(urls) < 1 and opts['use_queue'] is True:
+            flayer.db.pop_dl_queue(dbclient, urls, opts)
+        if opts['urls']:
+            queued, opts['urls'] = opts['urls'], []
+            flayer.tools.queue_urls(queued, dbclient, opts)
+        if parse_pool is not None:
+            for result in parse_pool.drain():
+                _handle_parsed(result, opts, urls, dbclient)
+        # Share domain waits with other agents, every so often
+        urls.scheduler.sync(dbclient)
+        try:
+            url = urls.pop(0)
+        except IndexError:
+            if opts['daemon'] or urls.busy() or (
+                    parse_pool is not None and parse_pool.busy()):
+                time.sleep(.1)
+                continue
+            else:
+                break
+        if url is None:
+            # There are URLs, but their hosts are all waiting
+            time.sleep(min(urls.wait_time() or .1, 1))
+            continue
+        if url.strip() == '':
+            urls.release(url)
+            continue
+        try:
+            level = _process(
+                url, level, opts, context, urls, dbclient, parsers, parse_pool
+            )
+        finally:
+            urls.release(url)
+        if opts.get('single') is True:
+            break
+
+    if parse_pool is not None:
+        # Pages which were sent to the pool before the loop exited still need
+        # their links queued, or they would be lost
+        while True:
+            for result in parse_pool.drain():
+                _handle_parsed(result, opts, urls, dbclient)
+            if not parse_pool.busy():
+                break
+            time.sleep(.1)
+
+
+def _process(url, level, opts, context, urls, dbclient, parsers, parse_pool=None):
+    '''
+    Download, parse and queue the links for a single URL
+    '''
+    import requests
+
+    out = flayer.tools.Output(opts)
+    url_uuid, url, content = flayer.tools.pre_flight(url, parsers)
+    if url_uuid is None:
+        try:
+            url_uuid, content, unchanged = flayer.tools.fetch_url(
+                url, dbclient=dbclient, opts=opts, context=context
+            )
+        except requests.exceptions.MissingSchema as exc:
+            out.error(exc)
+            return level
+        if unchanged is True:
+            # Nothing new to parse
+            return level
+    # Display the source of the URL content
+    if opts.get('source', False) is True:
+        out.info(content)
+    if parse_pool is not None:
+        # Links and parsers are handled in another process
+        parse_pool.submit(url_uuid, url, content, level)
+        return level + 1
+    content = flayer.document.Document.wrap(content, url, opts)
+    hrefs = content.links(level)
+    level += 1
+    parsed = True
+    if opts.get('use_parsers', True) is True:
+        try:
+            flayer.tools.process_url(url_uuid, url, content, parsers)
+        except TypeError:
+            parsed = False
+    _handle_parsed(
+        {'url': url, 'hrefs': hrefs, 'parsed': parsed, 'urls': []},
+        opts, urls, dbclient,
+    )
+    return level
+
+
+def _handle_parsed(result, opts, urls, dbclient):
+    '''
+    Display and queue the links from a parsed page
+    '''
+    out = flayer.tools.Output(opts)
+    hrefs = result['hrefs']
+    if opts.get('links', False) is True:
+        out.info('\n'.join(hrefs))
+    if opts.get('queuelinks', False) is True:
+        flayer.tools.queue_urls(hrefs, dbclient, opts)
+    if result['parsed'] is False:
+        out.warn('No matching parsers were found')
+    if opts.get('queue_re'):
+        flayer.tools.queue_regexp(hrefs, opts['queue_re'], dbclient, opts)
+    urls.extend(result['urls'])
 
 
 def run(run_opts=None):  # pylint: disable=too-many-return-statements
@@ -71,21 +242,16 @@ def run(run_opts=None):  # pylint: disable=too-many-return-statements
     if run_opts is None:
         run_opts = {}
 
-    opts, urls, parser = flayer.config.load(run_opts)
+    opts, cli_urls, parser = flayer.config.load(run_opts)
     context = {}
 
     if opts.get('stop') or opts.get('hard_stop') or opts.get('abort'):
         open(opts['stop_file'], 'a').close()
         return
 
-    if opts['daemon']:
-        daemonize(opts, context)
-
     out = flayer.tools.Output(opts)
-    dbclient = flayer.db.client(opts)
-
-    opts['salt_event'] = flayer.event.bus(opts)
 
+    # These don't need the database
     if opts.get('version'):
         out.info(__version__)
         return
@@ -98,6 +264,20 @@ def run(run_opts=None):  # pylint: disable=too-many-return-statements
         out.info(pprint.pformat(context))
         return
 
+    scheduler = flayer.scheduler.HostScheduler(
+        opts.get('domain_wait', 0),
+        opts.get('domain_burst', 1),
+        opts.get('domain_wait_sync', 5),
+    )
+    urls = flayer.frontier.Frontier(scheduler=scheduler)
+    urls.extend(cli_urls)
+
+    if opts['daemon']:
+        daemonize(opts)
+
+    dbclient = flayer.db.client(opts)
+
+    # These don't need the event bus
     if opts.get('list_queue', False) is True:
         flayer.db.list_queue(dbclient, opts)
         return
@@ -106,6 +286,11 @@ def run(run_opts=None):  # pylint: disable=too-many-return-statements
         flayer.db.get_url_metadata(dbclient, opts)
         return
 
+    if opts.get('migrate'):
+        from flayer import migrate
+        migrate.migrate(dbclient, opts)
+        return
+
     if opts.get('pause'):
         flayer.db.pause(dbclient, opts, opts['pause'])
         return
@@ -114,13 +299,19 @@ def run(run_opts=None):  # pylint: disable=too-many-return-statements
         flayer.db.unpause(dbclient, opts, opts['unpause'])
         return
 
+    if opts.get('salt_events') is True:
+        opts['salt_event'] = flayer.event.bus(opts)
+
     # Keeps track of the URLs that we've already warned about this session
-    opts['warned'] = []
+    opts['warned'] = set()
+
+    flayer.seen.load(dbclient, opts)
 
-    organizers = flayer.loader.organize(opts, dbclient, context)
+    organizers = {}
     organize_engine = None
     organize_fun = None
     if opts.get('search_organize'):
+        organizers = flayer.loader.organize(opts, dbclient, context)
         for organize_engine in opts['search_organize']:
             organize_fun = '.'.join([organize_engine, 'organize'])
             if organize_fun not in organizers:
@@ -159,15 +350,18 @@ def run(run_opts=None):  # pylint: disable=too-many-return-statements
 
     if opts.get('queue', False) is True:
         count = flayer.tools.queue_urls(urls, dbclient, opts)
-        out.info('Added item(s) to the queue, {} items now queued'.format(count))
+        out.info('Added item(s) to the queue, about {} items now queued'.format(count))
         return
 
+    if opts['reprocess']:
+        from flayer import reprocess
+        reprocess.run(dbclient, opts, context, opts['reprocess'])
+        if not urls:
+            return
+
     parsers = flayer.loader.parser(opts, context, urls, dbclient)
     filters = flayer.loader.filter(opts, context, urls, dbclient)
 
-    if opts['reprocess']:
-        urls = flayer.tools.reprocess_urls(urls, opts['reprocess'], dbclient)
-
     if not urls and opts['use_queue'] is True:
         flayer.db.pop_dl_queue(dbclient, urls, opts)
 
@@ -198,68 +392,52 @@ def run(run_opts=None):  # pylint: disable=too-many-return-statements
         json.dump(metadata, fh_, indent=4)
 
     if not opts['already_running'] or opts.get('single') is True:
-        level = 0
-        # Use a while instead of for, because the list is expected to expand
-        while True:
-            url_uuid = None
-            if opts['stop']:
-                opts['http_api'].shutdown()
-                break
-            if os.path.exists(opts['stop_file']):
-                out.warn('stop file found, exiting')
-                os.remove(opts['stop_file'])
-                try:
-                    opts['http_api'].shutdown()
-                except KeyError:
-                    pass
-                break
-            if len(urls) < 1 and opts['use_queue'] is True:
-                flayer.db.pop_dl_queue(dbclient, urls, opts)
-            if opts['urls']:
-                flayer.tools.queue_urls(opts['urls'], dbclient, opts)
-                opts['urls'] = []
-            try:
-                url = urls.pop(0)
-            except IndexError:
-                if opts['daemon']:
-                    time.sleep(.1)
-                    continue
-                else:
-                    break
-            if url.strip() == '':
-                continue
-            for mod in parsers:
-                if isinstance(url_uuid, int) and url_uuid == 0:
-                    break
-                if not mod.endswith('.pre_flight'):
-                    continue
-                url_uuid, url, content = parsers[mod](url)
-            if url_uuid is None:
-                try:
-                    url_uuid, content = flayer.tools.get_url(
-                        url, dbclient=dbclient, opts=opts, context=context
+        # The frontier's scheduler takes care of domain_wait from here on
+        opts['local_domain_wait'] = True
+        workers = int(opts.get('workers', 1))
+        parse_pool = None
+        if int(opts.get('parse_processes', 0)) > 0 and opts.get('engine') != 'asyncio':
+            from flayer import pipeline
+            parse_pool = pipeline.ParsePool(opts, int(opts['parse_processes']))
+        if opts['daemon']:
+            # The API runs in a thread, so it is only started once the parse
+            # pool has been forked
+            from flayer import api
+            api.run(opts, context)
+        try:
+            if opts.get('engine') == 'asyncio':
+                from flayer import aio
+                aio.crawl(opts, context, urls, dbclient, parsers)
+            elif workers > 1 and opts.get('single') is not True:
+                stop = threading.Event()
+                context['workers'] = {}
+                threads = []
+                for worker_id in range(workers):
+                    thread = threading.Thread(
+                        target=_worker,
+                        args=(worker_id, opts, context, urls, stop, parse_pool),
+                        name='flay-worker-{}'.format(worker_id),
                     )
-                except requests.exceptions.MissingSchema as exc:
-                    out.error(exc)
-                    continue
-            # Display the source of the URL content
-            if opts.get('source', False) is True:
-                out.info(content)
-            hrefs = flayer.tools.parse_links(url, content, level, opts)
-            level += 1
-            if opts.get('links', False) is True:
-                out.info('\n'.join(hrefs))
-            if opts.get('queuelinks', False) is True:
-                flayer.tools.queue_urls(hrefs, dbclient, opts)
-            if opts.get('use_parsers', True) is True:
-                try:
-                    flayer.tools.process_url(url_uuid, url, content, parsers)
-                except TypeError:
-                    out.warn('No matching parsers were found')
-            if opts.get('queue_re'):
-                flayer.tools.queue_regexp(hrefs, opts['queue_re'], dbclient, opts)
-            if opts.get('single') is True:
-                break
+                    thread.start()
+                    threads.append(thread)
+                for thread in threads:
+                    thread.join()
+            else:
+                crawl(opts, context, urls, dbclient, parsers, parse_pool=parse_pool)
+        except BaseException:
+            # URLs are claimed from the queue several at a time, so any which
+            # were not processed have to be put back, even after a crash
+            dbclient.rollback()
+            flayer.db.requeue_claims(dbclient, urls)
+            raise
+        flayer.db.requeue_claims(dbclient, urls)
+        if parse_pool is not None:
+            parse_pool.close()
+        scheduler.sync(dbclient, force=True)
+        try:
+            opts['http_api'].shutdown()
+        except KeyError:
+            pass
         try:
             os.remove(opts['pid_file'])
         except FileNotFoundError:
@@ -269,6 +447,8 @@ def run(run_opts=None):  # pylint: disable=too-many-return-statements
         except FileNotFoundError:
             pass
     else:
+        import psutil
+
         verified_running = False
         for process in psutil.process_iter():
             try:
@@ -295,4 +475,5 @@ def run(run_opts=None):  # pylint: disable=too-many-return-statements
                     opts['stop_file']
                 ), force=True
             )
+        flayer.db.requeue_claims(dbclient, urls)
         flayer.tools.queue_urls(urls, dbclient, opts)
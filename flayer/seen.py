@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+'''
+Seen-URL filter for Web Flayer
+
+When ``seen_filter`` is set to a file, a Bloom filter of every URL that has
+been added to the ``urls`` or ``dl_queue`` tables is kept in that file, which
+is mapped into memory with ``mmap``. It is built from the database the first
+time it is used, and updated as URLs are added after that, so it persists
+between runs.
+
+The filter can say for certain that a URL has not been seen, and can say that
+a URL has probably been seen. Links which have not been seen are sent
+straight to the download queue as before. When every link in a batch has
+probably been seen (as with the navigation links that appear on every page of
+a site), they are confirmed with one read-only lookup, instead of an
+``INSERT`` which checks every link.
+
+Bits are only ever set, never cleared, so agents which share the file (or
+threads which update it at the same time) can at worst lose an update. That
+only turns a "probably seen" into a "not seen", which the database still
+catches.
+'''
+# Python
+import os
+import math
+import mmap
+import struct
+import hashlib
+
+MAGIC = b'FLSEEN01'
+
+# Magic, number of bits, number of hashes
+HEADER = struct.Struct('<8sQI')
+
+ERROR_RATE = 0.01
+
+_FILTERS = {}
+
+
+def store(opts):
+    '''
+    Return the filter configured by ``seen_filter``, or ``None`` if there isn't
+    one
+    '''
+    path = opts.get('seen_filter')
+    if not path:
+        return None
+    if path not in _FILTERS:
+        _FILTERS[path] = SeenFilter(path, int(opts.get('seen_filter_size', 10000000)))
+    return _FILTERS[path]
+
+
+def add(opts, urls):
+    '''
+    Add URLs to the filter, if there is one
+    '''
+    seen = store(opts)
+    if seen is None:
+        return
+    if isinstance(urls, str):
+        urls = [urls]
+    for url in urls:
+        seen.add(url)
+
+
+def load(dbclient, opts, batch_size=10000):
+    '''
+    Open the filter, filling it with the URLs which are already in the
+    database if it was just created. Returns the filter, or ``None``.
+    '''
+    seen = store(opts)
+    if seen is None or not seen.created:
+        return seen
+    cur = dbclient.cursor(name='flayer_seen')
+    cur.itersize = batch_size
+    cur.execute('SELECT url FROM urls UNION ALL SELECT url FROM dl_queue')
+    for row in cur:
+        if row[0]:
+            seen.add(row[0])
+    cur.close()
+    dbclient.commit()
+    seen.created = False
+    seen.flush()
+    return seen
+
+
+class SeenFilter(object):
+    '''
+    A Bloom filter, stored in a file
+    '''
+    def __init__(self, path, capacity):
+        '''
+        Open the filter at ``path``, or create one big enough to hold
+        ``capacity`` URLs with a false positive rate of ``ERROR_RATE``
+        '''
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.created = not os.path.exists(self.path)
+        if self.created:
+            bits, hashes = self.size(capacity, ERROR_RATE)
+            os.makedirs(os.path.dirname(self.path), mode=0o0755, exist_ok=True)
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'wb') as fh_:
+                fh_.write(HEADER.pack(MAGIC, bits, hashes))
+                fh_.truncate(HEADER.size + (bits + 7) // 8)
+            os.replace(tmp, self.path)
+        self.fh_ = open(self.path, 'r+b')
+        self.map = mmap.mmap(self.fh_.fileno(), 0)
+        magic, self.bits, self.hashes = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('{} is not a seen-URL filter'.format(self.path))
+
+    @staticmethod
+    def size(capacity, error_rate):
+        '''
+        Return the number of bits and hashes needed to hold ``capacity`` URLs
+        with the given false positive rate
+        '''
+        capacity = max(capacity, 1)
+        bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        hashes = max(int(round(bits / capacity * math.log(2))), 1)
+        return bits, hashes
+
+    def _positions(self, url):
+        '''
+        Return the bits for a URL. Two 64-bit hashes are combined to make as
+        many as are needed, rather than hashing the URL over and over.
+        '''
+        digest = hashlib.blake2b(url.encode('utf-8', 'replace'), digest_size=16).digest()
+        first, second = struct.unpack('<QQ', digest)
+        for num in range(self.hashes):
+            yield (first + num * second) % self.bits
+
+    def add(self, url):
+        '''
+        Add a URL to the filter
+        '''
+        for pos in self._positions(url):
+            offset = HEADER.size + (pos >> 3)
+            self.map[offset] |= 1 << (pos & 7)
+
+    def __contains__(self, url):
+        '''
+        Whether the URL has probably been seen
+        '''
+        for pos in self._positions(url):
+            if not self.map[HEADER.size + (pos >> 3)] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def flush(self):
+        '''
+        Write the filter out to its file
+        '''
+        self.map.flush()
+
+    def close(self):
+        '''
+        Close the filter
+        '''
+        self.map.close()
+        self.fh_.close()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+'''
+Segmented downloads for Web Flayer
+
+Some media hosts limit how fast each connection may go. When ``segments`` is
+set, and a server says that it accepts ``Range`` requests, large files are
+split into that many segments, which are downloaded at the same time, each
+over its own connection. The first segment is read from the response that
+``status()`` was handed; the rest are requested in their own threads. Every
+segment is written straight into its place in a single preallocated file
+with ``os.pwrite()``, so no reassembly is needed afterwards.
+
+The segments which are still left to download are recorded in the
+``.part.json`` file, so that an interrupted download picks up each segment
+where it left off.
+
+Each segment thread has a session of its own, and its requests time out
+after ``segment_timeout`` seconds without a response, so that a stalled
+segment can't hold the download up forever.
+'''
+# Python
+import os
+import re
+import time
+import threading
+
+# Internal
+import flayer.session
+
+CHUNK_SIZE = 256 * 1024
+
+
+def split(start, end, count):
+    '''
+    Split the bytes from ``start`` up to ``end`` into ``count`` ranges, each
+    of which is a ``[position, end]`` list
+    '''
+    size = -(-(end - start) // count)
+    return [
+        [pos, min(pos + size, end)]
+        for pos in range(start, end, size)
+    ]
+
+
+def plan(req, part, offset, total, opts):
+    '''
+    Return the ranges to download a response in, or ``None`` if it should be
+    downloaded in one piece
+    '''
+    count = int(opts.get('segments') or 1)
+    if count < 2 or not total:
+        return None
+    if part and part.get('segments') and req.status_code == 206:
+        # Pick up the segments from the last attempt
+        ranges = [list(rng) for rng in part['segments'] if rng[0] < rng[1]]
+        if ranges and ranges[0][0] == offset:
+            return ranges
+    if total - offset < int(opts.get('segment_min_size', 16 * 1024 * 1024)):
+        return None
+    if req.status_code != 206 and req.headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return None
+    return split(offset, total, count)
+
+
+class Download(object):
+    '''
+    Download a set of ranges at the same time
+    '''
+    def __init__(self, req, url, fileno, ranges, validator, opts):
+        '''
+        Initialize. ``req`` is the response that the first range will be read
+        from, and ``validator`` is sent as ``If-Range`` for the others.
+        '''
+        self.req = req
+        self.url = url
+        self.fileno = fileno
+        self.ranges = ranges
+        self.validator = validator
+        self.opts = opts
+        self.timeout = float(opts.get('segment_timeout') or 60)
+        self.errors = []
+        self.stopped = threading.Event()
+        self.threads = []
+        # Held while writing, so that nothing is written once stop() is done
+        self._lock = threading.Lock()
+
+    def start(self):
+        '''
+        Start a thread for each range
+        '''
+        for index in range(len(self.ranges)):
+            thread = threading.Thread(target=self._run, args=(index,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def wait(self, timeout):
+        '''
+        Wait up to ``timeout`` seconds (or forever, if it is ``None``), and
+        return whether every range is finished
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self.threads:
+            if deadline is None:
+                thread.join()
+            else:
+                thread.join(max(deadline - time.time(), 0))
+            if thread.is_alive():
+                return False
+        return True
+
+    def stop(self):
+        '''
+        Ask every range to stop, and wait up to ``segment_timeout`` seconds for
+        them to do so. Returns whether they all did; any which didn't are left
+        to finish by themselves, but won't write anything more.
+        '''
+        with self._lock:
+            self.stopped.set()
+        return self.wait(self.timeout)
+
+    def count(self):
+        '''
+        Return the number of bytes that have been downloaded so far, counting
+        the bytes before each range that were already there
+        '''
+        remaining = sum(end - pos for pos, end in self.ranges)
+        return self.ranges[-1][1] - remaining
+
+    def remaining(self):
+        '''
+        Return the ranges which are not yet finished
+        '''
+        return [list(rng) for rng in self.ranges if rng[0] < rng[1]]
+
+    def complete(self):
+        '''
+        Whether every range has been downloaded
+        '''
+        return not self.errors and not self.remaining()
+
+    def _run(self, index):
+        '''
+        Download a range
+        '''
+        rng = self.ranges[index]
+        session = None
+        try:
+            if index == 0:
+                resp = self.req
+            else:
+                session = flayer.session.new(self.opts)
+                resp = self._request(session, rng)
+            try:
+                for block in resp.iter_content(CHUNK_SIZE):
+                    block = memoryview(block)[:rng[1] - rng[0]]
+                    with self._lock:
+                        if self.stopped.is_set():
+                            break
+                        os.pwrite(self.fileno, block, rng[0])
+                    rng[0] += len(block)
+                    if rng[0] >= rng[1]:
+                        break
+            finally:
+                if hasattr(resp, 'close'):
+                    resp.close()
+            if rng[0] < rng[1] and not self.stopped.is_set():
+                raise IOError('Segment ended {} bytes early'.format(rng[1] - rng[0]))
+        except Exception as exc:  # pylint: disable=broad-except
+            self.errors.append(exc)
+            # There's no point carrying on with the other segments
+            self.stopped.set()
+        finally:
+            if session is not None:
+                session.close()
+
+    def _request(self, session, rng):
+        '''
+        Request a range, and make sure the server sent back what we asked for
+        '''
+        headers = {'Range': 'bytes={}-{}'.format(rng[0], rng[1] - 1)}
+        if self.validator:
+            headers['If-Range'] = self.validator
+        resp = session.get(
+            self.url,
+            headers=headers,
+            stream=True,
+            timeout=self.timeout,
+        )
+        match = re.match(r'bytes (\d+)-', resp.headers.get('Content-Range', ''))
+        if resp.status_code != 206 or not match or int(match.group(1)) != rng[0]:
+            resp.close()
+            raise IOError('Server did not return bytes {}-{}'.format(rng[0], rng[1] - 1))
+        return resp
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+'''
+HTTP sessions for Web Flayer
+
+Each thread gets its own ``requests.Session``, which keeps connections alive
+between requests, so that hitting the same host over and over does not pay
+for a new TCP and TLS handshake every time. The ``headers`` and ``verify``
+options are applied to the session once, when it is created.
+'''
+# Python
+import threading
+
+_LOCAL = threading.local()
+
+
+def client(opts):
+    '''
+    Return the session for the current thread, creating it if necessary
+    '''
+    session = getattr(_LOCAL, 'session', None)
+    if session is None:
+        session = _LOCAL.session = new(opts)
+    return session
+
+
+def new(opts):
+    '''
+    Create a new session.
+
+    ``pool_size`` is the number of connections kept alive for each host, and
+    ``pool_hosts`` is the number of hosts to keep connections for. Specific
+    hosts may be given their own sizes with ``pool_sizes``, which is
+    a dictionary of host names and sizes, in the configuration file:
+
+    .. code-block:: yaml
+
+        pool_size: 10
+        pool_sizes:
+          en.wikipedia.org: 50
+    '''
+    import requests
+    import requests.adapters
+
+    session = requests.Session()
+    session.headers.update(opts.get('headers') or {})
+    session.verify = bool(opts.get('verify', True))
+
+    pool_size = int(opts.get('pool_size', 10))
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=int(opts.get('pool_hosts', 100)),
+        pool_maxsize=pool_size,
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    for host, size in (opts.get('pool_sizes') or {}).items():
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=int(size),
+        )
+        session.mount('http://{}/'.format(host), adapter)
+        session.mount('https://{}/'.format(host), adapter)
+
+    return session
@@ -6,20 +6,33 @@ Tools for Web Flayer
 import os
 import re
 import sys
+import json
+import hashlib
 import time
 import random
 import pprint
 import urllib
 
 # 3rd party
-import requests
 from termcolor import colored
 import psycopg2
-from psycopg2.extras import Json
-from bs4 import BeautifulSoup
+import psycopg2.extras
 
 # Internal
+import flayer.seen
 import flayer.event
+import flayer.blobs
+import flayer.canon
+import flayer.dispatch
+import flayer.links
+import flayer.document
+import flayer.session
+import flayer.segments
+import flayer.compress
+
+# Bounds for the size of the chunks that downloads are read in
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 1024 * 1024
 
 
 class Output(object):
@@ -61,17 +74,29 @@ class Output(object):
             print(colored(msg, self.opts.get('error_color', 'red'), attrs=['bold']))
 
 
-def process_url(url_uuid, url, content, parsers):
+def pre_flight(url, parsers):
     '''
-    Process a URL
+    Run a URL through the ``pre_flight()`` hooks of the parsers, which may
+    rewrite it, or supply its content so that it isn't downloaded. Returns
+    ``(url_uuid, url, content)``, where ``url_uuid`` is ``None`` if the URL
+    should still be downloaded; once a hook returns a ``url_uuid`` of ``0``,
+    the rest are skipped.
     '''
-    fun = None
-    for mod in parsers:
-        if fun is not None:
+    url_uuid = None
+    content = None
+    for hook in flayer.dispatch.index(parsers).pre_flight:
+        if isinstance(url_uuid, int) and url_uuid == 0:
             break
-        if not mod.endswith('.func_map'):
-            continue
-        fun = parsers[mod](url)
+        url_uuid, url, content = hook(url)
+    return url_uuid, url, content
+
+
+def process_url(url_uuid, url, content, parsers):
+    '''
+    Process a URL with the parser that it is routed to (see
+    ``flayer.dispatch``). Raises a ``TypeError`` if there isn't one.
+    '''
+    fun = flayer.dispatch.index(parsers).route(url)
     fun(url_uuid, url, content)
 
 
@@ -80,30 +105,53 @@ def get_url(
         parent=None,
         referer=None,
         dbclient=None,
-        client=requests,
+        client=None,
         opts=None,
         context=None,
     ):
     '''
-    Download a URL (if necessary) and store it
+    Download a URL (if necessary) and store it. Unless a ``client`` is passed
+    in, the current thread's keep-alive session will be used.
     '''
-    out = Output(opts)
+    url_uuid, content, _ = fetch_url(url, parent, referer, dbclient, client, opts, context)
+    return url_uuid, content
 
-    headers = opts['headers'].copy()
-    data = opts.get('data', None)
 
-    if referer:
-        headers['referer'] = referer
+def fetch_url(
+        url,
+        parent=None,
+        referer=None,
+        dbclient=None,
+        client=None,
+        opts=None,
+        context=None,
+    ):
+    '''
+    The same as ``get_url()``, but also returns whether the URL was refreshed
+    and found to be unchanged since it was last downloaded.
+
+    URLs which are queued with a ``refresh_interval`` are downloaded again
+    each time they come up, but conditionally: the ``ETag`` and
+    ``Last-Modified`` headers from the last download are sent back, and a
+    ``304 Not Modified`` means the cached copy is used. If the server doesn't
+    support that, the new body is compared with a hash of the old one.
+    '''
+    # requests is slow to import, and isn't needed by commands which don't
+    # download anything, so it is imported when it is first used
+    import requests
 
-    if flayer.db.check_domain_wait(dbclient, url) is False:
-        # We need to put this URL back into the queue
-        queue_urls([url], dbclient, opts)
-    flayer.db.pattern_wait(dbclient, url)
-    flayer.db.set_domain_wait(dbclient, opts, url)
+    out = Output(opts)
+
+    if client is None:
+        client = flayer.session.client(opts)
+
+    url = flayer.canon.canonicalize(url)
+    headers, data = prepare_request(url, referer, opts)
 
     wait = 0
     if opts.get('no_db_cache') is True:
-        # Skip all the DB stuff and just download the URL
+        # Skip all the DB stuff (except the waits) and just download the URL
+        flayer.db.finish_url(dbclient, opts, url)
         req = client.request(
             opts['method'],
             url,
@@ -118,66 +166,23 @@ def get_url(
         if opts['random_wait'] is True:
             wait = int(opts.get('wait', 10))
             time.sleep(random.randrange(1, wait))
-        if url not in opts['warned']:
-            opts['warned'].append(url)
-        return 0, content
+        opts['warned'].add(url)
+        return 0, content, False
 
-    cur = dbclient.cursor()
-    exists = False
-
-    # Check for URL in DB
-    cur.execute('''
-        SELECT uuid, url, last_retrieved
-        FROM urls
-        WHERE url = %s
-    ''', [url])
-
-    if cur.rowcount < 1:
-        # URL has never been retrieved
-        cur.execute('''
-            INSERT INTO urls
-            (url) VALUES (%s)
-            RETURNING uuid
-        ''', [url])
-        dbclient.commit()
-        url_uuid = cur.fetchone()[0]
-        out.action('{} has not been retrieved before, new UUID is {}'.format(url, url_uuid))
-    else:
-        # URL has been retrieved, get its UUID
-        url_uuid = cur.fetchone()[0]
-        out.warn('{} exists, UUID is {}'.format(url, url_uuid))
-        exists = True
-        if url not in opts['warned']:
-            opts['warned'].append(url)
+    url_uuid, exists, cached, refresh = lookup_url(url, parent, dbclient, opts)
+    unchanged = False
 
-    # Save referer relationships
-    if parent:
-        try:
-            cur.execute('''
-                INSERT INTO referers
-                (url_uuid, referer_uuid)
-                VALUES
-                (%s, %s)
-            ''', [url_uuid, parent])
-            dbclient.commit()
-        except psycopg2.IntegrityError:
-            # This relationship already exists
-            dbclient.rollback()
-
-    if opts['force_directories'] and not opts['save_path']:
-        opts['save_path'] = '.'
-
-    # Check for content
-    cur.execute('''
-        SELECT data, uuid
-        FROM content
-        WHERE url_uuid = %s
-        ORDER BY retrieved
-        LIMIT 1
-    ''', [url_uuid])
-    if cur.rowcount < 1:
+    if cached is None or cached[0] is None or refresh is True or opts['force'] is True:
+        if cached is not None and cached[0] is not None and opts['force'] is not True:
+            headers.update(conditional_headers(cached[2]))
         try:
             if opts['save_path']:
+                resume = resume_headers(_file_name(url, opts), url)
+                if resume:
+                    # A partial download can't also be conditional
+                    headers.pop('If-None-Match', None)
+                    headers.pop('If-Modified-Since', None)
+                    headers.update(resume)
                 req = client.request(
                     opts['method'],
                     url,
@@ -186,7 +191,9 @@ def get_url(
                     verify=bool(opts.get('verify', True)),
                     stream=True,
                 )
-                content, req_headers = _save_path(url, url_uuid, req, wait, opts, context, dbclient)
+                content, req_headers, blob = _save_path(
+                    url, url_uuid, req, wait, opts, context, dbclient
+                )
             else:
                 req = client.request(
                     opts['method'],
@@ -197,96 +204,201 @@ def get_url(
                 )
                 content = req.text
                 req_headers = req.headers
+                blob = None
         except requests.exceptions.ConnectionError as exc:
             out.error('Error downloading {}:'.format(url))
             out.error(exc)
-            return 0, ''
+            return 0, '', False
         except requests.exceptions.InvalidSchema as exc:
             out.error('Error downloading {}:'.format(url))
             out.error(exc)
-            return 0, ''
-        if url not in opts['warned']:
-            opts['warned'].append(url)
+            return 0, '', False
+        opts['warned'].add(url)
         if opts.get('include_headers') is True:
             out.info(pprint.pformat(dict(req_headers)))
-        if content:
-            cur.execute('''
-                    INSERT INTO content
-                    (url_uuid, data) VALUES (%s, %s)
-                ''',
-                [
-                    url_uuid,
-                    Json({
-                        'content': content.replace('\x00', ''),
-                        'status': req.status_code,
-                    })
-                ]
+        unchanged = opts['force'] is not True and is_unchanged(
+            cached, req.status_code, content, blob
+        )
+        if unchanged is True:
+            out.info('{} has not changed'.format(url))
+            content = cached[0]['content']
+            flayer.db.finish_url(dbclient, opts, url)
+        else:
+            store_content(
+                url, url_uuid, content, req.status_code, cached, dbclient, opts, req_headers, blob
             )
-            dbclient.commit()
     else:
-        if opts['force'] is True:
-            row_id = cur.fetchone()[1]
-            if opts['save_path']:
-                req = client.request(
-                    opts['method'],
-                    url,
-                    headers=headers,
-                    data=data,
-                    verify=bool(opts.get('verify', True)),
-                    stream=True,
-                )
-                content, req_headers = _save_path(url, url_uuid, req, wait, opts, context, dbclient)
-            else:
-                req = client.request(
-                    opts['method'],
-                    url,
-                    headers=headers,
-                    data=data,
-                    verify=bool(opts.get('verify', True)),
-                )
-                content = req.text
-                req_headers = req.headers
-            if url not in opts['warned']:
-                opts['warned'].append(url)
-            if opts.get('include_headers') is True:
-                out.info(pprint.pformat(dict(req_headers)))
-            if content:
-                cur.execute('''
-                        UPDATE content
-                        SET url_uuid = %s, data = %s
-                        WHERE uuid = %s
-                    ''',
-                    [
-                        url_uuid,
-                        Json({'content': content}),
-                        row_id
-                    ]
-                )
-                dbclient.commit()
-        else:
-            content = cur.fetchone()[0]['content']
-
-    flayer.db.pattern_wait(dbclient, url)
-    flayer.db.set_domain_wait(dbclient, opts, url)
+        content = cached[0]['content']
+        flayer.db.finish_url(dbclient, opts, url)
 
     if exists is False:
         if opts['random_wait'] is True:
             wait = int(opts.get('wait', 10))
             time.sleep(random.randrange(1, wait))
-    return url_uuid, content
+    return url_uuid, content, unchanged
 
 
-def _save_path(url, url_uuid, req, wait, opts, context, dbclient):
+def conditional_headers(validators):
     '''
-    Save the URL to a path
+    Return the headers which ask the server for a page only if it has changed
+    since the ``validators`` (from ``lookup_url()``) were stored
+    '''
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def is_unchanged(cached, status_code, content, blob=None):
+    '''
+    Whether a download turned out to be the same as the ``cached`` copy:
+    either the server said so with a ``304``, or the body has the same hash
+    '''
+    if cached is None or cached[0] is None:
+        return False
+    if status_code == 304:
+        return True
+    old_hash = cached[2].get('body_hash')
+    return old_hash is not None and old_hash == body_hash(content, blob)
+
+
+def body_hash(content, blob=None):
+    '''
+    Return the sha256 of a body, which is already known if it is in the blob
+    store
+    '''
+    if blob is not None:
+        return blob.digest
+    if not content:
+        return None
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def prepare_request(url, referer, opts):
+    '''
+    Return the headers and data to download a URL with
+    '''
+    headers = opts['headers'].copy()
+    data = opts.get('data', None)
+
+    if referer:
+        headers['referer'] = referer
+
+    return headers, data
+
+
+def lookup_url(url, parent, dbclient, opts):
+    '''
+    Look up (or create) the URL in the database, and return its UUID, whether
+    it already existed, the cached ``(data, uuid, validators)`` row from the
+    ``content`` table (or ``None`` if it has not been cached), and whether the
+    URL is queued to be refreshed. ``data`` may be ``None`` if the page is in
+    a blob store which is not available, and ``validators`` is a dict of the
+    ``etag``, ``last_modified`` and ``body_hash`` of the cached copy.
+
+    The waits for the URL are checked and set at the same time, all in one
+    round trip to the database.
+    '''
+    out = Output(opts)
+
+    row = flayer.db.begin_url(dbclient, opts, url, parent)
+    url_uuid = row['url_uuid']
+    exists = row['exists']
+
+    if row['waiting'] is True:
+        # We need to put this URL back into the queue
+        requeue_urls([url], dbclient, opts)
+
+    if exists is False:
+        out.action('{} has not been retrieved before, new UUID is {}'.format(url, url_uuid))
+    else:
+        out.warn('{} exists, UUID is {}'.format(url, url_uuid))
+        opts['warned'].add(url)
+
+    if opts['force_directories'] and not opts['save_path']:
+        opts['save_path'] = '.'
+
+    cached = None
+    if row['content_uuid'] is not None:
+        cached = (row['data'], row['content_uuid'], row['validators'])
+
+    return url_uuid, exists, cached, row['refresh']
+
+
+def store_content(
+        url,
+        url_uuid,
+        content,
+        status_code,
+        cached,
+        dbclient,
+        opts,
+        headers=None,
+        blob=None,
+    ):
+    '''
+    Store downloaded content in the database (compressed, if
+    ``content_compression`` is set), and update the waits for the URL. If
+    ``cached`` is the row that was returned from ``lookup_url()``, that row
+    will be updated instead.
+
+    If ``blob_store`` is set, the content is stored there instead, and only
+    its digest is stored in the database. If the body was already streamed
+    into the blob store, its ``blob`` should be passed in.
+    '''
+    blobs = flayer.blobs.store(opts)
+    if blob is None and content and blobs is not None:
+        blob = blobs.put(content.encode('utf-8'))
+
+    columns = None
+    if blob is not None:
+        columns = {
+            'status': status_code,
+            'headers': psycopg2.extras.Json(dict(headers or {})),
+            'digest': blob.digest,
+            'size': blob.size,
+        }
+    elif content:
+        columns = flayer.compress.pack(content, status_code, headers, opts)
+    if columns is not None:
+        headers = headers or {}
+        columns['etag'] = headers.get('ETag')
+        columns['last_modified'] = headers.get('Last-Modified')
+        columns['body_hash'] = body_hash(content, blob)
+    content_uuid = None
+    if cached is not None:
+        content_uuid = cached[1]
+    flayer.db.finish_url(dbclient, opts, url, url_uuid, columns, content_uuid)
+
+
+def _file_name(url, opts):
+    '''
+    Return the path that a URL will be saved to (before any renaming)
     '''
     urlcomps = urllib.parse.urlparse(url)
     if opts['force_directories']:
         newpath = urlcomps[2].lstrip('/')
-        file_name = os.path.join(opts['save_path'], urlcomps[1], newpath)
-    else:
-        file_name = os.path.join(opts['save_path'], urlcomps[2].split('/')[-1])
-    return status(req, url, url_uuid, file_name, wait, opts, context, dbclient)
+        return os.path.join(opts['save_path'], urlcomps[1], newpath)
+    return os.path.join(opts['save_path'], urlcomps[2].split('/')[-1])
+
+
+def _save_path(url, url_uuid, req, wait, opts, context, dbclient):
+    '''
+    Save the URL to a path
+    '''
+    file_name = _file_name(url, opts)
+    blob = None
+    blobs = flayer.blobs.store(opts)
+    if blobs is not None:
+        blob = blobs.writer()
+    content, req_headers = status(
+        req, url, url_uuid, file_name, wait, opts, context, dbclient, blob, waits=False
+    )
+    if blob is not None and blob.digest is None:
+        blob = None
+    return content, req_headers, blob
 
 
 def status(
@@ -298,10 +410,31 @@ def status(
         opts=None,
         context=None,
         dbclient=None,
+        blob=None,
+        waits=True,
+        urls=None,
     ):
     '''
     Show status of the download
+
+    The download is written to ``file_name`` with ``.part`` on the end, next
+    to a ``.part.json`` file which records how much has been downloaded, along
+    with the ``ETag`` and ``Last-Modified`` headers. Once the download is
+    complete, it is moved into place. If it is interrupted, the partial file
+    is kept, and if ``req`` was requested with the headers from
+    ``resume_headers()``, the next attempt picks up where it left off.
+
+    If a ``blob`` (from ``flayer.blobs``) is passed in, the download is
+    streamed into it, and ``file_name`` is linked to it once it is complete.
+
+    Plugins which make requests of their own (such as a second request to
+    the same host) call this directly, and the waits for the host are applied
+    before and after the download with ``hit_host()``; they should pass in
+    ``__urls__``, so that the crawl's ``HostScheduler`` sees the request.
+    ``fetch_url()`` applies the waits itself, so it passes ``waits=False``.
     '''
+    import requests
+
     out = Output(opts)
 
     if opts is None:
@@ -310,13 +443,22 @@ def status(
     if context is None:
         context = {}
 
+    if req.status_code == 304:
+        # Not modified since it was last downloaded
+        if blob is not None:
+            blob.abort()
+        return None, req.headers
+
+    # Partial downloads are named before renaming, so that they can be found
+    # again by the next attempt
+    part_name = file_name + '.part'
     file_name = _rename(media_url, file_name, opts)
 
-    cache_dir = '/'.join(file_name.split('/')[:-1])
-    try:
-        os.makedirs(cache_dir, mode=0o0755, exist_ok=True)
-    except PermissionError as exc:
-        out.error('Cannot create directory {}: {}'.format(cache_dir, exc))
+    for cache_dir in {os.path.dirname(file_name), os.path.dirname(part_name)}:
+        try:
+            os.makedirs(cache_dir, mode=0o0755, exist_ok=True)
+        except PermissionError as exc:
+            out.error('Cannot create directory {}: {}'.format(cache_dir, exc))
 
     is_text = False
     req_headers = req.headers
@@ -324,7 +466,6 @@ def status(
         if header.lower().startswith('content-type'):
             if req_headers[header].startswith('text'):
                 is_text = True
-    content = ''
 
     cur = dbclient.cursor()
     agent_id = opts.get('id', 'unknown')
@@ -336,8 +477,8 @@ def status(
     cur.execute('SELECT url FROM urls WHERE uuid = %s', [url_uuid])
     root_url = cur.fetchone()[0]
 
-    flayer.db.pattern_wait(dbclient, media_url)
-    flayer.db.set_domain_wait(dbclient, opts, media_url)
+    if waits is True:
+        hit_host(media_url, dbclient, opts, urls)
 
     out.action('Downloading: {}'.format(media_url))
     if os.path.exists(file_name):
@@ -345,24 +486,50 @@ def status(
             out.warn('... {} exists, overwriting'.format(file_name))
         else:
             out.warn('... {} exists, skipping'.format(file_name))
+            if blob is not None:
+                blob.abort()
+            cur.execute('DELETE FROM active_dl WHERE url_uuid = %s', [url_uuid])
             return None, {}
+
+    part = _read_part(part_name, media_url)
+    offset, total = _resume_offset(req, part)
+    if offset is None:
+        out.warn('... {} cannot be resumed, starting over'.format(file_name))
+        _remove_part(part_name)
+        requeue_urls([media_url], dbclient, opts)
+        if blob is not None:
+            blob.abort()
+        cur.execute('DELETE FROM active_dl WHERE url_uuid = %s', [url_uuid])
+        return None, {}
+    part = {
+        'url': media_url,
+        'etag': req.headers.get('ETag') or (part or {}).get('etag'),
+        'last_modified': req.headers.get('Last-Modified') or (part or {}).get('last_modified'),
+        'length': total,
+        'offset': offset,
+        'segments': (part or {}).get('segments') if offset else None,
+    }
+
     if not opts['daemon']:
         sys.stdout.write(colored('...Saving to: ', 'green'))
     out.info(file_name)
-    buffer_size = 4096
-    total = int(req.headers.get('Content-Length', 0))
-    count = 0
-    try:
-        point = int(total / 100)
-        #increment = int(total / buffer_size)
-    except ZeroDivisionError:
-        out.error('Divide by zero error, status not available')
-        point = 0
-        #increment = 0
-    start_time = time.time()
-    last_time = time.time()
-    delay_blocks = 0
-    delay_count = 0
+    if offset:
+        out.info('... resuming from {}'.format(sizeof_fmt(offset)))
+    chunk_size = _chunk_size(total)
+    # Text is collected as bytes, and only decoded once it is all here
+    body = None
+    if is_text is True:
+        body = bytearray()
+        if offset:
+            with open(part_name, 'rb') as fh_:
+                body += fh_.read(offset)
+    count = offset
+    start_time = last_time = time.time()
+    last_count = offset
+    # Rather than looking at the clock for every chunk, guess how many bytes
+    # will arrive before it's time to update the progress again
+    next_sample = offset + chunk_size
+    failed = False
 
     context['dl_data'] = {
         'url': root_url,
@@ -375,92 +542,117 @@ def status(
         'kbsec': 0,
     }
     flayer.event.fire('flayer/{}/download'.format(opts['id']), {root_url: 'started'}, opts)
+    ranges = None
+    if is_text is False:
+        ranges = flayer.segments.plan(req, part, offset, total, opts)
+    if not ranges:
+        part.pop('segments')
+    _write_part(part_name, part)
     try:
-        with open(file_name, 'wb') as fhp:
-            #old_time = time.time()
-            try:
-                for block in req.iter_content(buffer_size):
-                    if opts.get('hard_stop'):
-                        queue_urls([media_url], dbclient, opts)
-                        break
-                    if opts.get('abort'):
-                        break
-                    if is_text is True:
-                        content += str(block)
-                    fhp.write(block)
-                    count += buffer_size
-                    delay_blocks += buffer_size
-                    delay_count += 1
-                    #old_time = time.time()
-                    time_delay = time.time() - last_time
-                    if time_delay >= float(1):
-                        last_time = time.time()
-                        try:
-                            blocks_left = int((total - count) / buffer_size)
-                        except ZeroDivisionError:
-                            blocks_left = 0
-                        kbsec = (buffer_size / 1024) * delay_count
-                        try:
-                            seconds_left = ((blocks_left * buffer_size) / 1024) / kbsec
-                        except ZeroDivisionError:
-                            seconds_left = 0
-                        minutes_left = int(seconds_left / 60)
-                        minsecs_left = seconds_left % 60
-                        time_left = '%d:%02d' % (minutes_left, minsecs_left)
-                        seconds_elapsed = time.time() - start_time
-                        seconds_total = seconds_elapsed + seconds_left
-                        minutes_total = int(seconds_total / 60)
-                        minsecs_total = int(seconds_total % 60)
-                        time_total = '%d:%02d' % (minutes_total, minsecs_total)
-                        try:
-                            percent = int(count / point)
-                        except ZeroDivisionError:
-                            percent = 0
-                        context['dl_data']['bytes_total']   = total  # pylint: disable=bad-whitespace
-                        context['dl_data']['bytes_elapsed'] = count  # pylint: disable=bad-whitespace
-                        context['dl_data']['time_total']    = time_total  # pylint: disable=bad-whitespace
-                        context['dl_data']['time_left']     = time_left  # pylint: disable=bad-whitespace
-                        context['dl_data']['kbsec']         = kbsec  # pylint: disable=bad-whitespace
-                        if not opts['daemon']:
-                            sys.stdout.write('\x1b[2K\r')
-                            sys.stdout.write(
-                                colored('Total size is {} '.format(sizeof_fmt(total)), 'green'))
-                            sys.stdout.write(colored('({} bytes), '.format(total), 'green'))
-                            sys.stdout.write(colored('{}%, '.format(str(percent)), 'cyan'))
-                            sys.stdout.write(colored(kbsec, 'cyan'))
-                            sys.stdout.write(colored(' KiB/s, ', 'cyan'))
-                            sys.stdout.write(colored('{}/{} left'.format(time_left, time_total), 'cyan'))
-                            sys.stdout.flush()
-                        delay_blocks = 0
-                        delay_count = 0
-            except OSError as exc:
-                out.error('OS Error: {}'.format(exc))
-                out.error('Media URL: {}'.format(media_url))
-            except ProtocolError as exc:
-                out.error('Protocol Error: {}'.format(exc))
-                out.error('Media URL: {}'.format(media_url))
-            except Exception as exc:
-                out.error('Exception: {}'.format(exc))
-                out.error('Media URL: {}'.format(media_url))
+        if ranges:
+            if blob is not None:
+                # The blob will be hashed once all of the segments are in
+                blob.abort()
+            count, failed = _download_segments(
+                req, media_url, part_name, part, ranges, opts, context, dbclient
+            )
+        else:
+            if blob is not None:
+                blob.resume(part_name, offset)
+            with blob if blob is not None else _open_part(part_name, offset) as fhp:
+                preallocated = _preallocate(fhp, total)
+                try:
+                    for block in req.iter_content(chunk_size):
+                        fhp.write(block)
+                        if body is not None:
+                            body += block
+                        count += len(block)
+                        if count < next_sample:
+                            continue
+                        if opts.get('hard_stop'):
+                            requeue_urls([media_url], dbclient, opts)
+                            break
+                        if opts.get('abort'):
+                            break
+                        now = time.time()
+                        elapsed = max(now - last_time, .001)
+                        rate = (count - last_count) / elapsed
+                        if elapsed < 1:
+                            next_sample = count + max(int(rate * (1 - elapsed)), chunk_size)
+                            continue
+                        _progress(context, opts, total, count, now - start_time, rate)
+                        fhp.flush()
+                        part['offset'] = count
+                        _write_part(part_name, part)
+                        last_time = now
+                        last_count = count
+                        next_sample = count + max(int(rate), chunk_size)
+                except requests.exceptions.RequestException as exc:
+                    # This is a subclass of OSError, so it has to come first
+                    failed = True
+                    out.error('Protocol Error: {}'.format(exc))
+                    out.error('Media URL: {}'.format(media_url))
+                except OSError as exc:
+                    failed = True
+                    out.error('OS Error: {}'.format(exc))
+                    out.error('Media URL: {}'.format(media_url))
+                except Exception as exc:
+                    failed = True
+                    out.error('Exception: {}'.format(exc))
+                    out.error('Media URL: {}'.format(media_url))
+                if preallocated is True and count < total:
+                    fhp.truncate(count)
     except OSError as exc:
-        out.error('There was an error opening {}: {}'.format(file_name, exc))
+        failed = True
+        out.error('There was an error opening {}: {}'.format(part_name, exc))
 
     del context['dl_data']
 
-    if opts.get('hard_stop') or opts.get('abort'):
-        os.remove(file_name)
-
-    if is_text is True and opts.get('save_html', True) is False:
+    complete = (
+        not failed
+        and not opts.get('hard_stop')
+        and not opts.get('abort')
+        and count >= total
+    )
+    if complete is True:
+        if blob is not None:
+            if ranges:
+                blob.adopt(part_name)
+            blob.commit()
+            blob.copy(file_name)
+        else:
+            os.replace(part_name, file_name)
+        _remove_part(part_name)
+    elif opts.get('abort'):
+        if blob is not None:
+            blob.abort()
+        _remove_part(part_name, keep=False)
+    else:
+        # Keep what we have, and pick it up again next time
+        if not ranges:
+            part['offset'] = count
+        _write_part(part_name, part)
+        out.warn('... {} of {} saved to {}'.format(
+            sizeof_fmt(count), sizeof_fmt(total), part_name
+        ))
+        if count > offset and not opts.get('hard_stop'):
+            requeue_urls([media_url], dbclient, opts)
+
+    if is_text is True and opts.get('save_html', True) is False and os.path.lexists(file_name):
         os.remove(file_name)
 
-    if not content:
-        content = None
+    content = None
+    if body and complete is True:
+        try:
+            content = body.decode(getattr(req, 'encoding', None) or 'utf-8', 'replace')
+        except LookupError:
+            content = body.decode('utf-8', 'replace')
 
     cur.execute('DELETE FROM active_dl WHERE url_uuid = %s', [url_uuid])
     flayer.event.fire('flayer/{}/download'.format(opts['id']), {root_url: 'complete'}, opts)
 
-    flayer.db.pattern_wait(dbclient, media_url)
-    flayer.db.set_domain_wait(dbclient, opts, media_url)
+    if waits is True:
+        hit_host(media_url, dbclient, opts, urls)
 
     if not opts['daemon']:
         print()
@@ -469,6 +661,230 @@ def status(
     return content, req_headers
 
 
+def hit_host(url, dbclient, opts, urls=None):
+    '''
+    Apply the waits for a request to a URL's host which was not made by
+    ``fetch_url()``: any matching ``pattern_wait``, and the ``domain_wait``.
+    If the crawl's frontier is passed in as ``urls``, and its scheduler is
+    keeping track of the waits, the scheduler is told about the request.
+    Otherwise (in a parse process, say) the wait is written to the
+    ``domain_wait`` table, where the scheduler will find it when it syncs.
+    '''
+    scheduler = getattr(urls, 'scheduler', None)
+    if opts.get('local_domain_wait') is True and scheduler is not None:
+        scheduler.hit(urllib.parse.urlparse(url)[1])
+    else:
+        opts = dict(opts, local_domain_wait=False)
+    flayer.db.finish_url(dbclient, opts, url)
+
+
+def resume_headers(file_name, url):
+    '''
+    Return the headers needed to resume a partial download of ``url`` to
+    ``file_name``, or an empty dict if there isn't one. Downloads are only
+    resumed if the server gave us a strong ``ETag`` or a ``Last-Modified``
+    header, which is sent back as ``If-Range``, so that a file which has
+    changed since is downloaded from the start instead.
+    '''
+    part = _read_part(file_name + '.part', url)
+    if part is None or not part['offset']:
+        return {}
+    validator = part.get('etag')
+    if not validator or validator.startswith('W/'):
+        validator = part.get('last_modified')
+    if not validator:
+        return {}
+    return {
+        'Range': 'bytes={}-'.format(part['offset']),
+        'If-Range': validator,
+    }
+
+
+def _read_part(part_name, url):
+    '''
+    Return the metadata for a partial download of ``url``, or ``None`` if
+    there isn't one
+    '''
+    try:
+        with open(part_name + '.json', 'r') as fh_:
+            part = json.load(fh_)
+    except (OSError, ValueError):
+        return None
+    if part.get('url') != url:
+        return None
+    try:
+        if os.path.getsize(part_name) < part.get('offset', 0):
+            return None
+    except OSError:
+        return None
+    return part
+
+
+def _write_part(part_name, part):
+    '''
+    Save the metadata for a partial download
+    '''
+    with open(part_name + '.json.tmp', 'w') as fh_:
+        json.dump(part, fh_)
+    os.replace(part_name + '.json.tmp', part_name + '.json')
+
+
+def _remove_part(part_name, keep=True):
+    '''
+    Remove the metadata for a partial download, and the partial file itself
+    unless ``keep`` is set (because it has already been moved into place)
+    '''
+    paths = [part_name + '.json']
+    if keep is False:
+        paths.append(part_name)
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _resume_offset(req, part):
+    '''
+    Work out where a response picks up from, and the total size of the
+    download. Returns an offset of ``None`` if the response can't be used to
+    resume the partial download.
+    '''
+    length = int(req.headers.get('Content-Length') or 0)
+    if req.status_code == 416:
+        return None, 0
+    if req.status_code != 206:
+        return 0, length
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', req.headers.get('Content-Range', ''))
+    if not match or part is None or int(match.group(1)) != part['offset']:
+        return None, 0
+    offset = int(match.group(1))
+    if match.group(2) != '*':
+        return offset, int(match.group(2))
+    return offset, offset + length
+
+
+def _open_part(part_name, offset):
+    '''
+    Open a partial download for writing, keeping the first ``offset`` bytes
+    '''
+    if not offset:
+        return open(part_name, 'wb')
+    fhp = open(part_name, 'r+b')
+    fhp.truncate(offset)
+    fhp.seek(offset)
+    return fhp
+
+
+def _download_segments(req, media_url, part_name, part, ranges, opts, context, dbclient):
+    '''
+    Download a file in several segments at once (see ``flayer.segments``).
+    Returns the number of bytes that have been downloaded, and whether any of
+    the segments failed. The segments which are left are recorded in
+    ``part``.
+    '''
+    out = Output(opts)
+    total = ranges[-1][1]
+    validator = part.get('etag')
+    if not validator or validator.startswith('W/'):
+        validator = part.get('last_modified')
+
+    mode = 'r+b' if os.path.exists(part_name) else 'w+b'
+    with open(part_name, mode) as fhp:
+        _preallocate(fhp, total)
+        download = flayer.segments.Download(
+            req, media_url, fhp.fileno(), ranges, validator, opts
+        )
+        out.info('... in {} segments'.format(len(ranges)))
+        download.start()
+        start_time = last_time = time.time()
+        last_count = download.count()
+        while not download.wait(1):
+            if opts.get('hard_stop'):
+                requeue_urls([media_url], dbclient, opts)
+                download.stop()
+                break
+            if opts.get('abort'):
+                download.stop()
+                break
+            now = time.time()
+            count = download.count()
+            rate = (count - last_count) / max(now - last_time, .001)
+            _progress(context, opts, total, count, now - start_time, rate)
+            _segments_left(part, download, total)
+            _write_part(part_name, part)
+            last_time = now
+            last_count = count
+
+    for exc in download.errors:
+        out.error('Segment Error: {}'.format(exc))
+        out.error('Media URL: {}'.format(media_url))
+    _segments_left(part, download, total)
+    return download.count(), bool(download.errors)
+
+
+def _segments_left(part, download, total):
+    '''
+    Record the segments which are left to download in a partial download's
+    metadata. A plain ``Range`` request picks up from the start of the first
+    one.
+    '''
+    part['segments'] = download.remaining()
+    part['offset'] = part['segments'][0][0] if part['segments'] else total
+
+
+def _chunk_size(total):
+    '''
+    Pick the chunk size for a download: larger downloads are read in larger
+    chunks, between MIN_CHUNK and MAX_CHUNK
+    '''
+    return min(max(total // 64, MIN_CHUNK), MAX_CHUNK)
+
+
+def _preallocate(fhp, total):
+    '''
+    Reserve space for a download whose size is known, so that the file is not
+    fragmented while it grows. Returns whether the space was reserved.
+    '''
+    if total <= 0 or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(fhp.fileno(), 0, total)
+    except OSError:
+        return False
+    return True
+
+
+def _progress(context, opts, total, count, seconds_elapsed, rate):
+    '''
+    Update the progress of a download in the context, and show it
+    '''
+    kbsec = round(rate / 1024, 1)
+    seconds_left = 0
+    if rate and total > count:
+        seconds_left = (total - count) / rate
+    time_left = '%d:%02d' % (int(seconds_left / 60), seconds_left % 60)
+    seconds_total = seconds_elapsed + seconds_left
+    time_total = '%d:%02d' % (int(seconds_total / 60), int(seconds_total % 60))
+    percent = 0
+    if total:
+        percent = int(count * 100 / total)
+    context['dl_data']['bytes_total']   = total  # pylint: disable=bad-whitespace
+    context['dl_data']['bytes_elapsed'] = count  # pylint: disable=bad-whitespace
+    context['dl_data']['time_total']    = time_total  # pylint: disable=bad-whitespace
+    context['dl_data']['time_left']     = time_left  # pylint: disable=bad-whitespace
+    context['dl_data']['kbsec']         = kbsec  # pylint: disable=bad-whitespace
+    if not opts['daemon']:
+        sys.stdout.write('\x1b[2K\r')
+        sys.stdout.write(colored('Total size is {} '.format(sizeof_fmt(total)), 'green'))
+        sys.stdout.write(colored('({} bytes), '.format(total), 'green'))
+        sys.stdout.write(colored('{}%, '.format(str(percent)), 'cyan'))
+        sys.stdout.write(colored(kbsec, 'cyan'))
+        sys.stdout.write(colored(' KiB/s, ', 'cyan'))
+        sys.stdout.write(colored('{}/{} left'.format(time_left, time_total), 'cyan'))
+        sys.stdout.flush()
+
+
 def sizeof_fmt(num, suffix='B'):
     '''
     Show human-readable sizes
@@ -480,7 +896,7 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s " % (num, 'Yi', suffix)
 
 
-def dbsave_media(cur, media_url, url_uuid, file_name, dbclient):
+def dbsave_media(cur, media_url, url_uuid, file_name, dbclient, opts=None):
     '''
     Save a media item into the database, once it's been downloaded
 
@@ -491,19 +907,32 @@ def dbsave_media(cur, media_url, url_uuid, file_name, dbclient):
     url_uuid: The UUID of the parent of the media_url
 
     file_name: The place where the media_url was downloaded to
+
+    opts: The running opts, so that a new media_url can be added to the
+    ``seen_filter``
+
+    Nothing is saved unless the download is complete; partial downloads are
+    kept as ``file_name`` with ``.part`` on the end, so until then,
+    ``file_name`` does not exist.
     '''
+    if not os.path.exists(file_name) or os.path.exists(file_name + '.part'):
+        return
+    media_url = flayer.canon.canonicalize(media_url)
+    media_hash = flayer.canon.url_hash(media_url)
     try:
         cur.execute('''
-            INSERT INTO urls (url) values (%s) RETURNING uuid
-        ''', [media_url])
+            INSERT INTO urls (url, url_hash) values (%s, %s) RETURNING uuid
+        ''', [media_url, media_hash])
         dbclient.commit()
         new_id = cur.fetchone()[0]
+        if opts is not None:
+            flayer.seen.add(opts, media_url)
     except psycopg2.IntegrityError:
         # This relationship already exists
         dbclient.rollback()
         cur.execute('''
-            SELECT uuid FROM urls WHERE url = %s
-        ''', [media_url])
+            SELECT uuid FROM urls WHERE url_hash = %s AND url = %s
+        ''', [media_hash, media_url])
         new_id = cur.fetchone()[0]
 
     try:
@@ -530,78 +959,51 @@ def dbsave_media(cur, media_url, url_uuid, file_name, dbclient):
 
 def queue_urls(links, dbclient, opts):
     '''
-    Check the database for any queued URLS, and add to the list
+    Add URLs to the download queue. URLs are sent to the database in batches
+    of ``queue_batch_size``, and unless ``force`` is set, URLs which have
+    already been downloaded are skipped.
+
+    Returns an estimate of the number of URLs now in the queue.
     '''
     out = Output(opts)
 
-    cur = dbclient.cursor()
     if isinstance(links, str):
         links = [links]
-    for url in links:
-        if opts.get('force') is not True and not opts.get('queue_id'):
-            # Check for URL in DB
-            cur.execute('''
-                SELECT uuid
-                FROM urls
-                WHERE url = %s
-            ''', [url])
-            if cur.rowcount > 0:
-                if url not in opts['warned']:
-                    out.info('URL has already been downloaded; use --force if necessary')
-                else:
-                    if url not in opts['warned']:
-                        opts['warned'].append(url)
-                continue
-
-        fields = ['url']
-        args = [url]
-        if opts.get('queue_id') is not None:
-            fields.append('uuid')
-            args.append(opts['queue_id'])
 
-        if 'refresh_interval' in opts:
-            fields.append('refresh_interval')
-            args.append(opts['refresh_interval'])
+    if 'overwrite' not in opts:
+        opts['overwrite'] = False
 
-        if 'overwrite' not in opts:
-            opts['overwrite'] = False
+    batch_size = int(opts.get('queue_batch_size', 1000))
+    skip_existing = opts.get('force') is not True
 
-        fields.append('overwrite')
-        args.append(opts['overwrite'])
-
-        query = 'INSERT INTO dl_queue ({}) VALUES ({})'.format(
-            ', '.join(fields),
-            ', '.join(['%s' for arg in range(len(args))])
+    skipped = 0
+    batch = []
+    for url in links:
+        url = url.strip()
+        if not url:
+            continue
+        batch.append(flayer.canon.canonicalize(url))
+        if len(batch) >= batch_size:
+            skipped += len(batch) - flayer.db.queue_batch(dbclient, opts, batch, skip_existing)
+            batch = []
+    if batch:
+        skipped += len(batch) - flayer.db.queue_batch(dbclient, opts, batch, skip_existing)
+
+    if skipped and skip_existing:
+        out.info(
+            '{} URL(s) already downloaded or queued; use --force if necessary'.format(skipped)
         )
-
-        try:
-            cur.execute(query, args)
-            dbclient.commit()
-        except psycopg2.IntegrityError:
-            # This URL is already queued
-            dbclient.rollback()
-    cur.execute('SELECT count(*) FROM dl_queue')
-    return cur.fetchone()[0]
+    return flayer.db.queue_size(dbclient)
 
 
-def reprocess_urls(urls, patterns, dbclient=None):
+def requeue_urls(links, dbclient, opts):
     '''
-    Reprocess the cached URLs which matches the pattern(s)
+    Put URLs which could not be downloaded yet back into the download queue.
+    ``begin_url()`` has already added them to ``urls`` by then, so unlike
+    ``queue_urls()``, this doesn't skip URLs which have been seen before.
     '''
-    if not urls:
-        urls = []
-
-    if isinstance(patterns, str):
-        patterns = [patterns]
-
-    cur = dbclient.cursor()
-    wheres = ['url~%s'] * len(patterns)
-    query = 'SELECT url FROM urls WHERE {}'.format(' OR '.join(wheres))
-    cur.execute(query, patterns)
-    for row in cur.fetchall():
-        urls.append(row[0])
-
-    return urls
+    links = [flayer.canon.canonicalize(url) for url in links]
+    return flayer.db.queue_batch(dbclient, opts, links, skip_existing=False)
 
 
 def queue_regexp(urls, pattern, dbclient, opts):
@@ -659,14 +1061,23 @@ def _rename(media_url, file_name, opts):
 
 def parse_links(url, content, level, opts):
     '''
-    Return the links from an HTML page
+    Return the links from an HTML page, using the extractor chosen with
+    ``link_extractor``. The ``soup`` extractor is implemented here, and the
+    ``fast`` one in ``flayer.links``. Rendering a page needs the soup.
     '''
+    if opts.get('link_extractor', 'fast') == 'fast' and opts.get('render', False) is not True:
+        return flayer.links.extract(url, content, level, opts)
+
     out = Output(opts)
 
     hrefs = []
     try:
         # Get ready to do some html parsing
-        soup = BeautifulSoup(content, 'html.parser')
+        if isinstance(content, flayer.document.Document):
+            soup = content.soup
+        else:
+            from bs4 import BeautifulSoup
+            soup = BeautifulSoup(content, 'html.parser')
         # Generate absolute URLs for every link on the page
         url_comps = urllib.parse.urlparse(url)
         tags = soup.find_all('a')
@@ -686,7 +1097,7 @@ def parse_links(url, content, level, opts):
             if opts['span_hosts'] is not True:
                 if not link_comps[1].startswith(url_comps[1].split(':')[0]):
                     continue
-            hrefs.append(href.split('#')[0])
+            hrefs.append(flayer.canon.canonicalize(href))
         # Render the page, and print it along with the links
         if opts.get('render', False) is True:
             out.info(soup.get_text())
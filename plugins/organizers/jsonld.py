@@ -2,9 +2,9 @@
 '''
 Web Flayer organizer module for JSON-LD
 '''
-import json
-from bs4 import BeautifulSoup
 import flayer.tools
+import flayer.jsonld
+import flayer.document
 
 
 def organize(url):
@@ -16,13 +16,9 @@ def organize(url):
     )
 
     types = set()
-    soup = BeautifulSoup(content, 'html.parser')
-    for tag in soup.find_all('script', attrs={'type': 'application/ld+json'}):
-        for data in tag:
-            try:
-                script = json.loads(data)
-                types.add(script['@type'])
-            except json.decoder.JSONDecodeError as exc:
-                types.add(exc)
+    document = flayer.document.Document.wrap(content, url, __opts__)
+    for entity in document.jsonld.entities:
+        types.update(flayer.jsonld.types(entity))
+    types.update(document.jsonld_errors)
 
     return list(types)
@@ -9,15 +9,14 @@ In order to use this plugin, a ``jsonld_domains`` table needs to be created:
     create table jsonld_domains (domain text unique);
 '''
 # Python
-import json
 import urllib
 
 # 3rd party
 import requests
-from bs4 import BeautifulSoup
 
 # Internal
 import flayer.tools
+import flayer.document
 
 
 def organize(url):
@@ -33,7 +32,7 @@ def organize(url):
     '''
 
     try:
-        req = requests.get(url)
+        req = __session__.get(url)
         content = req.text
     except requests.exceptions.MissingSchema as exc:
         return []
@@ -41,29 +40,19 @@ def organize(url):
         return []
     except requests.exceptions.SSLError:
         out.warn('SSL Error with {}, trying again without verification'.format(url))
-        req = requests.get(url, verify=False)
+        req = __session__.get(url, verify=False)
         content = req.text
 
-    soup = BeautifulSoup(content, 'html.parser')
+    document = flayer.document.Document(content, url, __opts__)
     if 'jsonld_domains' not in __context__:
         __context__['jsonld_domains'] = []
-    for tag in soup.find_all('script', attrs={'type': 'application/ld+json'}):
-        for data in tag:
-            try:
-                script = json.loads(data)
-                try:
-                    script_type = script['@type'].lower()
-                except (AttributeError, KeyError, TypeError):
-                    return []
-                if script_type == 'recipe':
-                    url_comps = urllib.parse.urlparse(url)
-                    netloc = url_comps[1].split(':')[0]
-                    cur.execute(insert_sql, [netloc])
-                    __dbclient__.commit()
-                    if netloc not in __context__['jsonld_domains']:
-                        __context__['jsonld_domains'].append(netloc)
-                    flayer.tools.queue_urls(url, __dbclient__, __opts__)
-                    return 'Queueing for download: {}'.format(url)
-            except json.decoder.JSONDecodeError as exc:
-                pass
+    if document.jsonld.of_type('Recipe'):
+        url_comps = urllib.parse.urlparse(url)
+        netloc = url_comps[1].split(':')[0]
+        cur.execute(insert_sql, [netloc])
+        __dbclient__.commit()
+        if netloc not in __context__['jsonld_domains']:
+            __context__['jsonld_domains'].append(netloc)
+        flayer.tools.queue_urls(url, __dbclient__, __opts__)
+        return 'Queueing for download: {}'.format(url)
     return []
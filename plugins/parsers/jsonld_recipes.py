@@ -12,12 +12,12 @@ import os
 import json
 import html
 import flayer.tools
-from bs4 import BeautifulSoup
+import flayer.document
 
 
-def func_map(url):
+def routes():
     '''
-    Function map
+    Route every domain which is known to use JSON-LD recipes
     '''
     domains = __context__.get('jsonld_domains')
     if domains is None:
@@ -28,24 +28,27 @@ def func_map(url):
             domains.append(row[0])
         __context__['jsonld_domains'] = domains
 
-    for domain in domains:
-        if domain in url:
-            return parse_page
-    return None
+    return [('host', domain, parse_page) for domain in domains]
 
 
-def parse_page(url_uuid, url, content):
+def routes_key():
+    '''
+    Build the routes again when the organizer finds a new domain, or when the
+    domains are dropped from the context, to be read from the database again
+    '''
+    domains = __context__.get('jsonld_domains')
+    return id(domains), len(domains or ())
+
+
+def parse_page(url_uuid, url, document):
     '''
     Route a page with primary data stored in json
     '''
-    soup = BeautifulSoup(content, 'html.parser')
-    for tag in soup.find_all('script', attrs={'type': 'application/ld+json'}):
-        for content in tag:
-            script = json.loads(content)
-            if script['@type'].lower() == 'recipe':
-                parse_recipe(url, content, script)
-            if script['@type'].lower() == 'itemlist':
-                parse_list(script['itemListElement'])
+    document = flayer.document.Document.wrap(document, url, __opts__)
+    for recipe in document.jsonld.of_type('Recipe'):
+        parse_recipe(url, document, recipe)
+    for item_list in document.jsonld.of_type('ItemList'):
+        parse_list(item_list.get('itemListElement', []))
 
 
 def parse_list(list_element):
@@ -54,7 +57,8 @@ def parse_list(list_element):
     '''
     urls = []
     for item in list_element:
-        urls.append(item['url'])
+        if isinstance(item, dict) and item.get('url'):
+            urls.append(item['url'])
     flayer.tools.queue_urls(urls, __dbclient__, __opts__)
 
 
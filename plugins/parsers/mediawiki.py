@@ -15,17 +15,14 @@ used to abuse the Wikipedia service.
 If you like Wikipedia, please consider donating to help keep it alive. You can
 donate at https://donate.wikimedia.org/.
 '''
-import requests
 import flayer.tools
 
 
-def func_map(url):
+def routes():
     '''
-    Function map
+    Route any URL which mentions wikipedia
     '''
-    if 'wikipedia' in url:
-        return wikipedia_raw
-    return None
+    return [('regex', 'wikipedia', wikipedia_raw)]
 
 
 def wikipedia_raw(url_uuid, url, content):
@@ -35,7 +32,7 @@ def wikipedia_raw(url_uuid, url, content):
     cache_path = __opts__.get('wikipedia_cache_path', '.')
     title = url.split('?')[0].split('/')[-1]
     file_name = '{}/{}'.format(cache_path, title)
-    req = requests.get(url, stream=True, params={'action': 'raw'})
+    req = __session__.get(url, stream=True, params={'action': 'raw'})
     flayer.tools.status(
         req,
         url,
@@ -44,4 +41,5 @@ def wikipedia_raw(url_uuid, url, content):
         dbclient=__dbclient__,
         opts=__opts__,
         context=__context__,
+        urls=__urls__,
     )
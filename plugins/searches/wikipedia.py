@@ -2,7 +2,6 @@
 '''
 Web Flayer search module for Wikipedia
 '''
-import requests
 from bs4 import BeautifulSoup
 
 
@@ -13,7 +12,7 @@ def search(opts):
     query = opts['search'][1].replace(' ', '+')
     url = ('https://en.wikipedia.org/w/index.php?search={}'
            '&title=Special:Search&profile=default&fulltext=1').format(query)
-    req = requests.get(url)
+    req = __session__.get(url)
 
     soup = BeautifulSoup(req.text, 'html.parser')
     urls = set()
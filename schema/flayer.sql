@@ -3,6 +3,7 @@ CREATE EXTENSION "uuid-ossp";
 CREATE TABLE urls (
     uuid uuid not null default uuid_generate_v4(),
     url text,
+    url_hash bigint,
     name text,
     last_retrieved timestamp without time zone DEFAULT now(),
     primary key (uuid)
@@ -11,6 +12,7 @@ CREATE TABLE urls (
 CREATE TABLE url_metadata (
     uuid uuid,
     url text,
+    url_hash bigint,
     metadata jsonb,
     primary key (url)
 );
@@ -20,6 +22,15 @@ CREATE TABLE content (
     url_uuid uuid,
     retrieved timestamp without time zone DEFAULT now(),
     data jsonb,
+    body bytea,
+    encoding text,
+    status integer,
+    headers jsonb,
+    digest text,
+    size bigint,
+    etag text,
+    last_modified text,
+    body_hash text,
     cache_path text,
     primary key (uuid)
 );
@@ -33,17 +44,19 @@ CREATE TABLE referers (
 CREATE TABLE dl_queue (
     uuid uuid not null default uuid_generate_v4(),
     url text,
+    url_hash bigint,
     dl_order integer NOT NULL default 1000000,
     paused boolean NOT NULL default FALSE,
     paused_until timestamp,
     refresh_interval jsonb,
-    primary key (uuid)
     added timestamp default now(),
     overwrite boolean NOT NULL default FALSE,
+    primary key (uuid)
 );
 
 CREATE TABLE active_dl (
     uuid uuid not null default uuid_generate_v4(),
+    url_uuid uuid,
     started_at timestamp default now(),
     started_by text,
     primary key (uuid)
@@ -62,3 +75,40 @@ CREATE TABLE domain_wait (
     wait_until timestamp,
     primary key (uuid)
 );
+
+CREATE TABLE schema_version (
+    version integer primary key,
+    description text,
+    applied timestamp without time zone DEFAULT now()
+);
+
+-- Version 1: Add indexes for hot queries
+CREATE UNIQUE INDEX urls_url_key ON urls (url);
+CREATE INDEX content_url_uuid_retrieved_idx ON content (url_uuid, retrieved DESC);
+CREATE UNIQUE INDEX referers_url_uuid_referer_uuid_key ON referers (url_uuid, referer_uuid);
+CREATE UNIQUE INDEX dl_queue_url_key ON dl_queue (url);
+CREATE INDEX dl_queue_ready_idx ON dl_queue (dl_order, added)
+    WHERE NOT paused AND paused_until IS NULL;
+CREATE INDEX dl_queue_paused_until_idx ON dl_queue (paused_until)
+    WHERE paused_until IS NOT NULL;
+CREATE INDEX active_dl_url_uuid_idx ON active_dl (url_uuid);
+CREATE INDEX domain_wait_wait_until_idx ON domain_wait (wait_until);
+INSERT INTO schema_version (version, description) VALUES (1, 'Add indexes for hot queries');
+
+-- Version 2: Add columns for compressed content
+ALTER TABLE content ALTER COLUMN body SET STORAGE EXTERNAL;
+INSERT INTO schema_version (version, description) VALUES (2, 'Add columns for compressed content');
+
+-- Version 3: Add columns for the blob store
+INSERT INTO schema_version (version, description) VALUES (3, 'Add columns for the blob store');
+
+-- Version 4: Add columns for conditional refreshes
+INSERT INTO schema_version (version, description) VALUES (4, 'Add columns for conditional refreshes');
+
+-- Version 5: Index URLs by their hashes
+CREATE UNIQUE INDEX urls_url_hash_url_key ON urls (url_hash, url);
+CREATE UNIQUE INDEX dl_queue_url_hash_url_key ON dl_queue (url_hash, url);
+CREATE INDEX url_metadata_url_hash_idx ON url_metadata (url_hash);
+DROP INDEX urls_url_key;
+DROP INDEX dl_queue_url_key;
+INSERT INTO schema_version (version, description) VALUES (5, 'Index URLs by their hashes');
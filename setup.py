@@ -30,6 +30,11 @@ setup(
         'requests',
         'termcolor',
     ],
+    extras_require={
+        'asyncio': ['aiohttp'],
+        'jsonld': ['orjson'],
+        'zstd': ['zstandard'],
+    },
     scripts=['scripts/flay'],
     data_files=[
         ('share/webflayer', ['schema/webflayer.sql']),